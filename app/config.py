@@ -13,6 +13,124 @@ class Settings:
     AUDIO_TEMP_DIR: str = str(Path(tempfile.gettempdir()) / "avito_voice_messages")
     AUDIO_DOWNLOAD_TIMEOUT: int = 30
     MAX_AUDIO_DURATION: int = 300
+    AUDIO_IN_MEMORY: bool = True  # Голосовые скачиваются в память, без временных файлов
+    AUDIO_SPILL_THRESHOLD_MB: float = 5  # Файлы больше порога пишутся на диск
+    AUDIO_TEMP_MAX_AGE_SECONDS: int = 3600  # Брошенные временные файлы удаляются через час
+    AUDIO_TEMP_QUOTA_MB: int = 500  # Предел объема AUDIO_TEMP_DIR, сверх него удаляются самые старые файлы
+    AUDIO_TEMP_SWEEP_INTERVAL: int = 300
+    VOICE_RESOLVE_WINDOW_MS: int = 20  # Окно сбора voice_id для одного запроса getVoiceFiles
+    VOICE_RESOLVE_MAX_BATCH: int = 10
+    VOICE_MAX_CONCURRENCY: int = 4  # Одновременных скачиваний и распознаваний
+    VOICE_DEFERRED_TRANSCRIPTION: bool = True  # Распознавание идет в фоне во время ожидания новых сообщений
+    STT_BACKEND: str = "api"  # "api" — Whisper API, "local" — faster-whisper на CPU с откатом на API
+    STT_LOCAL_MODEL: str = "small"
+    STT_LOCAL_COMPUTE_TYPE: str = "int8"
+    STT_LOCAL_WORKERS: int = 1  # Процессов с загруженной моделью
+    STT_LOCAL_CPU_THREADS: int = 4
+    STT_LOCAL_MAX_DURATION: int = 60  # Более длинные сообщения распознаются через API
+    STT_LOCAL_TIMEOUT: int = 30
+    AUDIO_PREPROCESSING_ENABLED: bool = False  # ffmpeg: удаление тишины, моно 16 кГц, Opus перед распознаванием
+    AUDIO_PREPROCESS_BITRATE_KBPS: int = 24
+    AUDIO_PREPROCESS_WORKERS: int = 2  # Одновременных процессов ffmpeg
+    AUDIO_PREPROCESS_TIMEOUT: int = 30
+    AUDIO_CHUNK_SECONDS: int = 120  # Более длинные сообщения режутся на части и распознаются параллельно
+    MAX_CHUNKED_AUDIO_DURATION: int = 1800  # Предел длительности при распознавании по частям
+
+    # Окно ожидания следующих сообщений перед ответом
+    DEBOUNCE_ADAPTIVE: bool = True  # Окно подбирается по паузам между сообщениями клиентов
+    DEBOUNCE_FIXED_SECONDS: float = 20  # Окно без адаптации и до накопления статистики
+    DEBOUNCE_MIN_SECONDS: float = 4
+    DEBOUNCE_MAX_SECONDS: float = 30  # Жесткий предел ожидания ответа с первого сообщения серии
+    DEBOUNCE_TERMINAL_SECONDS: float = 3  # Окно после законченного вопроса
+    DEBOUNCE_GAP_MARGIN: float = 1.5  # Запас к 90-му перцентилю пауз
+    DEBOUNCE_MIN_SAMPLES: int = 3
+    DEBOUNCE_CHAT_HISTORY: int = 20
+    DEBOUNCE_GLOBAL_HISTORY: int = 1000
+
+    # Кэш распознанных голосовых сообщений (LRU в памяти + Redis)
+    TRANSCRIPTION_CACHE_ENABLED: bool = True
+    TRANSCRIPTION_CACHE_SIZE: int = 2000
+    TRANSCRIPTION_CACHE_TTL: int = 7 * 24 * 3600
+
+    # Пул соединений с Postgres
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 20
+    DB_POOL_TIMEOUT: int = 30  # Сколько секунд ждать свободное соединение
+    DB_POOL_RECYCLE: int = 1800  # Пересоздание соединений старше 30 минут
+    DB_POOL_PRE_PING: bool = True
+    DB_PREPARED_STATEMENT_CACHE_SIZE: int = 500  # Кэш подготовленных выражений asyncpg
+
+    # Кэш строк Chat (LRU в памяти + Redis, инвалидация через pub/sub)
+    CHAT_CACHE_ENABLED: bool = True
+    CHAT_CACHE_SIZE: int = 10000
+    CHAT_CACHE_LOCAL_TTL: int = 60  # Страховка на случай пропущенной инвалидации
+    CHAT_CACHE_REDIS_TTL: int = 600  # Короткий срок: страховка, если инвалидация не дошла до Redis
+
+    # Очередь уведомлений в Telegram
+    TELEGRAM_OUTBOX_ENABLED: bool = True  # Уведомления отправляются в фоне, не задерживая ответ клиенту
+    TELEGRAM_OUTBOX_PERSIST: bool = True  # Хранить неотправленные уведомления в Redis
+    TELEGRAM_OUTBOX_MAX_ATTEMPTS: int = 5
+    TELEGRAM_OUTBOX_LEASE_SECONDS: int = 30  # Аренда очереди воркера; после истечения ее забирают другие
+    TELEGRAM_GROUP_RATE_PER_MIN: int = 20  # Лимит Telegram на сообщения в группу
+    TELEGRAM_GROUP_BURST: int = 5
+    TELEGRAM_THREAD_RATE_PER_MIN: int = 10
+    TELEGRAM_THREAD_BURST: int = 3
+
+    # Создание топиков Telegram для новых чатов
+    FORUM_TOPIC_ASYNC: bool = True  # Топик создается в фоне, чат сразу сохраняется без thread_id
+    FORUM_TOPIC_RATE_PER_MIN: int = 20
+    FORUM_TOPIC_MAX_ATTEMPTS: int = 5
+    FORUM_TOPIC_MAX_FAILURES: int = 3  # После стольких неудачных серий попыток топик чата при перезапуске не создается
+
+    # Парсер склада
+    SIZE_NORMALIZER_CACHE_SIZE: int = 4096
+    CATALOG_ENABLED: bool = True  # Товары ищутся в каталоге в памяти, а не скачиванием листов на каждый запрос
+    CATALOG_REFRESH_INTERVAL: int = 300
+    CATALOG_MISS_REFRESH_INTERVAL: int = 30  # Не чаще этого обновляем каталог, если ID не найден
+    CATALOG_MISS_REFRESH_TIMEOUT: float = 5  # Сколько ответ ждет обновления каталога, если ID не найден
+    CATALOG_SNAPSHOT_ENABLED: bool = True  # Снимок каталога на диске: ответы по последним данным, если Google недоступен
+    CATALOG_SNAPSHOT_PATH: str = str(Path(tempfile.gettempdir()) / "avito_catalog.sqlite3")
+    KNOWLEDGE_BASE_ENABLED: bool = True  # В контекст добавляются подходящие пары из базы знаний
+    KNOWLEDGE_TOP_K: int = 3
+    KNOWLEDGE_MIN_SCORE: float = 1.0  # Минимальная релевантность BM25
+
+    # Кэш ответов на повторяющиеся вопросы по объявлению
+    ANSWER_CACHE_ENABLED: bool = True
+    ANSWER_CACHE_SIZE: int = 5000
+    ANSWER_CACHE_TTL: int = 24 * 3600
+    ANSWER_CACHE_MIN_WORDS: int = 2  # Более короткие вопросы зависят от истории чата
+    ANSWER_CACHE_STORE_MAX_CLIENT_MESSAGES: int = 2  # Ответ кэшируется, только если до вопроса было лишь приветствие
+    ANSWER_CACHE_SIMILARITY_ENABLED: bool = True  # Поиск того же вопроса в другой формулировке (MinHash)
+    ANSWER_CACHE_SIMILARITY_THRESHOLD: float = 0.8
+    ANSWER_CACHE_MINHASH_PERMUTATIONS: int = 64
+    ANSWER_CACHE_SIMILAR_PER_AD: int = 50  # Сколько вопросов по одному объявлению сравнивается
+
+    # Движок диалога
+    CONVERSATION_ENGINE: str = "assistants"  # "assistants" — треды OpenAI, "chat_completions" — история в Redis
+    CHAT_COMPLETIONS_MODEL: str = "gpt-4o-mini"
+    CHAT_COMPLETIONS_MAX_TOOL_ROUNDS: int = 2  # Сколько раз подряд модель может вызвать функции за один ход
+    CHAT_HISTORY_LIMIT: int = 20
+    CHAT_HISTORY_TTL: int = 24 * 3600
+    REPLY_STREAMING_ENABLED: bool = False  # Длинные ответы уходят в Авито частями по мере генерации (только chat_completions)
+    REPLY_STREAM_FIRST_CHUNK_CHARS: int = 60  # Первая часть отправляется на первой границе предложения после этой длины
+    REPLY_STREAM_CHUNK_CHARS: int = 300
+
+    # Учет расхода OpenAI
+    USAGE_TRACKING_ENABLED: bool = True  # Счетчики токенов и секунд Whisper в Redis, сводка в Postgres
+    USAGE_REDIS_TTL_DAYS: int = 7
+    USAGE_ROLLUP_INTERVAL: int = 3600  # Как часто итоги из Redis записываются в assistant.usage_daily
+    CHAT_TOKEN_BUDGET: int = 0  # Токенов на чат в день; после превышения — дешевая модель и короткая история (0 — без лимита)
+    BUDGET_MODEL: str = "gpt-4.1-nano"
+    BUDGET_HISTORY_LIMIT: int = 6  # Сколько последних сообщений видит модель при превышении бюджета
+
+    # Сжатие длинных тредов OpenAI (движок assistants)
+    THREAD_COMPACTION_ENABLED: bool = True  # Заменять длинный тред новым со сводкой переписки
+    THREAD_COMPACT_MAX_MESSAGES: int = 60  # Сообщений в треде до сжатия
+    THREAD_COMPACT_MAX_TOKENS: int = 30000  # prompt_tokens последнего запуска, после которых тред сжимается
+    THREAD_COMPACT_IDLE_SECONDS: int = 14 * 24 * 3600  # Простой треда, после которого он сжимается перед ответом
+    THREAD_SUMMARY_MODEL: str = "gpt-4o-mini"  # Модель для сводки переписки
+    THREAD_SUMMARY_SOURCE_MESSAGES: int = 100  # Сколько последних сообщений треда попадает в сводку
+    THREAD_STATE_TTL: int = 90 * 24 * 3600  # Время хранения состояния треда в Redis
 
 settings = Settings()
 
@@ -26,6 +144,9 @@ TELEGRAM_ESCALATION_THREAD_ID = os.getenv("TELEGRAM_ESCALATION_THREAD_ID")
 
 OPENAI_ASSISTANT_ID = os.getenv("OPENAI_ASSISTANT_ID")  # Add this line
 
+# Доступ к /metrics: без токена эндпоинт закрыт (в сводке id чатов и объявлений)
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
 # Логи
 SOURCE_TOKEN = os.getenv("source_token")
 INGESTING_HOST = os.getenv("ingesting_host")
@@ -76,6 +197,17 @@ You are a sales manager providing product information to customers. Try answer s
 
 '''
 
+# 📏 ДОПОЛНИТЕЛЬНЫЕ ТАБЛИЦЫ РАЗМЕРОВ (заголовок колонки в таблице -> размер в ответе)
+# Имеют приоритет над встроенной таблицей одежды, регистр и кириллица/латиница не важны
+SIZE_MAPPING = {
+    # Обувь
+    # "eu 38": "38",
+    # "38 eu": "38",
+    # Детские размеры по росту
+    # "рост 110": "110",
+    # "110 см": "110",
+}
+
 # 🚨 КЛЮЧЕВЫЕ СЛОВА ДЛЯ АВТОЭСКАЛАЦИИ
 ESCALATION_KEYWORDS = [
     'самовывоз',
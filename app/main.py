@@ -1,19 +1,43 @@
 from fastapi import FastAPI, Request
 from starlette.middleware.base import BaseHTTPMiddleware
-from app.routes import chat
+from app.routes import chat, metrics
 from app.services.logs import logger
 from contextlib import asynccontextmanager
 import asyncio
 from app.services.telegram_bot import start_bot
+from app.services.chat_cache import chat_cache
+from app.services.telegram_notifier import telegram_outbox
+from app.services.forum_topics import forum_topic_worker
+from app.services.stt_backends import local_whisper_backend
+from app.services.audio_downloader import audio_downloader
+from app.services.google_sheets_api import product_catalog
+from app.services.usage_tracker import usage_tracker
+from app.config import settings
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Фоновый запуск бота при старте FastAPI и инициализация ассистента"""
     bot_task = asyncio.create_task(start_bot())  # Запускаем бота в фоне
+    cache_task = asyncio.create_task(chat_cache.listen_invalidations())  # Инвалидация кэша чатов
+    await telegram_outbox.start()  # Фоновая отправка уведомлений в Telegram
+    await forum_topic_worker.start()  # Фоновое создание топиков для новых чатов
+    await audio_downloader.janitor.start()  # Очистка временных аудио файлов
+    if settings.CATALOG_ENABLED:
+        await product_catalog.start()  # Фоновое обновление каталога товаров
+    if settings.STT_BACKEND == "local":
+        await local_whisper_backend.start()  # Прогреваем локальную модель распознавания
+    await usage_tracker.start()  # Периодическая сводка расхода OpenAI в Postgres
     logger.info("FastAPI приложение запущено!")
     yield  # Ждем завершения приложения
+    await forum_topic_worker.stop()
+    await local_whisper_backend.stop()
+    await audio_downloader.janitor.stop()
+    await product_catalog.stop()
+    await usage_tracker.stop()  # Сохраняем итоги расхода
+    await telegram_outbox.stop()  # Досылаем уведомления, пока бот еще работает
     bot_task.cancel()  # Завершаем бота при выключении FastAPI
+    cache_task.cancel()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -32,6 +56,7 @@ app.add_middleware(LogRequestMiddleware)
 
 # Подключаем маршруты
 app.include_router(chat.router, tags=["Chat"])
+app.include_router(metrics.router, tags=["Metrics"])
 
 
 @app.get("/")
@@ -0,0 +1,69 @@
+import json
+from dataclasses import dataclass, field
+from typing import Optional
+
+
+@dataclass(slots=True)
+class StockItem:
+    """Наличие размеров одного цвета"""
+    color: str
+    sizes: dict[str, str]
+    has_available_sizes: bool
+
+
+@dataclass(slots=True)
+class Product:
+    """Товар со склада; prompt — готовое компактное представление для контекста ассистента"""
+    id: str
+    category: str
+    name: str
+    price: str
+    description: str
+    size_info: str
+    payment_method: str
+    delivery_method: str
+    photo_ids: str
+    stock: list[StockItem]
+    has_stock: bool
+    available_colors: list[str]
+    prompt: str = field(default="", repr=False, compare=False)
+
+    def render_body(self) -> str:
+        """JSON без id, пустых полей и пробелов; id подставляется в with_id"""
+        data = {key: value for key, value in self.to_dict().items() if key != "id" and value not in ("", [])}
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+    def with_id(self, ad_id: str, body: Optional[str] = None) -> "Product":
+        """Копия товара для конкретного объявления (несколько ID в ячейке — один товар)"""
+        body = body if body is not None else self.render_body()
+        prompt = '{"id":' + json.dumps(ad_id) + (',' + body[1:] if body != "{}" else "}")
+        return Product(
+            ad_id, self.category, self.name, self.price, self.description, self.size_info, self.payment_method,
+            self.delivery_method, self.photo_ids, self.stock, self.has_stock, self.available_colors, prompt
+        )
+
+    def to_dict(self) -> dict:
+        # Без dataclasses.asdict: он глубоко копирует все поля, а словарь нужен только для JSON
+        return {
+            "id": self.id,
+            "category": self.category,
+            "name": self.name,
+            "price": self.price,
+            "description": self.description,
+            "size_info": self.size_info,
+            "payment_method": self.payment_method,
+            "delivery_method": self.delivery_method,
+            "photo_ids": self.photo_ids,
+            "stock": [
+                {"color": item.color, "sizes": item.sizes, "has_available_sizes": item.has_available_sizes}
+                for item in self.stock
+            ],
+            "has_stock": self.has_stock,
+            "available_colors": self.available_colors
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Product":
+        stock = [StockItem(**item) for item in data.get("stock", [])]
+        product = cls(**{**data, "stock": stock})
+        return product.with_id(product.id)
@@ -1,42 +1,86 @@
 import json
-import aioredis
+import time
+from typing import Optional
+
+from redis import asyncio as aioredis
 from app.services.logs import logger
 from app.config import REDIS_HOST, REDIS_PORT
 
+_shared_redis = None
+
+
 # Асинхронное подключение к Redis
 async def get_redis():
     return await aioredis.from_url(f"redis://{REDIS_HOST}:{REDIS_PORT}", encoding='utf-8', decode_responses=True)
 
 
+def is_redis_configured() -> bool:
+    return bool(REDIS_HOST and REDIS_PORT)
+
+
+def get_shared_redis():
+    """Общий клиент Redis с пулом соединений (для кэшей и pub/sub, не закрывается после запроса)"""
+    global _shared_redis
+    if _shared_redis is None:
+        _shared_redis = aioredis.from_url(f"redis://{REDIS_HOST}:{REDIS_PORT}", encoding='utf-8',
+                                          decode_responses=True, socket_connect_timeout=1)
+    return _shared_redis
+
+
+class RedisTier:
+    """
+    Доступ сервиса к общему Redis с паузой после ошибки: пока Redis недоступен,
+    client() возвращает None и сервис работает на данных в памяти процесса.
+    """
+
+    def __init__(self, name: str, fallback: str, cooldown: float = 30):
+        self.name = name  # Префикс логов сервиса
+        self.fallback = fallback  # Чем сервис обходится без Redis (для лога)
+        self.cooldown = cooldown
+        self.failures = 0
+        self._down_until = 0.0
+
+    @property
+    def configured(self) -> bool:
+        return is_redis_configured()
+
+    @property
+    def available(self) -> bool:
+        return self.configured and time.monotonic() >= self._down_until
+
+    def client(self) -> Optional[aioredis.Redis]:
+        """Клиент Redis или None, если Redis не настроен или недавно был недоступен"""
+        return get_shared_redis() if self.available else None
+
+    def mark_down(self, error: Exception) -> None:
+        self.failures += 1
+        self._down_until = time.monotonic() + self.cooldown
+        logger.warning(f"[{self.name}] Redis недоступен, {self.fallback} {self.cooldown:.0f}с: {error}")
+
+
 # Получение истории сообщений по user_id и chat_id
 async def get_history(user_id, chat_id):
-    redis = await get_redis()  # Подключение к Redis внутри функции
+    redis = get_shared_redis()
     logger.info(f"[Redis] Получение истории сообщений для пользователя {user_id}, чат {chat_id}")
-    history = await redis.get(f"history:{user_id}:{chat_id}")
-    if history:
-        logger.info(f"[Redis] История для пользователя {user_id}, чат {chat_id} успешно получена")
-        await redis.close()  # Закрытие соединения после использования
-        return json.loads(history)
-    else:
-        logger.info(f"[Redis] История для пользователя {user_id}, чат {chat_id} не найдена")
-        await redis.close()  # Закрытие соединения после использования
-        return []
+    history = await redis.lrange(f"history:{user_id}:{chat_id}", 0, -1)
+    return [json.loads(item) for item in history]
+
+
+# Сохранение сообщений в историю одним запросом (хранится не больше limit последних)
+async def save_messages(user_id, chat_id, messages, limit=20, ttl=86400):
+    redis = get_shared_redis()
+    key = f"history:{user_id}:{chat_id}"
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.rpush(key, *[json.dumps(message, ensure_ascii=False) for message in messages])
+        pipe.ltrim(key, -limit, -1)
+        pipe.expire(key, ttl)  # Храним 24 часа с последнего сообщения
+        await pipe.execute()
+    logger.info(f"[Redis] Сохранено {len(messages)} сообщений в историю пользователя {user_id}, чат {chat_id}")
 
 
 # Сохранение сообщения в историю (максимум 20 сообщений)
 async def save_message(user_id, chat_id, role, message):
-    redis = await get_redis()  # Подключение к Redis внутри функции
-    logger.info(f"[Redis] Сохранение сообщения для пользователя {user_id}, чат {chat_id}, роль: {role}")
-    history = await get_history(user_id, chat_id)
-    if len(history) >= 20:
-        logger.info(f"[Redis] История пользователя {user_id}, чат {chat_id} превышает 20 сообщений, удаление старых")
-        history.pop(0)
-    history.append({"role": role, "content": message})
-
-    await redis.setex(f"history:{user_id}:{chat_id}", 86400, json.dumps(history))  # Храним 24 часа
-    logger.info(f"Сообщение для пользователя {user_id}, чат {chat_id} сохранено в историю")
-    await redis.close()  # Закрытие соединения после использования
-    return None
+    await save_messages(user_id, chat_id, [{"role": role, "content": message}])
 
 
 # Добавление чата в список (каждый chat_id хранится 24 часа)
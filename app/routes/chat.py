@@ -11,18 +11,24 @@ from app.config import Settings, TELEGRAM_ESCALATION_THREAD_ID, ESCALATION_KEYWO
 from db.chat_crud import get_chat_by_id, create_chat, update_chat
 from app.services.telegram_notifier import create_telegram_forum_topic
 from db.messages_crud import get_latest_message_by_chat_id_and_author_id
+from db.db_config import unit_of_work
+from app.services.forum_topics import forum_topic_worker
+from app.services.debounce import debounce_policy
+from app.services.reply_stream import reply_streamer
 
 # 🎙️ Импорты для голосовых сообщений
 from app.services.voice_recognition import voice_recognition
 from app.models.voice_schemas import VoiceProcessingStatus
 
 import asyncio
+from typing import Optional
 
 router = APIRouter()
 
 # Очередь сообщений и задачи ожидания
 message_queues = {}
 processing_tasks = {}
+voice_tasks = {}  # message_id -> фоновое распознавание голосового
 
 def check_escalation_keywords(message_text: str) -> tuple[bool, list[str]]:
     """
@@ -65,6 +71,116 @@ def check_escalation_keywords(message_text: str) -> tuple[bool, list[str]]:
     return needs_escalation, matched_keywords
 
 
+async def auto_escalate(chat_id, author_id, user_id, item_id, matched_keywords: list[str]):
+    """Отключает бота в чате и передает клиента оператору"""
+    logger.info(f"[AutoEscalation] Обнаружены ключевые слова эскалации: {matched_keywords}")
+
+    # Создание ссылки на чат
+    chat_url = f'https://www.avito.ru/profile/messenger/channel/{chat_id}'
+
+    # Получение информации
+    ad_url = await get_ad(user_id, item_id)
+    user_name, user_url = await get_user_info(user_id, chat_id)
+
+    # Проверка/создание чата в БД
+    chat_object = await get_chat_by_id(chat_id)
+    if not chat_object:
+        logger.info(f"[AutoEscalation] Создаем новый чат для эскалации {chat_id}")
+        topic_name = f'{user_name}, {item_id} [АВТОЭСКАЛАЦИЯ]'
+        async_topic = Settings.FORUM_TOPIC_ASYNC and forum_topic_worker.running
+        thread_id = None if async_topic else await create_telegram_forum_topic(topic_name)
+        async with unit_of_work():
+            await create_chat(chat_id, thread_id, author_id, user_id, chat_url,
+                              under_assistant=False)  # Сразу отключаем бота
+            chat_object = await get_chat_by_id(chat_id)
+        if async_topic:
+            await forum_topic_worker.request(chat_id, topic_name)
+    else:
+        # Отключаем бота в существующем чате
+        await update_chat(chat_id, under_assistant=False)
+
+    # Отправляем уведомление в Telegram
+    escalation_message = (
+        f"❗️Требуется срочное внимание менеджера\n\n"
+        f"Товар: {ad_url}\n"
+        f"Причина: Найдены ключевые слова\n"
+        f"Ссылка на чат: {chat_url}\n"
+        f"🔍 Найденные ключевые слова: {', '.join(matched_keywords)}"
+    )
+
+    try:
+        await send_alert(escalation_message, TELEGRAM_ESCALATION_THREAD_ID)
+        logger.info(f"[AutoEscalation] ✅ Уведомление отправлено в Telegram thread {chat_object.thread_id}")
+    except Exception as telegram_error:
+        logger.error(f"[AutoEscalation] ❌ Ошибка отправки Telegram уведомления: {telegram_error}")
+
+    # Отправляем клиенту информацию о передаче оператору
+    try:
+        await send_message(user_id, chat_id,
+                           "Передаю ваш запрос оператору. Сейчас с вами свяжется наш менеджер для решения вопроса.")
+        logger.info(f"[AutoEscalation] ✅ Клиенту отправлено уведомление о передаче оператору")
+    except Exception as send_error:
+        logger.error(f"[AutoEscalation] ❌ Ошибка отправки сообщения клиенту: {send_error}")
+
+
+async def transcribe_voice(chat_id, user_id, voice_url, message_id) -> Optional[str]:
+    """Распознает голосовое сообщение; при ошибке сообщает клиенту и в Telegram и возвращает None"""
+    try:
+        # Распознаем голосовое сообщение
+        voice_result = await voice_recognition.process_voice_message(
+            voice_url=voice_url,
+            chat_id=chat_id,
+            message_id=message_id,
+            user_id=user_id
+        )
+
+        if voice_result.status == VoiceProcessingStatus.COMPLETED and voice_result.transcribed_text:
+            # Успешно распознали - используем как текст
+            message_text = voice_result.transcribed_text
+            logger.info(
+                f"[VoiceMessage] ✅ Голос распознан за {voice_result.processing_time:.2f}с: '{message_text[:50]}...'")
+            return message_text
+        else:
+            # Ошибка распознавания
+            error_msg = voice_result.error_message or "Неизвестная ошибка"
+            logger.error(f"[VoiceMessage] ❌ Ошибка распознавания голоса: {error_msg}")
+
+            await send_message(user_id, chat_id,
+                               "Извините, не удалось распознать ваше голосовое сообщение. Пожалуйста, отправьте текстовое сообщение.")
+
+            # Безопасная отправка Telegram уведомления
+            try:
+                await send_alert(f"❌ Ошибка распознавания голосового сообщения: {error_msg}", 0)
+            except Exception as telegram_error:
+                logger.error(f"[VoiceMessage] Ошибка отправки Telegram уведомления: {telegram_error}")
+
+            return None
+
+    except Exception as e:
+        logger.error(f"[VoiceMessage] 💥 Критическая ошибка обработки голоса: {e}")
+        await send_message(user_id, chat_id,
+                           "Извините, произошла ошибка при обработке голосового сообщения. Попробуйте отправить текст.")
+
+        # Безопасная отправка Telegram уведомления
+        try:
+            await send_alert(f"💥 Критическая ошибка голосового модуля: {str(e)}", 0)
+        except Exception as telegram_error:
+            logger.error(f"[VoiceMessage] Ошибка отправки Telegram уведомления: {telegram_error}")
+
+        return None
+
+
+async def send_chat_alert(chat_id, message: str, thread_id):
+    """Уведомление в топик чата; если топик еще создается — отправится после его создания"""
+    if thread_id is None:
+        if await forum_topic_worker.defer_alert(chat_id, message):
+            return
+        # Топик мог быть создан уже после того, как сообщение попало в очередь
+        chat_object = await get_chat_by_id(chat_id)
+        thread_id = chat_object.thread_id if chat_object else None
+    await send_alert(message, thread_id)
+
+
 async def message_collector(chat_id, message: WebhookRequest):
     """Добавляет сообщение в очередь и сбрасывает таймер ожидания"""
     message_type = message.payload.value.type
@@ -88,17 +204,24 @@ async def message_collector(chat_id, message: WebhookRequest):
     user_name, user_url = await get_user_info(user_id, chat_id)
 
     # Проверка существования чата в БД AIvito
-    if not await get_chat_by_id(chat_id):
+    chat_object = await get_chat_by_id(chat_id)
+    if not chat_object:
         logger.info(f"[Logic] Чат {chat_id} отсутствует")
-        thread_id = await create_telegram_forum_topic(f'{user_name}, {item_id}')
-        # ИСПРАВЛЕНИЕ: Все новые чаты создаются с включенным ассистентом по умолчанию
-        await create_chat(chat_id, thread_id, author_id, user_id, chat_url, under_assistant=True)
-        await send_alert(f"Создан новый чат\nКлиент: {user_name}\nСсылка на клиента: {user_url}\n"
-                         f"Объявление: {ad_url}\nСссылка на чат: {chat_url}\n", thread_id)
+        new_chat_alert = (f"Создан новый чат\nКлиент: {user_name}\nСсылка на клиента: {user_url}\n"
+                          f"Объявление: {ad_url}\nСссылка на чат: {chat_url}\n")
+        async_topic = Settings.FORUM_TOPIC_ASYNC and forum_topic_worker.running
+        # Топик создается в фоне, чтобы ответ клиенту не ждал Telegram
+        thread_id = None if async_topic else await create_telegram_forum_topic(f'{user_name}, {item_id}')
+        async with unit_of_work():
+            # ИСПРАВЛЕНИЕ: Все новые чаты создаются с включенным ассистентом по умолчанию
+            await create_chat(chat_id, thread_id, author_id, user_id, chat_url, under_assistant=True)
+            chat_object = await get_chat_by_id(chat_id)
+        if async_topic:
+            await forum_topic_worker.request(chat_id, f'{user_name}, {item_id}', alert=new_chat_alert)
+        else:
+            await send_alert(new_chat_alert, thread_id)
         logger.info(f"[Logic] Создан новый чат {chat_id} с включенным ассистентом")
 
-    chat_object = await get_chat_by_id(chat_id)
-
     if chat_object.under_assistant is False:
         logger.info(f'[Logic] Чат бот отключен в чате {chat_id} для юзера {user_id}')
         return None
@@ -126,12 +249,14 @@ async def message_collector(chat_id, message: WebhookRequest):
             # Создание/обновление чата в БД (обязательно для всех сообщений)
             if user_id == author_id:
                 # Получаем последнее сообщения для автора сообщения с user_id владельца аккаунта
-                last_message = await get_latest_message_by_chat_id_and_author_id(chat_id, user_id)
+                async with unit_of_work():
+                    last_message = await get_latest_message_by_chat_id_and_author_id(chat_id, user_id)
+                    if last_message != message_text:
+                        await update_chat(chat_id=chat_id, under_assistant=False)
                 if last_message == message_text:
                     logger.info(f'[Logic] Хук на собственное сообщение в чате {chat_id}')
                 else:
-                    await update_chat(chat_id=chat_id, under_assistant=False)
-                    await send_alert("❗️К чату подключился оператор", chat_object.thread_id)
+                    await send_chat_alert(chat_id, "❗️К чату подключился оператор", chat_object.thread_id)
                     logger.info(f'[Logic] К чату {chat_id} подключился оператор')
                 return None
 
@@ -151,49 +276,15 @@ async def message_collector(chat_id, message: WebhookRequest):
                                    "Извините, произошла ошибка при обработке голосового сообщения. Попробуйте отправить текст.")
                 return None
 
-            try:
-                # Распознаем голосовое сообщение
-                voice_result = await voice_recognition.process_voice_message(
-                    voice_url=voice_url,
-                    chat_id=chat_id,
-                    message_id=message_id,
-                    user_id=user_id
-                )
-
-                if voice_result.status == VoiceProcessingStatus.COMPLETED and voice_result.transcribed_text:
-                    # Успешно распознали - используем как текст
-                    message_text = voice_result.transcribed_text
-                    logger.info(
-                        f"[VoiceMessage] ✅ Голос распознан за {voice_result.processing_time:.2f}с: '{message_text[:50]}...'")
-                else:
-                    # Ошибка распознавания
-                    error_msg = voice_result.error_message or "Неизвестная ошибка"
-                    logger.error(f"[VoiceMessage] ❌ Ошибка распознавания голоса: {error_msg}")
-
-                    await send_message(user_id, chat_id,
-                                       "Извините, не удалось распознать ваше голосовое сообщение. Пожалуйста, отправьте текстовое сообщение.")
-
-                    # Безопасная отправка Telegram уведомления
-                    try:
-                        await send_alert(f"❌ Ошибка распознавания голосового сообщения: {error_msg}", 0)
-                    except Exception as telegram_error:
-                        logger.error(f"[VoiceMessage] Ошибка отправки Telegram уведомления: {telegram_error}")
-
+            if Settings.VOICE_DEFERRED_TRANSCRIPTION and str(author_id) != str(user_id):
+                # Распознавание идет в фоне, пока чат ждет следующих сообщений; текст заберем при сбросе очереди
+                voice_tasks[message_id] = asyncio.create_task(
+                    transcribe_voice(chat_id, user_id, voice_url, message_id))
+            else:
+                message_text = await transcribe_voice(chat_id, user_id, voice_url, message_id)
+                if message_text is None:
                     return None
 
-            except Exception as e:
-                logger.error(f"[VoiceMessage] 💥 Критическая ошибка обработки голоса: {e}")
-                await send_message(user_id, chat_id,
-                                   "Извините, произошла ошибка при обработке голосового сообщения. Попробуйте отправить текст.")
-
-                # Безопасная отправка Telegram уведомления
-                try:
-                    await send_alert(f"💥 Критическая ошибка голосового модуля: {str(e)}", 0)
-                except Exception as telegram_error:
-                    logger.error(f"[VoiceMessage] Ошибка отправки Telegram уведомления: {telegram_error}")
-
-                return None
-
     else:
         # 🚫 ГОЛОСОВЫЕ СООБЩЕНИЯ ОТКЛЮЧЕНЫ
         if await message.is_voice_message():
@@ -222,60 +313,19 @@ async def message_collector(chat_id, message: WebhookRequest):
         needs_escalation, matched_keywords = check_escalation_keywords(message_text)
 
         if needs_escalation:
-            logger.info(f"[AutoEscalation] Обнаружены ключевые слова эскалации: {matched_keywords}")
-
-            # Создание ссылки на чат
-            chat_url = f'https://www.avito.ru/profile/messenger/channel/{chat_id}'
-
-            # Получение информации
-            ad_url = await get_ad(user_id, item_id)
-            user_name, user_url = await get_user_info(user_id, chat_id)
-
-            # Проверка/создание чата в БД
-            chat_object = await get_chat_by_id(chat_id)
-            if not chat_object:
-                logger.info(f"[AutoEscalation] Создаем новый чат для эскалации {chat_id}")
-                thread_id = await create_telegram_forum_topic(f'{user_name}, {item_id} [АВТОЭСКАЛАЦИЯ]')
-                await create_chat(chat_id, thread_id, author_id, user_id, chat_url,
-                                  under_assistant=False)  # Сразу отключаем бота
-                chat_object = await get_chat_by_id(chat_id)
-            else:
-                # Отключаем бота в существующем чате
-                await update_chat(chat_id, under_assistant=False)
-
-            # Отправляем уведомление в Telegram
-            escalation_message = (
-                f"❗️Требуется срочное внимание менеджера\n\n"
-                f"Товар: {ad_url}\n"
-                f"Причина: Найдены ключевые слова\n"
-                f"Ссылка на чат: {chat_url}\n"
-                f"🔍 Найденные ключевые слова: {', '.join(matched_keywords)}"
-            )
-
-            try:
-                await send_alert(escalation_message, TELEGRAM_ESCALATION_THREAD_ID)
-                logger.info(f"[AutoEscalation] ✅ Уведомление отправлено в Telegram thread {chat_object.thread_id}")
-            except Exception as telegram_error:
-                logger.error(f"[AutoEscalation] ❌ Ошибка отправки Telegram уведомления: {telegram_error}")
-
-            # Отправляем клиенту информацию о передаче оператору
-            try:
-                await send_message(user_id, chat_id,
-                                   "Передаю ваш запрос оператору. Сейчас с вами свяжется наш менеджер для решения вопроса.")
-                logger.info(f"[AutoEscalation] ✅ Клиенту отправлено уведомление о передаче оператору")
-            except Exception as send_error:
-                logger.error(f"[AutoEscalation] ❌ Ошибка отправки сообщения клиенту: {send_error}")
-
+            await auto_escalate(chat_id, author_id, user_id, item_id, matched_keywords)
             return None  # Прекращаем обработку, передали оператору
 
     # Логика при отключенном WORKING_TIME_LOGIC остается прежней
     if user_id == author_id:
-        last_message = await get_latest_message_by_chat_id_and_author_id(chat_id, user_id)
+        async with unit_of_work():
+            last_message = await get_latest_message_by_chat_id_and_author_id(chat_id, user_id)
+            if last_message != message_text:
+                await update_chat(chat_id=chat_id, under_assistant=False)
         if last_message == message_text:
             logger.info(f'[Logic] Хук на собственное сообщение в чате {chat_id}')
         else:
-            await update_chat(chat_id=chat_id, under_assistant=False)
-            await send_alert("❗️К чату подключился оператор", chat_object.thread_id)
+            await send_chat_alert(chat_id, "❗️К чату подключился оператор", chat_object.thread_id)
             logger.info(f'[Logic] К чату {chat_id} подключился оператор')
         return None
 
@@ -287,7 +337,7 @@ async def message_collector(chat_id, message: WebhookRequest):
 
     # 🎙️ Создаем объект сообщения с распознанным текстом для голосовых
     message_for_queue = message
-    if await message.is_voice_message() and Settings.VOICE_RECOGNITION_ENABLED:
+    if await message.is_voice_message() and Settings.VOICE_RECOGNITION_ENABLED and message_text:
         # Создаем копию сообщения с замененным текстом
         message_for_queue.payload.value.content.text = message_text
 
@@ -297,19 +347,32 @@ async def message_collector(chat_id, message: WebhookRequest):
     if chat_id in processing_tasks and not processing_tasks[chat_id].done():
         processing_tasks[chat_id].cancel()
 
-    # Запускаем новый таймер
+    # Запускаем новый таймер (окно ожидания зависит от того, как пишет клиент)
+    debounce_policy.record_message(chat_id)
+    delay = debounce_policy.delay(chat_id, message_text)
     processing_tasks[chat_id] = asyncio.create_task(
-        process_queue_after_delay(chat_id, author_id, user_id, message_text, ad_url, user_name, chat_object.thread_id))
+        process_queue_after_delay(chat_id, author_id, user_id, message_text, ad_url, user_name, chat_object.thread_id,
+                                  delay=delay))
 
 
-async def process_queue_after_delay(chat_id, author_id, user_id, message_text, ad_url, user_name, thread_id):
-    """ Ждет 20 секунд без новых сообщений, затем обрабатывает очередь """
+async def process_queue_after_delay(chat_id, author_id, user_id, message_text, ad_url, user_name, thread_id,
+                                    delay: float = 20):
+    """ Ждет delay секунд без новых сообщений, затем обрабатывает очередь """
     try:
-        logger.info(f"[Queue] Ожидание 20 секунд для {chat_id}")
-        await asyncio.sleep(20)  # Ожидание без сброса
+        logger.info(f"[Queue] Ожидание {delay:.0f} секунд для {chat_id}")
+        await asyncio.sleep(delay)  # Ожидание без сброса
     except asyncio.CancelledError:
         return  # Таймер был сброшен новым сообщением
 
+    debounce_policy.record_flush(chat_id, delay)
+
+    # Новое сообщение сбрасывает только ожидание: начатая обработка очереди не прерывается
+    await asyncio.shield(
+        flush_queue(chat_id, author_id, user_id, message_text, ad_url, user_name, thread_id))
+
+
+async def flush_queue(chat_id, author_id, user_id, message_text, ad_url, user_name, thread_id):
+    """Забирает накопленные сообщения, дожидается распознавания голосовых и отправляет на обработку"""
     queue = message_queues.get(chat_id)
     if not queue:
         return
@@ -318,8 +381,27 @@ async def process_queue_after_delay(chat_id, author_id, user_id, message_text, a
     while not queue.empty():
         messages.append(await queue.get())
 
-    # Склеиваем все сообщения (теперь голосовые уже содержат распознанный текст)
-    combined_message = " ".join(msg.payload.value.content.text for msg in messages)
+    # Распознавание голосовых запущено при получении — здесь забираем готовые (или почти готовые) тексты
+    pending = {msg.payload.value.id: voice_tasks.pop(msg.payload.value.id)
+               for msg in messages if msg.payload.value.id in voice_tasks}
+    voice_texts = dict(zip(pending, await asyncio.gather(*pending.values())))
+
+    texts = [voice_texts[msg.payload.value.id] if msg.payload.value.id in voice_texts else msg.payload.value.content.text
+             for msg in messages]
+    texts = [text for text in texts if text]
+    if not texts:
+        logger.info(f"[Queue] В очереди чата {chat_id} не осталось сообщений с текстом")
+        return
+
+    # Текст голосовых не проверялся на ключевые слова при получении
+    if Settings.AUTO_ESCALATION_ENABLED and voice_texts:
+        needs_escalation, matched_keywords = check_escalation_keywords(" ".join(filter(None, voice_texts.values())))
+        if needs_escalation:
+            await auto_escalate(chat_id, author_id, user_id, messages[-1].payload.value.item_id, matched_keywords)
+            return
+
+    # Склеиваем все сообщения в исходном порядке
+    combined_message = " ".join(texts)
 
     # Отправляем на обработку
     await process_and_send_response(combined_message, chat_id, author_id, user_id, ad_url, user_name, thread_id)
@@ -330,8 +412,12 @@ async def process_and_send_response(combined_message, chat_id, author_id, user_i
     logger.info(f'[Logic] Обработка запроса от {chat_id}')
 
     chat_url = f'https://www.avito.ru/profile/messenger/channel/{chat_id}'
+    # Длинный ответ уходит клиенту частями по мере генерации
+    stream = reply_streamer.open(user_id, chat_id, send_message) if reply_streamer.enabled else None
     response = await process_message(client_id=author_id, user_id=user_id, chat_id=chat_id, message=combined_message,
-                                     ad_url=ad_url, client_name=user_name, chat_url=chat_url)
+                                     ad_url=ad_url, client_name=user_name, chat_url=chat_url,
+                                     on_text=stream.feed if stream else None)
+    streamed = await stream.finish() if stream else False
 
     if response == "__emoji_only__":
         logger.info(f"[Logic] Пропущено сообщение только из эмодзи в чате {chat_id}")
@@ -339,14 +425,17 @@ async def process_and_send_response(combined_message, chat_id, author_id, user_i
         logger.error(f'[Logic] Не получен ответ от модели в чате {chat_id}')
     elif response == 'Communication finished':
         logger.info(f'[Logic] Коммуникация завершена {chat_id}')
-        await send_alert(f"💁‍♂️ {user_name}: {combined_message}\n🤖 Бот: Коммуникация завершена\n_____\n\n",
-                         thread_id=thread_id)
+        await send_chat_alert(chat_id, f"💁‍♂️ {user_name}: {combined_message}\n🤖 Бот: Коммуникация завершена\n_____\n\n",
+                              thread_id=thread_id)
     else:
         logger.info(f"[Logic] Чат {chat_id}\n"
                     f"Ответ модели: {response}")
-        await send_message(user_id, chat_id, response)
-        await send_alert(f"💁‍♂️ {user_name}: {combined_message}\n🤖 Бот: {response}\n_____\n\n",
-                         thread_id=thread_id)
+        if not streamed:
+            # Через ту же блокировку, что и части потокового ответа: порядок ответов в чате сохраняется
+            async with reply_streamer.chat_lock(chat_id):
+                await send_message(user_id, chat_id, response)
+        await send_chat_alert(chat_id, f"💁‍♂️ {user_name}: {combined_message}\n🤖 Бот: {response}\n_____\n\n",
+                              thread_id=thread_id)
 
 from pydantic import ValidationError
 import traceback
@@ -0,0 +1,47 @@
+import secrets
+from typing import Optional
+
+from fastapi import APIRouter, Header, HTTPException, Query
+
+from app.config import METRICS_TOKEN
+from app.services.answer_cache import answer_cache
+from app.services.chat_cache import chat_cache
+from app.services.chat_engine import chat_completions_engine
+from app.services.debounce import debounce_policy
+from app.services.forum_topics import forum_topic_worker
+from app.services.google_sheets_api import product_catalog
+from app.services.knowledge_index import knowledge_index
+from app.services.reply_stream import reply_streamer
+from app.services.telegram_notifier import telegram_outbox
+from app.services.thread_compaction import thread_compactor
+from app.services.usage_tracker import usage_tracker
+from app.services.voice_recognition import voice_recognition
+from db.db_config import get_pool_stats
+
+router = APIRouter()
+
+
+@router.get("/metrics")
+async def metrics(token: Optional[str] = Query(None),
+                  x_metrics_token: Optional[str] = Header(None)):
+    """ Расход OpenAI за сегодня и состояние кэшей и фоновых сервисов (JSON); токен — в X-Metrics-Token или ?token= """
+    provided = x_metrics_token or token
+    if not METRICS_TOKEN or not provided or not secrets.compare_digest(provided, METRICS_TOKEN):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    return {
+        "usage": await usage_tracker.snapshot(),
+        "usage_tracker": usage_tracker.stats(),
+        "answer_cache": answer_cache.stats(),
+        "chat_cache": chat_cache.stats(),
+        "debounce": debounce_policy.stats(),
+        "catalog": product_catalog.stats(),
+        "knowledge_index": knowledge_index.stats(),
+        "chat_engine": chat_completions_engine.stats(),
+        "reply_stream": reply_streamer.stats(),
+        "thread_compaction": thread_compactor.stats(),
+        "telegram_outbox": telegram_outbox.stats(),
+        "forum_topics": forum_topic_worker.stats(),
+        # Включает кэш распознаваний, очистку временных файлов и предобработку аудио
+        "voice": await voice_recognition.get_processing_stats(),
+        "db_pool": get_pool_stats()
+    }
@@ -0,0 +1,214 @@
+import hashlib
+import json
+import random
+from dataclasses import dataclass
+from typing import Optional
+
+from app.config import settings
+from app.redis_db import RedisTier
+from app.services.cache import LRUCache
+from app.services.knowledge_index import TOKEN_PATTERN
+from app.services.logs import logger
+
+# Вежливые слова не меняют смысл вопроса; отрицания и местоимения оставляем — от них зависит ответ
+FILLER_WORDS = {
+    "здравствуйте", "здрасте", "привет", "добрый", "день", "вечер", "утро", "пожалуйста", "подскажите",
+    "скажите", "спасибо", "а", "ну", "вот", "еще"
+}
+# Слова, которые меняют ответ при почти одинаковом тексте: "есть 46?" и "есть 48?" похожи на 90%
+NEGATIONS = {"не", "нет", "ни"}
+MINHASH_PRIME = (1 << 61) - 1
+
+
+def normalize_question(text: str) -> str:
+    words = TOKEN_PATTERN.findall(str(text).lower().replace("ё", "е"))
+    return " ".join(word for word in words if word not in FILLER_WORDS)
+
+
+def context_version(*parts: Optional[str]) -> str:
+    """Версия данных, на которых построен ответ: меняется вместе с товаром или подобранным FAQ"""
+    digest = hashlib.blake2b(digest_size=8)
+    for part in parts:
+        digest.update((part or "").encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+
+def question_markers(question: str) -> frozenset:
+    """Числа и отрицания вопроса — похожий вопрос должен совпадать с кэшированным по ним точно"""
+    return frozenset(word for word in question.split() if word.isdigit() or word in NEGATIONS)
+
+
+class MinHasher:
+    """MinHash по символьным триграммам: близкие формулировки дают близкие сигнатуры"""
+
+    def __init__(self, permutations: int = 64, shingle_size: int = 3, seed: int = 1):
+        rng = random.Random(seed)
+        self.shingle_size = shingle_size
+        self._permutations = [
+            (rng.randrange(1, MINHASH_PRIME), rng.randrange(0, MINHASH_PRIME)) for _ in range(permutations)
+        ]
+
+    def signature(self, text: str) -> tuple[int, ...]:
+        size = self.shingle_size
+        shingles = {text[i:i + size] for i in range(max(1, len(text) - size + 1))}
+        hashes = [
+            int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "little")
+            for shingle in shingles
+        ]
+        return tuple(min((a * h + b) % MINHASH_PRIME for h in hashes) for a, b in self._permutations)
+
+    @staticmethod
+    def similarity(first: tuple[int, ...], second: tuple[int, ...]) -> float:
+        return sum(x == y for x, y in zip(first, second)) / len(first)
+
+
+@dataclass(slots=True)
+class AnswerKey:
+    ad_id: str
+    version: str
+    question: str
+
+    @property
+    def redis_key(self) -> str:
+        question_hash = hashlib.blake2b(self.question.encode("utf-8"), digest_size=12).hexdigest()
+        return f"answer:{self.ad_id}:{self.version}:{question_hash}"
+
+
+class AnswerCache:
+    """
+    Кэш ответов ассистента на повторяющиеся вопросы по объявлению.
+    Ключ — (ad_id, версия товара и FAQ, нормализованный вопрос): LRU в памяти процесса + Redis.
+    Второй уровень (MinHash, только в памяти) находит тот же вопрос в другой формулировке.
+    Хранятся только ответы без вызова функций, поэтому эскалации и заказы всегда проходят через ассистента,
+    и только на вопросы, до которых клиент успел лишь поздороваться: ответ на позднем ходу опирается
+    на рост, размеры и договоренности из истории конкретного чата.
+    """
+
+    def __init__(self):
+        self.local = LRUCache(maxsize=settings.ANSWER_CACHE_SIZE, ttl=settings.ANSWER_CACHE_TTL)
+        # (ad_id, версия) -> [(сигнатура, числа и отрицания, ответ)]
+        self.similar = LRUCache(maxsize=settings.ANSWER_CACHE_SIZE, ttl=settings.ANSWER_CACHE_TTL)
+        self.minhash = MinHasher(settings.ANSWER_CACHE_MINHASH_PERMUTATIONS)
+        self.redis_ttl = settings.ANSWER_CACHE_TTL
+        self.redis = RedisTier("AnswerCache", "работаем без него")
+        self.exact_hits = 0
+        self.similar_hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+        self.skipped = 0
+        self.stores = 0
+        # Средняя длительность запуска ассистента — столько экономит каждое попадание
+        self.run_seconds_avg = 0.0
+        self.saved_seconds = 0.0
+
+    def key(self, ad_id: str, version: str, text: str) -> Optional[AnswerKey]:
+        """None, если вопрос слишком короткий: "а в черном?" без истории чата не понять"""
+        question = normalize_question(text)
+        # Предлоги и частицы не делают вопрос самостоятельным
+        if sum(len(word) > 2 for word in question.split()) < settings.ANSWER_CACHE_MIN_WORDS:
+            return None
+        return AnswerKey(str(ad_id), version, question)
+
+    async def get(self, key: AnswerKey) -> Optional[str]:
+        answer, similar = await self._lookup(key)
+        if similar:
+            self.similar_hits += 1
+        elif answer is not None:
+            self.exact_hits += 1
+
+        if answer is None:
+            self.misses += 1
+            return None
+        self.saved_seconds += self.run_seconds_avg
+        return answer
+
+    async def peek(self, key: AnswerKey) -> Optional[str]:
+        """Ответ, который отдал бы get, без учета в статистике попаданий"""
+        answer, _ = await self._lookup(key)
+        return answer
+
+    async def _lookup(self, key: AnswerKey) -> tuple[Optional[str], bool]:
+        """(ответ, найден ли он по похожему вопросу): память процесса, Redis, затем MinHash"""
+        answer = self.local.get((key.ad_id, key.version, key.question))
+        if answer is None:
+            answer = await self._get_redis(key)
+        if answer is None and settings.ANSWER_CACHE_SIMILARITY_ENABLED:
+            answer = self._get_similar(key)
+            return answer, answer is not None
+        return answer, False
+
+    async def _get_redis(self, key: AnswerKey) -> Optional[str]:
+        redis = self.redis.client()
+        if redis is None:
+            return None
+        try:
+            raw = await redis.get(key.redis_key)
+        except Exception as e:
+            self.redis.mark_down(e)
+            return None
+        if raw is None:
+            return None
+        answer = json.loads(raw)["answer"]
+        self.local.set((key.ad_id, key.version, key.question), answer)
+        self.redis_hits += 1
+        return answer
+
+    def _get_similar(self, key: AnswerKey) -> Optional[str]:
+        bucket = self.similar.get((key.ad_id, key.version))
+        if not bucket:
+            return None
+        markers = question_markers(key.question)
+        candidates = [(other, answer) for other, other_markers, answer in bucket if other_markers == markers]
+        if not candidates:
+            return None
+        signature = self.minhash.signature(key.question)
+        score, answer = max((self.minhash.similarity(signature, other), answer) for other, answer in candidates)
+        if score < settings.ANSWER_CACHE_SIMILARITY_THRESHOLD:
+            return None
+        logger.info(f"[AnswerCache] Похожий вопрос для {key.ad_id}: сходство {score:.2f}")
+        return answer
+
+    async def set(self, key: AnswerKey, answer: str) -> None:
+        self.local.set((key.ad_id, key.version, key.question), answer)
+        self.stores += 1
+        if settings.ANSWER_CACHE_SIMILARITY_ENABLED:
+            bucket_key = (key.ad_id, key.version)
+            bucket = self.similar.get(bucket_key) or []
+            bucket.append((self.minhash.signature(key.question), question_markers(key.question), answer))
+            self.similar.set(bucket_key, bucket[-settings.ANSWER_CACHE_SIMILAR_PER_AD:])
+
+        redis = self.redis.client()
+        if redis is None:
+            return
+        try:
+            await redis.set(key.redis_key, json.dumps({"answer": answer}, ensure_ascii=False), ex=self.redis_ttl)
+        except Exception as e:
+            self.redis.mark_down(e)
+
+    def record_run(self, seconds: float) -> None:
+        """Учитывает длительность запуска ассистента при промахе кэша"""
+        if self.run_seconds_avg:
+            self.run_seconds_avg = 0.9 * self.run_seconds_avg + 0.1 * seconds
+        else:
+            self.run_seconds_avg = seconds
+
+    def stats(self) -> dict:
+        hits = self.exact_hits + self.similar_hits
+        total = hits + self.misses
+        return {
+            "size": len(self.local),
+            "exact_hits": self.exact_hits,
+            "similar_hits": self.similar_hits,
+            "redis_hits": self.redis_hits,
+            "misses": self.misses,
+            "skipped": self.skipped,
+            "stores": self.stores,
+            "hit_rate": round(hits / total, 4) if total else 0.0,
+            "run_seconds_avg": round(self.run_seconds_avg, 3),
+            "saved_seconds": round(self.saved_seconds, 1)
+        }
+
+
+# Создаем глобальный экземпляр
+answer_cache = AnswerCache()
@@ -0,0 +1,151 @@
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Optional
+
+from app.config import TELEGRAM_ESCALATION_THREAD_ID
+from app.services.logs import logger
+from db.chat_crud import update_chat
+from db.db_config import unit_of_work
+from db.escalation_crud import create_escalation
+from db.orders_crud import create_order
+from db.returns_crud import create_return
+
+# Функции ассистента: одна схема для Assistants API и Chat Completions
+TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "escalation",
+            "description": "Client wants to be connected with manager or operator, or assistant cannot help the client",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "reason": {"type": "string", "description": "Reason for escalation"},
+                },
+                "required": ["reason"]
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "create_order",
+            "description": "Create an order for a product",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "size": {"type": "string", "description": "Size of the product"},
+                    "color": {"type": "string", "description": "Color of the product"},
+                },
+                "required": ["size", "color"]
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "initiate_return",
+            "description": "Initiate a return for a product",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "date_of_order": {"type": "string", "description": "Date of the order"},
+                    "reason": {"type": "string", "description": "Reason for return"},
+                },
+                "required": ["date_of_order", "reason"]
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "finish_communication",
+            "description": "Finish communication when client sends a final message like 'Thank you', 'Order placed', 'Thanks, I ordered' or any other message indicating the conversation goal has been achieved and no further assistance is needed",
+            "parameters": {
+                "type": "object",
+                "properties": {},
+                "required": []
+            }
+        }
+    }
+]
+
+
+@dataclass(slots=True)
+class ToolContext:
+    """Данные чата, нужные обработчикам функций"""
+    chat_id: str
+    client_id: str
+    client_name: str
+    chat_url: str
+    ad_url: str
+    good_name: str
+
+
+@dataclass(slots=True)
+class ToolResult:
+    """Результат функции для модели и уведомление, которое отправляется в фоне, не задерживая ответ"""
+    output: dict
+    alert: Optional[tuple[str, Any]] = None  # (текст, тред Telegram)
+
+
+async def handle_escalation(arguments: dict, context: ToolContext) -> ToolResult:
+    reason = arguments.get("reason")
+
+    # Эскалация и отключение бота — одна транзакция
+    async with unit_of_work():
+        await create_escalation(context.chat_id, context.client_id, context.client_name, context.chat_url, reason)
+        # Отключает бота в чате, если была эскалация
+        await update_chat(context.chat_id, under_assistant=False)
+
+    return ToolResult(
+        {"status": "success", "message": "Escalation created"},
+        (f"❗️Требуется срочное внимание менеджера\n\n"
+         f"Товар: {context.ad_url}\n"
+         f"Причина: {reason}\n"
+         f"Ссылка на чат: {context.chat_url}", TELEGRAM_ESCALATION_THREAD_ID)
+    )
+
+
+async def handle_create_order(arguments: dict, context: ToolContext) -> ToolResult:
+    size = arguments.get("size")
+    color = arguments.get("color")
+
+    await create_order(context.chat_id, context.client_id, context.client_name, color, size, context.ad_url,
+                       context.good_name)
+
+    return ToolResult(
+        {"status": "success", "message": "Order created"},
+        (f"Новый заказ\n\n"
+         f"Товар: {context.ad_url}\n"
+         f"Размер: {size}\n"
+         f"Цвет: {color}", 138)
+    )
+
+
+async def handle_initiate_return(arguments: dict, context: ToolContext) -> ToolResult:
+    date_of_order = arguments.get("date_of_order")
+    reason = arguments.get("reason")
+
+    await create_return(context.chat_id, context.client_id, context.client_name, reason, context.ad_url)
+
+    return ToolResult(
+        {"status": "success", "message": "Return initiated"},
+        (f"Новая заявка на возврат\n\n"
+         f"Товар: {context.ad_url}\n"
+         f"Заказ от: {date_of_order}\n"
+         f"Причина: {reason}", 76)
+    )
+
+
+async def handle_finish_communication(arguments: dict, context: ToolContext) -> ToolResult:
+    logger.info(f"[Assistant] Communication finished in chat {context.chat_id}")
+    return ToolResult({"status": "success", "message": "Communication finished"})
+
+
+# Обработчики функций ассистента по имени из TOOLS
+TOOL_HANDLERS: dict[str, Callable[[dict, ToolContext], Awaitable[ToolResult]]] = {
+    "escalation": handle_escalation,
+    "create_order": handle_create_order,
+    "initiate_return": handle_initiate_return,
+    "finish_communication": handle_finish_communication,
+}
@@ -1,8 +1,11 @@
+import asyncio
+import io
 import os
 import httpx
 import aiofiles
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import BinaryIO, Optional, Tuple, Union
 import uuid
 from urllib.parse import urlparse
 
@@ -10,6 +13,149 @@ from app.config import settings, CLIENT_ID, CLIENT_SECRET
 from app.services.logs import logger
 from app.models.voice_schemas import VoiceError, VoiceErrorCodes, AudioFormat
 from app.services.avito_api import get_avito_token
+from app.services.temp_janitor import TempFileJanitor
+
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 1024 * 1024
+
+
+@dataclass
+class AudioSource:
+    """Скачанное аудио: байты в памяти или (для больших файлов) временный файл на диске"""
+    filename: str
+    data: Optional[bytes] = None
+    file_path: Optional[str] = None
+
+    @classmethod
+    def from_path(cls, file_path: str) -> "AudioSource":
+        return cls(filename=Path(file_path).name, file_path=file_path)
+
+    @property
+    def in_memory(self) -> bool:
+        return self.data is not None
+
+    def exists(self) -> bool:
+        return self.in_memory or os.path.exists(self.file_path)
+
+    @property
+    def size(self) -> int:
+        return len(self.data) if self.in_memory else os.path.getsize(self.file_path)
+
+    def open(self) -> BinaryIO:
+        return io.BytesIO(self.data) if self.in_memory else open(self.file_path, "rb")
+
+    def read_bytes(self) -> bytes:
+        if self.in_memory:
+            return self.data
+        with open(self.file_path, "rb") as audio_file:
+            return audio_file.read()
+
+
+class VoiceResolveError(Exception):
+    """Ошибка получения URL голосовых файлов, общая для всех voice_id запроса"""
+
+    def __init__(self, error: VoiceError):
+        super().__init__(error.message)
+        self.error = error
+
+
+class VoiceUrlResolver:
+    """
+    Получает URL голосовых файлов пачками.
+    Клиенты часто присылают несколько голосовых подряд: voice_id, пришедшие в течение
+    короткого окна, запрашиваются одним вызовом getVoiceFiles (эндпоинт принимает несколько id).
+    """
+
+    def __init__(self, timeout: int):
+        self.timeout = timeout
+        self.window = settings.VOICE_RESOLVE_WINDOW_MS / 1000
+        self.max_batch = settings.VOICE_RESOLVE_MAX_BATCH
+        self._pending: dict[str, dict[str, list[asyncio.Future]]] = {}  # user_id -> voice_id -> ожидающие
+        self._timers: dict[str, asyncio.Task] = {}
+        self._flushing: set[asyncio.Task] = set()
+        self.requests = 0
+        self.resolved = 0
+
+    async def resolve(self, user_id, voice_id: str) -> Optional[str]:
+        """Возвращает URL файла или None, если voice_id нет в ответе API"""
+        account = str(user_id)
+        future = asyncio.get_running_loop().create_future()
+        batch = self._pending.setdefault(account, {})
+        batch.setdefault(voice_id, []).append(future)
+
+        if len(batch) >= self.max_batch:
+            timer = self._timers.pop(account, None)
+            if timer:
+                timer.cancel()
+            task = asyncio.create_task(self._flush(account))
+            self._flushing.add(task)
+            task.add_done_callback(self._flushing.discard)
+        elif account not in self._timers:
+            self._timers[account] = asyncio.create_task(self._flush_later(account))
+        return await future
+
+    async def _flush_later(self, account: str) -> None:
+        await asyncio.sleep(self.window)
+        self._timers.pop(account, None)
+        await self._flush(account)
+
+    async def _flush(self, account: str) -> None:
+        batch = self._pending.pop(account, None)
+        if not batch:
+            return
+        try:
+            urls = await self._fetch(account, list(batch))
+        except Exception as e:
+            for futures in batch.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            return
+
+        for voice_id, futures in batch.items():
+            for future in futures:
+                if not future.done():
+                    future.set_result(urls.get(voice_id))
+
+    async def _fetch(self, user_id: str, voice_ids: list[str]) -> dict:
+        # Получаем токен авторизации Avito
+        try:
+            auth_token = await get_avito_token()
+        except Exception as e:
+            logger.error(f"[AudioDownloader] Ошибка получения токена Avito: {e}")
+            raise VoiceResolveError(VoiceError(
+                code=VoiceErrorCodes.NETWORK_ERROR,
+                message="Не удалось получить токен авторизации Avito"
+            ))
+
+        voice_url_api = f"https://api.avito.ru/messenger/v1/accounts/{user_id}/getVoiceFiles"
+
+        headers = {
+            "Authorization": f"Bearer {auth_token}",
+            "User-Agent": "AvitoAI-Assistant/1.0",
+            "Accept": "application/json"
+        }
+
+        params = {
+            "voice_ids": voice_ids
+        }
+
+        logger.info(f"[AudioDownloader] Запрашиваем URL для voice_id: {', '.join(voice_ids)}")
+        self.requests += 1
+
+        async with httpx.AsyncClient(timeout=self.timeout) as client:
+            response = await client.get(voice_url_api, headers=headers, params=params)
+
+        if response.status_code != 200:
+            logger.error(f"[AudioDownloader] Ошибка получения URL: HTTP {response.status_code}")
+            raise VoiceResolveError(VoiceError(
+                code=VoiceErrorCodes.DOWNLOAD_FAILED,
+                message=f"Не удалось получить URL голосового файла: HTTP {response.status_code}"
+            ))
+
+        voices_urls = response.json().get("voices_urls", {})
+        self.resolved += len(voices_urls)
+        return voices_urls
 
 
 class AudioDownloader:
@@ -19,13 +165,23 @@ class AudioDownloader:
         self.temp_dir = Path(settings.AUDIO_TEMP_DIR)
         self.max_size_bytes = settings.MAX_AUDIO_SIZE_MB * 1024 * 1024
         self.timeout = settings.AUDIO_DOWNLOAD_TIMEOUT
+        self.spill_threshold_bytes = int(settings.AUDIO_SPILL_THRESHOLD_MB * 1024 * 1024)
+        self.resolver = VoiceUrlResolver(self.timeout)
+        self._download_slots = asyncio.Semaphore(settings.VOICE_MAX_CONCURRENCY)
+        self.janitor = TempFileJanitor(
+            self.temp_dir,
+            max_age_seconds=settings.AUDIO_TEMP_MAX_AGE_SECONDS,
+            quota_bytes=settings.AUDIO_TEMP_QUOTA_MB * 1024 * 1024,
+            interval=settings.AUDIO_TEMP_SWEEP_INTERVAL,
+            name="AudioJanitor"
+        )
 
         # Создаем временную директорию если не существует
         self.temp_dir.mkdir(parents=True, exist_ok=True)
         logger.info(f"[AudioDownloader] Временная директория: {self.temp_dir}")
 
     async def download_voice_file(self, voice_id: str, chat_id: str, message_id: str, user_id: int) -> Tuple[
-        Optional[str], Optional[VoiceError]]:
+        Optional[AudioSource], Optional[VoiceError]]:
         """
         Скачивает голосовой файл через официальный API Авито
 
@@ -36,65 +192,30 @@ class AudioDownloader:
             user_id: ID пользователя для API запроса
 
         Returns:
-            Tuple[file_path, error]: Путь к скачанному файлу или ошибка
+            Tuple[audio, error]: Скачанное аудио (в памяти или во временном файле) или ошибка
         """
         logger.info(f"[AudioDownloader] Начинаем скачивание голосового сообщения {voice_id}")
 
         try:
-            # Получаем токен авторизации Avito
+            # Шаг 1: Получаем URL голосового файла через официальный API (одним запросом с соседними голосовыми)
             try:
-                auth_token = await get_avito_token()
-            except Exception as e:
-                logger.error(f"[AudioDownloader] Ошибка получения токена Avito: {e}")
+                voice_file_url = await self.resolver.resolve(user_id, voice_id)
+            except VoiceResolveError as e:
+                return None, e.error
+
+            if not voice_file_url:
+                logger.error(f"[AudioDownloader] voice_id {voice_id} не найден в ответе API")
                 error = VoiceError(
-                    code=VoiceErrorCodes.NETWORK_ERROR,
-                    message="Не удалось получить токен авторизации Avito"
+                    code=VoiceErrorCodes.DOWNLOAD_FAILED,
+                    message=f"Голосовой файл {voice_id} не найден"
                 )
                 return None, error
 
-            # Шаг 1: Получаем URL голосового файла через официальный API
-            voice_url_api = f"https://api.avito.ru/messenger/v1/accounts/{user_id}/getVoiceFiles"
-            
-            headers = {
-                "Authorization": f"Bearer {auth_token}",
-                "User-Agent": "AvitoAI-Assistant/1.0",
-                "Accept": "application/json"
-            }
-            
-            params = {
-                "voice_ids": voice_id
-            }
-
-            logger.info(f"[AudioDownloader] Запрашиваем URL для voice_id: {voice_id}")
-
-            async with httpx.AsyncClient(timeout=self.timeout) as client:
-                response = await client.get(voice_url_api, headers=headers, params=params)
-                
-                if response.status_code != 200:
-                    logger.error(f"[AudioDownloader] Ошибка получения URL: HTTP {response.status_code}")
-                    error = VoiceError(
-                        code=VoiceErrorCodes.DOWNLOAD_FAILED,
-                        message=f"Не удалось получить URL голосового файла: HTTP {response.status_code}"
-                    )
-                    return None, error
-
-                # Парсим ответ
-                voice_data = response.json()
-                voices_urls = voice_data.get("voices_urls", {})
-                
-                if voice_id not in voices_urls:
-                    logger.error(f"[AudioDownloader] voice_id {voice_id} не найден в ответе API")
-                    error = VoiceError(
-                        code=VoiceErrorCodes.DOWNLOAD_FAILED,
-                        message=f"Голосовой файл {voice_id} не найден"
-                    )
-                    return None, error
-
-                voice_file_url = voices_urls[voice_id]
-                logger.info(f"[AudioDownloader] Получен URL голосового файла: {voice_file_url}")
+            logger.info(f"[AudioDownloader] Получен URL голосового файла: {voice_file_url}")
 
             # Шаг 2: Скачиваем файл по полученному URL
-            return await self._download_file_from_url(voice_file_url, chat_id, message_id, voice_id)
+            async with self._download_slots:
+                return await self._download_file_from_url(voice_file_url, chat_id, message_id, voice_id)
 
         except httpx.TimeoutException:
             logger.error(f"[AudioDownloader] Таймаут при получении URL для voice_id: {voice_id}")
@@ -112,17 +233,35 @@ class AudioDownloader:
             )
             return None, error
 
+    def _chunk_size(self, content_length: Optional[str]) -> int:
+        """Размер чанка под размер файла: меньше итераций для больших файлов, без лишнего для маленьких"""
+        if not content_length:
+            return MIN_CHUNK_SIZE
+        return min(max(int(content_length) // 4, MIN_CHUNK_SIZE), MAX_CHUNK_SIZE)
+
+    def _size_error(self, size: int) -> VoiceError:
+        size_mb = size / (1024 * 1024)
+        logger.error(f"[AudioDownloader] Файл слишком большой: {size_mb:.1f} МБ")
+        return VoiceError(
+            code=VoiceErrorCodes.FILE_TOO_LARGE,
+            message=f"Размер файла {size_mb:.1f} МБ превышает лимит {settings.MAX_AUDIO_SIZE_MB} МБ"
+        )
+
     async def _download_file_from_url(self, voice_file_url: str, chat_id: str, message_id: str, voice_id: str) -> Tuple[
-        Optional[str], Optional[VoiceError]]:
+        Optional[AudioSource], Optional[VoiceError]]:
         """
-        Скачивает файл по прямому URL
+        Скачивает файл по прямому URL.
+        Небольшие файлы остаются в памяти, на диск пишутся только файлы больше AUDIO_SPILL_THRESHOLD_MB.
         """
-        try:
-            # Генерируем уникальное имя файла (Авито использует opus в mp4 контейнере)
-            filename = f"{chat_id}_{message_id}_{voice_id[:8]}.mp4"
-            file_path = self.temp_dir / filename
+        # Генерируем уникальное имя файла (Авито использует opus в mp4 контейнере)
+        filename = f"{chat_id}_{message_id}_{voice_id[:8]}.mp4"
+        file_path = self.temp_dir / filename
+        spill_threshold = self.spill_threshold_bytes if settings.AUDIO_IN_MEMORY else 0
+        buffer = bytearray()
+        file = None
 
-            logger.info(f"[AudioDownloader] Скачиваем файл в: {file_path}")
+        try:
+            logger.info(f"[AudioDownloader] Скачиваем файл {filename}")
 
             # Скачиваем файл (URL от Авито уже авторизован, дополнительные заголовки не нужны)
             async with httpx.AsyncClient(timeout=self.timeout) as client:
@@ -139,47 +278,47 @@ class AudioDownloader:
                     # Проверяем размер файла из заголовков
                     content_length = response.headers.get("content-length")
                     if content_length and int(content_length) > self.max_size_bytes:
-                        size_mb = int(content_length) / (1024 * 1024)
-                        logger.error(f"[AudioDownloader] Файл слишком большой: {size_mb:.1f} МБ")
-                        error = VoiceError(
-                            code=VoiceErrorCodes.FILE_TOO_LARGE,
-                            message=f"Размер файла {size_mb:.1f} МБ превышает лимит {settings.MAX_AUDIO_SIZE_MB} МБ"
-                        )
-                        return None, error
+                        return None, self._size_error(int(content_length))
 
-                    # Скачиваем файл по частям
                     total_size = 0
-                    async with aiofiles.open(file_path, "wb") as file:
-                        async for chunk in response.aiter_bytes(chunk_size=8192):
-                            total_size += len(chunk)
-
-                            # Проверяем размер в процессе скачивания
-                            if total_size > self.max_size_bytes:
-                                await file.close()
-                                file_path.unlink(missing_ok=True)
-
-                                size_mb = total_size / (1024 * 1024)
-                                logger.error(f"[AudioDownloader] Файл превысил лимит размера: {size_mb:.1f} МБ")
-                                error = VoiceError(
-                                    code=VoiceErrorCodes.FILE_TOO_LARGE,
-                                    message=f"Размер файла {size_mb:.1f} МБ превышает лимит {settings.MAX_AUDIO_SIZE_MB} МБ"
-                                )
-                                return None, error
-
+                    async for chunk in response.aiter_bytes(chunk_size=self._chunk_size(content_length)):
+                        total_size += len(chunk)
+
+                        # Проверяем размер в процессе скачивания
+                        if total_size > self.max_size_bytes:
+                            return None, self._size_error(total_size)
+
+                        if file is None and total_size > spill_threshold:
+                            # Файл оказался большим — дальше пишем на диск
+                            logger.info(f"[AudioDownloader] Файл больше порога, пишем на диск: {file_path}")
+                            file = await aiofiles.open(file_path, "wb")
+                            # Файл в работе с момента создания: квота не удалит его посреди скачивания
+                            self.janitor.track(file_path, 0)
+                            await file.write(bytes(buffer))
+                            buffer = bytearray()
+
+                        if file is None:
+                            buffer += chunk
+                        else:
                             await file.write(chunk)
 
-            # Проверяем что файл успешно создан
-            if not file_path.exists() or file_path.stat().st_size == 0:
-                logger.error(f"[AudioDownloader] Файл не создан или пустой: {file_path}")
+            if total_size == 0:
+                logger.error(f"[AudioDownloader] Скачан пустой файл {filename}")
                 error = VoiceError(
                     code=VoiceErrorCodes.DOWNLOAD_FAILED,
                     message="Файл не был скачан или оказался пустым"
                 )
                 return None, error
 
-            file_size = file_path.stat().st_size
-            logger.info(f"[AudioDownloader] Файл успешно скачан: {file_path} ({file_size} байт)")
-            return str(file_path), None
+            if file is not None:
+                await file.close()
+                file = None
+                self.janitor.track(file_path, total_size)  # Окончательный размер
+                logger.info(f"[AudioDownloader] Файл успешно скачан: {file_path} ({total_size} байт)")
+                return AudioSource(filename=filename, file_path=str(file_path)), None
+
+            logger.info(f"[AudioDownloader] Файл успешно скачан в память: {filename} ({total_size} байт)")
+            return AudioSource(filename=filename, data=bytes(buffer)), None
 
         except httpx.TimeoutException:
             logger.error(f"[AudioDownloader] Таймаут при скачивании файла")
@@ -191,16 +330,19 @@ class AudioDownloader:
 
         except Exception as e:
             logger.error(f"[AudioDownloader] Ошибка при скачивании файла: {e}")
-            # Удаляем файл если он был создан частично
-            if 'file_path' in locals() and file_path.exists():
-                file_path.unlink(missing_ok=True)
-
             error = VoiceError(
                 code=VoiceErrorCodes.DOWNLOAD_FAILED,
                 message=f"Ошибка скачивания: {str(e)}"
             )
             return None, error
 
+        finally:
+            # Файл на диске остается только при успешном скачивании
+            if file is not None:
+                await file.close()
+                file_path.unlink(missing_ok=True)
+                self.janitor.untrack(file_path)
+
     def _is_valid_url(self, url: str) -> bool:
         """Проверяет валидность URL"""
         try:
@@ -209,34 +351,25 @@ class AudioDownloader:
         except Exception:
             return False
 
-    async def cleanup_file(self, file_path: str) -> None:
+    async def cleanup_file(self, file_path: Union[str, AudioSource]) -> None:
         """Удаляет временный файл"""
+        if isinstance(file_path, AudioSource):
+            if file_path.in_memory:
+                return
+            file_path = file_path.file_path
         try:
             path = Path(file_path)
             if path.exists():
                 path.unlink()
                 logger.info(f"[AudioDownloader] Временный файл удален: {file_path}")
+            self.janitor.untrack(path)
         except Exception as e:
             logger.error(f"[AudioDownloader] Ошибка при удалении файла {file_path}: {e}")
 
     async def cleanup_old_files(self, max_age_hours: int = 24) -> None:
-        """Удаляет старые временные файлы"""
+        """Удаляет старые временные файлы (и файлы сверх квоты)"""
         try:
-            import time
-            current_time = time.time()
-            max_age_seconds = max_age_hours * 3600
-
-            cleaned_count = 0
-            for file_path in self.temp_dir.glob("*"):
-                if file_path.is_file():
-                    file_age = current_time - file_path.stat().st_mtime
-                    if file_age > max_age_seconds:
-                        file_path.unlink()
-                        cleaned_count += 1
-
-            if cleaned_count > 0:
-                logger.info(f"[AudioDownloader] Удалено {cleaned_count} старых временных файлов")
-
+            await self.janitor.sweep(max_age_seconds=max_age_hours * 3600)
         except Exception as e:
             logger.error(f"[AudioDownloader] Ошибка при очистке старых файлов: {e}")
 
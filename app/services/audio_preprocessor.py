@@ -0,0 +1,105 @@
+import asyncio
+import math
+import shutil
+from pathlib import Path
+from typing import Optional
+
+from app.config import settings
+from app.services.audio_downloader import AudioSource
+from app.services.logs import logger
+
+# Предобработка выполняется через ffmpeg — без него этап пропускается
+FFMPEG_PATH = shutil.which("ffmpeg")
+FFMPEG_AVAILABLE = FFMPEG_PATH is not None
+
+# Вырезаем паузы длиннее 0.7с тише -40 дБ (энергетический VAD ffmpeg)
+SILENCE_FILTER = "silenceremove=start_periods=1:start_threshold=-40dB:stop_periods=-1:stop_duration=0.7:stop_threshold=-40dB"
+
+
+class AudioPreprocessor:
+    """
+    Сжатие голосовых перед распознаванием: удаление тишины, моно 16 кГц, Opus с низким битрейтом.
+    Длинные сообщения режутся на части, которые распознаются параллельно и склеиваются обратно.
+    """
+
+    def __init__(self):
+        self.chunk_seconds = settings.AUDIO_CHUNK_SECONDS
+        self._slots = asyncio.Semaphore(settings.AUDIO_PREPROCESS_WORKERS)
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.failures = 0
+
+    @property
+    def enabled(self) -> bool:
+        return settings.AUDIO_PREPROCESSING_ENABLED and FFMPEG_AVAILABLE
+
+    async def prepare(self, audio: AudioSource, duration: Optional[float]) -> list[AudioSource]:
+        """
+        Возвращает части аудио для распознавания (по порядку).
+        При ошибке ffmpeg возвращается исходное аудио одним куском.
+        """
+        if duration and duration > self.chunk_seconds:
+            starts = range(0, math.ceil(duration), self.chunk_seconds)
+            pieces = await asyncio.gather(*(self._encode(audio, index, start) for index, start in enumerate(starts)))
+        else:
+            pieces = [await self._encode(audio)]
+
+        if any(piece is None for piece in pieces):
+            self.failures += 1
+            return [audio]
+
+        self.bytes_in += audio.size
+        self.bytes_out += sum(piece.size for piece in pieces)
+        logger.info(f"[AudioPreprocessor] {audio.filename}: {audio.size} -> {sum(p.size for p in pieces)} байт, "
+                    f"частей: {len(pieces)}")
+        return pieces
+
+    async def _encode(self, audio: AudioSource, index: int = 0, start: Optional[int] = None) -> Optional[AudioSource]:
+        args = [FFMPEG_PATH, "-hide_banner", "-loglevel", "error"]
+        if start is not None:
+            args += ["-ss", str(start), "-t", str(self.chunk_seconds)]
+        args += [
+            "-i", "pipe:0" if audio.in_memory else audio.file_path,
+            "-af", SILENCE_FILTER,
+            "-ac", "1", "-ar", "16000",
+            "-c:a", "libopus", "-b:a", f"{settings.AUDIO_PREPROCESS_BITRATE_KBPS}k",
+            "-f", "ogg", "pipe:1"
+        ]
+
+        async with self._slots:
+            process = await asyncio.create_subprocess_exec(
+                *args,
+                stdin=asyncio.subprocess.PIPE if audio.in_memory else asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+            try:
+                stdout, stderr = await asyncio.wait_for(
+                    process.communicate(audio.data if audio.in_memory else None),
+                    settings.AUDIO_PREPROCESS_TIMEOUT
+                )
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+                logger.warning(f"[AudioPreprocessor] Таймаут ffmpeg для {audio.filename}")
+                return None
+
+        if process.returncode != 0 or not stdout:
+            logger.warning(f"[AudioPreprocessor] ffmpeg не обработал {audio.filename}: "
+                           f"{stderr.decode(errors='ignore').strip()[:200]}")
+            return None
+
+        return AudioSource(filename=f"{Path(audio.filename).stem}_{index}.ogg", data=stdout)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "ffmpeg_available": FFMPEG_AVAILABLE,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "failures": self.failures
+        }
+
+
+# Создаем глобальный экземпляр
+audio_preprocessor = AudioPreprocessor()
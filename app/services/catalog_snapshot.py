@@ -0,0 +1,74 @@
+import json
+import sqlite3
+from contextlib import closing
+from pathlib import Path
+from typing import Optional
+
+from app.models.product import Product
+from app.services.logs import logger
+
+
+class CatalogSnapshot:
+    """
+    Снимок каталога товаров на локальном диске (SQLite), чтобы после перезапуска отвечать
+    по последним данным, даже если Google Sheets недоступен.
+    Методы синхронные — вызываются через asyncio.to_thread.
+    """
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+
+    def _connect(self) -> sqlite3.Connection:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        connection = sqlite3.connect(self.path)
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS sheets ("
+            "name TEXT PRIMARY KEY, position INTEGER NOT NULL, content_hash TEXT NOT NULL, products TEXT NOT NULL)"
+        )
+        connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        return connection
+
+    def load(self) -> Optional[dict]:
+        """Возвращает {"revision", "confirmed_at", "sheets": [(name, content_hash, products)]} или None"""
+        if not self.path.exists():
+            return None
+        try:
+            with closing(self._connect()) as connection, connection:
+                meta = dict(connection.execute("SELECT key, value FROM meta"))
+                rows = connection.execute(
+                    "SELECT name, content_hash, products FROM sheets ORDER BY position"
+                ).fetchall()
+        except sqlite3.Error as e:
+            logger.error(f"[CatalogSnapshot] Не удалось прочитать снимок {self.path}: {e}")
+            return None
+        if not rows or "confirmed_at" not in meta:
+            return None
+        return {
+            "revision": meta.get("revision"),
+            "confirmed_at": float(meta["confirmed_at"]),
+            "sheets": [
+                (name, content_hash, {ad_id: Product.from_dict(data) for ad_id, data in json.loads(products).items()})
+                for name, content_hash, products in rows
+            ]
+        }
+
+    def save(self, revision: Optional[str], confirmed_at: float, order: list[str],
+             changed: dict, removed: set) -> None:
+        """Записывает только измененные листы; changed — {name: (content_hash, products)}"""
+        try:
+            with closing(self._connect()) as connection, connection:
+                connection.executemany("DELETE FROM sheets WHERE name = ?", [(name,) for name in removed])
+                connection.executemany(
+                    "INSERT OR REPLACE INTO sheets (name, position, content_hash, products) VALUES (?, ?, ?, ?)",
+                    [(name, order.index(name), content_hash,
+                      json.dumps({ad_id: product.to_dict() for ad_id, product in products.items()}, ensure_ascii=False))
+                     for name, (content_hash, products) in changed.items()]
+                )
+                connection.executemany("UPDATE sheets SET position = ? WHERE name = ?",
+                                       [(position, name) for position, name in enumerate(order)])
+                connection.executemany(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                    [("revision", revision), ("confirmed_at", str(confirmed_at))]
+                )
+        except sqlite3.Error as e:
+            logger.error(f"[CatalogSnapshot] Не удалось сохранить снимок {self.path}: {e}")
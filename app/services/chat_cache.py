@@ -0,0 +1,225 @@
+import asyncio
+import datetime
+import itertools
+import json
+from typing import Optional
+
+from app.config import settings
+from app.redis_db import RedisTier, get_shared_redis, is_redis_configured
+from app.services.cache import LRUCache
+from app.services.logs import logger
+
+INVALIDATION_CHANNEL = "chat_cache:invalidate"
+
+# Строка сохраняется, только если версия чата не изменилась с начала чтения из БД
+FILL_IF_VERSION_SCRIPT = """
+if (redis.call('GET', KEYS[2]) or '0') == ARGV[1] then
+    redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+    return 1
+end
+return 0
+"""
+
+
+class ChatCache:
+    """
+    Read-through кэш строк Chat: LRU в памяти процесса + Redis.
+    Изменения чатов публикуются в канал Redis, и каждый воркер (и aiogram-бот)
+    сбрасывает у себя локальную запись.
+    Каждое изменение увеличивает версию чата; строка, прочитанная из БД до изменения,
+    в кэш уже не попадет (version() до чтения, set(..., version) после).
+    """
+
+    def __init__(self):
+        self.local = LRUCache(maxsize=settings.CHAT_CACHE_SIZE, ttl=settings.CHAT_CACHE_LOCAL_TTL)
+        self.redis_ttl = settings.CHAT_CACHE_REDIS_TTL
+        self.redis_hits = 0
+        self.stale_fills = 0
+        self.redis = RedisTier("ChatCache", "работаем без него")
+        # chat_id -> номер последней инвалидации в этом процессе (номера не повторяются)
+        self.versions = LRUCache(maxsize=settings.CHAT_CACHE_SIZE)
+        self._version_counter = itertools.count(1)
+        # Инвалидации, не дошедшие до Redis: повторяются, пока Redis снова не ответит
+        self.pending: set[str] = set()
+
+    @staticmethod
+    def _redis_key(chat_id) -> str:
+        return f"chat_cache:{chat_id}"
+
+    @staticmethod
+    def _version_key(chat_id) -> str:
+        return f"chat_cache:version:{chat_id}"
+
+    @staticmethod
+    def _serialize(row: dict) -> str:
+        return json.dumps(
+            {k: (v.isoformat() if isinstance(v, datetime.datetime) else v) for k, v in row.items()},
+            ensure_ascii=False
+        )
+
+    @staticmethod
+    def _deserialize(raw: str) -> dict:
+        row = json.loads(raw)
+        for key in ("created_at", "updated_at"):
+            if row.get(key):
+                row[key] = datetime.datetime.fromisoformat(row[key])
+        return row
+
+    def _bump_local(self, chat_id) -> None:
+        self.local.pop(str(chat_id))
+        self.versions.set(str(chat_id), next(self._version_counter))
+
+    async def _flush_pending(self, redis) -> None:
+        for chat_id in list(self.pending):
+            await self._invalidate_redis(redis, chat_id)
+            self.pending.discard(chat_id)
+        logger.info("[ChatCache] Отложенные инвалидации отправлены в Redis")
+
+    async def _invalidate_redis(self, redis, chat_id) -> None:
+        async with redis.pipeline(transaction=True) as pipe:
+            pipe.incr(self._version_key(chat_id))
+            pipe.expire(self._version_key(chat_id), self.redis_ttl)
+            pipe.delete(self._redis_key(chat_id))
+            await pipe.execute()
+        await redis.publish(INVALIDATION_CHANNEL, str(chat_id))
+
+    async def _ready_redis(self, chat_id):
+        """Redis для записи чата или None: Redis недоступен либо инвалидация чата еще не дошла до него"""
+        redis = self.redis.client()
+        if redis is None:
+            return None
+        if self.pending:
+            try:
+                await self._flush_pending(redis)
+            except Exception as e:
+                self.redis.mark_down(e)
+                return None
+        return redis if str(chat_id) not in self.pending else None
+
+    async def version(self, chat_id) -> Optional[tuple]:
+        """Версия чата перед чтением из БД; None — строку кэшировать нельзя"""
+        if not settings.CHAT_CACHE_ENABLED:
+            return None
+        local_version = self.versions.get(str(chat_id))
+        redis = await self._ready_redis(chat_id)
+        if redis is None:
+            return local_version, None
+        try:
+            return local_version, await redis.get(self._version_key(chat_id)) or "0"
+        except Exception as e:
+            self.redis.mark_down(e)
+            return local_version, None
+
+    async def get(self, chat_id) -> Optional[dict]:
+        if not settings.CHAT_CACHE_ENABLED:
+            return None
+
+        row = self.local.get(str(chat_id))
+        if row is not None:
+            return row
+
+        redis = await self._ready_redis(chat_id)
+        if redis is None:
+            return None
+        try:
+            raw = await redis.get(self._redis_key(chat_id))
+        except Exception as e:
+            self.redis.mark_down(e)
+            return None
+        if raw is None:
+            return None
+
+        row = self._deserialize(raw)
+        self.local.set(str(chat_id), row)
+        self.redis_hits += 1
+        return row
+
+    async def set(self, chat_id, row: dict, version: Optional[tuple] = None) -> None:
+        """Кэширует строку; с version — только если чат не менялся с момента version()"""
+        if not settings.CHAT_CACHE_ENABLED:
+            return
+        local_version, redis_version = version or (None, None)
+        if version is not None and self.versions.get(str(chat_id)) != local_version:
+            self.stale_fills += 1
+            return
+        self.local.set(str(chat_id), row)
+
+        redis = await self._ready_redis(chat_id)
+        if redis is None or (version is not None and redis_version is None):
+            return
+        try:
+            if version is None:
+                await redis.set(self._redis_key(chat_id), self._serialize(row), ex=self.redis_ttl)
+                return
+            stored = await redis.eval(FILL_IF_VERSION_SCRIPT, 2, self._redis_key(chat_id), self._version_key(chat_id),
+                                      redis_version, self._serialize(row), self.redis_ttl)
+            if not stored:
+                # Чат изменили другим процессом, пока строка читалась из БД
+                self.stale_fills += 1
+                self.local.pop(str(chat_id))
+        except Exception as e:
+            self.redis.mark_down(e)
+
+    async def invalidate(self, chat_id) -> None:
+        """Сбрасывает запись локально, в Redis и во всех остальных процессах"""
+        self._bump_local(chat_id)
+
+        redis = self.redis.client()
+        if redis is None:
+            if self.redis.configured:
+                self.pending.add(str(chat_id))
+            return
+        try:
+            await self._invalidate_redis(redis, chat_id)
+        except Exception as e:
+            self.pending.add(str(chat_id))
+            self.redis.mark_down(e)
+
+    async def listen_invalidations(self) -> None:
+        """Фоновая задача: слушает канал инвалидаций и сбрасывает локальные записи"""
+        if not is_redis_configured():
+            logger.info("[ChatCache] Redis не настроен, межпроцессная инвалидация отключена")
+            return
+
+        while True:
+            pubsub = get_shared_redis().pubsub()
+            try:
+                await pubsub.subscribe(INVALIDATION_CHANNEL)
+                logger.info(f"[ChatCache] Подписка на {INVALIDATION_CHANNEL}")
+                async for message in pubsub.listen():
+                    if message.get("type") == "message":
+                        self._bump_local(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Пока подписки не было, могли пропустить инвалидации — локальный кэш больше не доверенный
+                logger.error(f"[ChatCache] Ошибка подписки на инвалидации: {e}")
+                self.local.clear()
+                await asyncio.sleep(5)
+            finally:
+                try:
+                    await pubsub.close()
+                except Exception:
+                    pass
+
+    async def clear(self) -> None:
+        """Полный сброс кэша (локально и в Redis)"""
+        self.local.clear()
+
+        redis = self.redis.client()
+        if redis is None:
+            return
+        try:
+            keys = [key async for key in redis.scan_iter(match=self._redis_key("*"))]
+            if keys:
+                await redis.delete(*keys)
+        except Exception as e:
+            self.redis.mark_down(e)
+
+    def stats(self) -> dict:
+        return {**self.local.stats(), "redis_hits": self.redis_hits, "stale_fills": self.stale_fills,
+                "pending_invalidations": len(self.pending)}
+
+
+# Создаем глобальный экземпляр
+chat_cache = ChatCache()
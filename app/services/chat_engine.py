@@ -0,0 +1,194 @@
+import json
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Optional
+
+from openai import AsyncOpenAI
+
+from app.config import settings, OPENAI_API_KEY, prompt
+from app.redis_db import RedisTier, get_history, save_messages
+from app.services.assistant_tools import TOOLS
+from app.services.cache import LRUCache
+from app.services.logs import logger
+from app.services.usage_tracker import usage_tokens
+
+# Обработчик функций хода: [(имя, аргументы)] -> результаты для модели в том же порядке
+ToolHandler = Callable[[list[tuple[str, dict]]], Awaitable[list[dict]]]
+# Получатель фрагментов текста ответа по мере генерации
+TextCallback = Callable[[str], None]
+
+
+@dataclass(slots=True)
+class ToolCall:
+    """Вызов функции, собранный из фрагментов потока"""
+    id: str = ""
+    name: str = ""
+    arguments: str = ""
+
+
+@dataclass(slots=True)
+class EngineReply:
+    text: Optional[str]
+    function_name: Optional[str] = None
+    model: Optional[str] = None
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    tools: list[str] = field(default_factory=list)  # Вызванные за ход функции
+
+
+class ChatCompletionsEngine:
+    """
+    Движок диалога на Chat Completions вместо тредов Assistants API.
+    История чата хранится локально (Redis, при его недоступности — память процесса) и ограничена
+    CHAT_HISTORY_LIMIT сообщениями; на ход — один потоковый запрос и еще один после вызова функций.
+    """
+
+    def __init__(self, client: Optional[AsyncOpenAI] = None):
+        self.client = client or AsyncOpenAI(api_key=OPENAI_API_KEY)
+        self.local_history = LRUCache(maxsize=settings.CHAT_CACHE_SIZE, ttl=settings.CHAT_HISTORY_TTL)
+        self.redis = RedisTier("ChatEngine", "история в памяти")
+        self.turns = 0
+        self.requests = 0
+        self.tool_calls = 0
+
+    async def load_history(self, user_id, chat_id) -> list[dict]:
+        if self.redis.available:
+            try:
+                return await get_history(user_id, chat_id)
+            except Exception as e:
+                self.redis.mark_down(e)
+        return list(self.local_history.get((user_id, chat_id)) or [])
+
+    async def save_history(self, user_id, chat_id, messages: list[dict]) -> None:
+        limit = settings.CHAT_HISTORY_LIMIT
+        history = (self.local_history.get((user_id, chat_id)) or []) + messages
+        self.local_history.set((user_id, chat_id), history[-limit:])
+        if self.redis.available:
+            try:
+                await save_messages(user_id, chat_id, messages, limit=limit, ttl=settings.CHAT_HISTORY_TTL)
+            except Exception as e:
+                self.redis.mark_down(e)
+
+    async def _complete(self, messages: list[dict], reply: EngineReply, with_tools: bool = True,
+                        on_text: Optional[TextCallback] = None) -> tuple[str, list[ToolCall]]:
+        """
+        Один потоковый запрос: собирает текст ответа и вызовы функций из фрагментов.
+        Текст передается в on_text сразу, пока модель не начала вызывать функцию; токены добавляются в reply.
+        """
+        self.requests += 1
+        options = {"tools": TOOLS} if with_tools else {}
+        stream = await self.client.chat.completions.create(
+            model=reply.model, messages=messages, stream=True,
+            # Последний фрагмент потока содержит расход токенов
+            extra_body={"stream_options": {"include_usage": True}}, **options
+        )
+        parts: list[str] = []
+        calls: dict[int, ToolCall] = {}
+        async for chunk in stream:
+            usage = getattr(chunk, "usage", None)
+            if usage:
+                prompt_tokens, completion_tokens = usage_tokens(usage)
+                reply.prompt_tokens += prompt_tokens
+                reply.completion_tokens += completion_tokens
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            if delta.content:
+                parts.append(delta.content)
+                if on_text is not None and not calls:
+                    on_text(delta.content)
+            for tool_delta in delta.tool_calls or []:
+                call = calls.setdefault(tool_delta.index, ToolCall())
+                if tool_delta.id:
+                    call.id = tool_delta.id
+                if tool_delta.function:
+                    call.name += tool_delta.function.name or ""
+                    call.arguments += tool_delta.function.arguments or ""
+        return "".join(parts), [calls[index] for index in sorted(calls)]
+
+    async def respond(self, user_id, chat_id, text: str, context: str, handle_tools: ToolHandler,
+                      on_text: Optional[TextCallback] = None, economy: bool = False) -> EngineReply:
+        """
+        Ответ на сообщение клиента; контекст (товар, FAQ) передается в запрос, но не сохраняется в историю.
+        economy — чат превысил бюджет токенов: дешевая модель и короткая история.
+        """
+        self.turns += 1
+        history = await self.load_history(user_id, chat_id)
+        result = EngineReply(None, model=settings.CHAT_COMPLETIONS_MODEL)
+        if economy:
+            history = history[-settings.BUDGET_HISTORY_LIMIT:]
+            result.model = settings.BUDGET_MODEL
+        messages = [
+            {"role": "system", "content": prompt},
+            *history,
+            {"role": "system", "content": context},
+            {"role": "user", "content": text}
+        ]
+
+        # Текст раундов, закончившихся вызовом функции, уже ушел клиенту и входит в ответ
+        streamed: list[str] = []
+        round_text: list[str] = []
+
+        def emit(delta: str) -> None:
+            round_text.append(delta)
+            on_text(delta)
+
+        max_rounds = settings.CHAT_COMPLETIONS_MAX_TOOL_ROUNDS
+        for round_index in range(max_rounds + 1):
+            round_text.clear()
+            reply, tool_calls = await self._complete(messages, result, with_tools=round_index < max_rounds,
+                                                     on_text=emit if on_text is not None else None)
+            if not tool_calls:
+                break
+            if "".join(round_text).strip():
+                streamed.append("".join(round_text).strip())
+                on_text("\n")  # Текст следующего раунда начнется с новой части
+
+            messages.append({
+                "role": "assistant",
+                "content": reply or None,
+                "tool_calls": [
+                    {"id": call.id, "type": "function", "function": {"name": call.name, "arguments": call.arguments}}
+                    for call in tool_calls
+                ]
+            })
+            calls = []
+            for call in tool_calls:
+                result.function_name = call.name
+                result.tools.append(call.name)
+                self.tool_calls += 1
+                try:
+                    arguments = json.loads(call.arguments or "{}")
+                except json.JSONDecodeError:
+                    logger.error(f"[ChatEngine] Некорректные аргументы {call.name}: {call.arguments}")
+                    arguments = {}
+                calls.append((call.name, arguments))
+            outputs = await handle_tools(calls)
+            messages.extend(
+                {"role": "tool", "tool_call_id": call.id, "content": json.dumps(output)}
+                for call, output in zip(tool_calls, outputs)
+            )
+
+            # Завершение диалога не требует ответа клиенту
+            if result.function_name == "finish_communication":
+                await self.save_history(user_id, chat_id, [{"role": "user", "content": text}])
+                return result
+
+        result.text = "\n".join(part for part in [*streamed, reply] if part) if streamed else reply
+        await self.save_history(user_id, chat_id, [
+            {"role": "user", "content": text},
+            {"role": "assistant", "content": result.text}
+        ])
+        return result
+
+    def stats(self) -> dict:
+        return {
+            "turns": self.turns,
+            "requests": self.requests,
+            "tool_calls": self.tool_calls,
+            "history_fallbacks": self.redis.failures,
+            "local_histories": len(self.local_history)
+        }
+
+
+# Создаем глобальный экземпляр
+chat_completions_engine = ChatCompletionsEngine()
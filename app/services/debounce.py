@@ -0,0 +1,124 @@
+import re
+import statistics
+import time
+from collections import deque
+from typing import Optional
+
+from app.config import settings
+from app.services.cache import LRUCache
+
+# Сообщение выглядит законченным: вопрос/восклицание в конце или типовая завершенная просьба
+TERMINAL_PUNCTUATION = ("?", "!", "？")
+COMPLETE_INTENT_PATTERNS = re.compile(
+    r"\b(сколько стоит|какая цена|есть в наличии|как заказать|хочу заказать|можно заказать|"
+    r"куда приехать|где забрать|какой адрес|спасибо|до свидания)\b",
+    re.IGNORECASE
+)
+
+
+class _ChatGaps:
+    """Интервалы между сообщениями одного чата"""
+
+    __slots__ = ("last_message_at", "last_flush_at", "series_started_at", "gaps")
+
+    def __init__(self, history: int):
+        self.last_message_at: Optional[float] = None
+        self.last_flush_at: Optional[float] = None
+        self.series_started_at: Optional[float] = None  # Первое сообщение, еще не получившее ответа
+        self.gaps: deque = deque(maxlen=history)
+
+
+class DebouncePolicy:
+    """
+    Адаптивное окно ожидания перед ответом.
+    Окно подбирается по интервалам между сообщениями (по чату, а пока данных мало — по всем чатам),
+    сокращается, если сообщение выглядит законченным. DEBOUNCE_MAX_SECONDS ограничивает все ожидание
+    серии сообщений: каждое новое сообщение перезапускает таймер, но не отодвигает ответ дальше предела.
+    """
+
+    def __init__(self):
+        self.fixed_window = settings.DEBOUNCE_FIXED_SECONDS
+        self.min_window = settings.DEBOUNCE_MIN_SECONDS
+        self.max_window = settings.DEBOUNCE_MAX_SECONDS
+        self.terminal_window = settings.DEBOUNCE_TERMINAL_SECONDS
+        self._chats = LRUCache(maxsize=settings.CHAT_CACHE_SIZE)
+        self._global_gaps: deque = deque(maxlen=settings.DEBOUNCE_GLOBAL_HISTORY)
+        self._latencies: deque = deque(maxlen=settings.DEBOUNCE_GLOBAL_HISTORY)
+        self.flushes = 0
+        self.early_flushes = 0  # Ответили раньше фиксированного окна
+        self.split_replies = 0  # После ответа клиент дописал сообщение, которое фиксированное окно бы дождалось
+
+    def _chat(self, chat_id) -> _ChatGaps:
+        chat = self._chats.get(str(chat_id))
+        if chat is None:
+            chat = _ChatGaps(settings.DEBOUNCE_CHAT_HISTORY)
+            self._chats.set(str(chat_id), chat)
+        return chat
+
+    def record_message(self, chat_id) -> None:
+        """Учитывает интервал с предыдущим сообщением чата (в пределах одной серии сообщений)"""
+        now = time.monotonic()
+        chat = self._chat(chat_id)
+        # Пауза считается только между фрагментами одной серии, а не до ответа бота и после него
+        in_series = chat.last_flush_at is None or (chat.last_message_at or 0) > chat.last_flush_at
+        if chat.last_message_at is not None and in_series:
+            gap = now - chat.last_message_at
+            if gap <= self.max_window:
+                chat.gaps.append(gap)
+                self._global_gaps.append(gap)
+        if chat.last_message_at is None or not in_series:
+            chat.series_started_at = now
+        if chat.last_flush_at is not None and now - chat.last_flush_at < self.fixed_window:
+            self.split_replies += 1
+        chat.last_message_at = now
+
+    @staticmethod
+    def is_terminal(message_text: Optional[str]) -> bool:
+        if not message_text:
+            return False
+        text = message_text.strip()
+        return text.endswith(TERMINAL_PUNCTUATION) or bool(COMPLETE_INTENT_PATTERNS.search(text))
+
+    def _learned_window(self, chat: _ChatGaps) -> float:
+        gaps = chat.gaps if len(chat.gaps) >= settings.DEBOUNCE_MIN_SAMPLES else self._global_gaps
+        if len(gaps) < max(settings.DEBOUNCE_MIN_SAMPLES, 2):
+            return self.fixed_window
+        # Ждем чуть дольше, чем клиент обычно делает паузу между фрагментами
+        window = statistics.quantiles(gaps, n=10)[-1] * settings.DEBOUNCE_GAP_MARGIN
+        return min(max(window, self.min_window), self.max_window)
+
+    def delay(self, chat_id, message_text: Optional[str]) -> float:
+        """Сколько ждать следующих сообщений перед ответом"""
+        chat = self._chat(chat_id)
+        if not settings.DEBOUNCE_ADAPTIVE:
+            window = self.fixed_window
+        else:
+            window = self._learned_window(chat)
+            if self.is_terminal(message_text):
+                window = min(window, self.terminal_window)
+        # Клиент, который пишет без остановки, не откладывает ответ дольше DEBOUNCE_MAX_SECONDS от начала серии
+        elapsed = time.monotonic() - chat.series_started_at if chat.series_started_at is not None else 0.0
+        return max(min(window, self.max_window - elapsed), 0.0)
+
+    def record_flush(self, chat_id, waited: float) -> None:
+        """Фиксирует сброс очереди: waited — сколько ждали после последнего сообщения"""
+        self._chat(chat_id).last_flush_at = time.monotonic()
+        self._latencies.append(waited)
+        self.flushes += 1
+        if waited < self.fixed_window:
+            self.early_flushes += 1
+
+    def stats(self) -> dict:
+        return {
+            "adaptive": settings.DEBOUNCE_ADAPTIVE,
+            "flushes": self.flushes,
+            "early_flushes": self.early_flushes,
+            "split_replies": self.split_replies,
+            "median_wait_seconds": round(statistics.median(self._latencies), 2) if self._latencies else None,
+            "fixed_window_seconds": self.fixed_window,
+            "global_gap_samples": len(self._global_gaps)
+        }
+
+
+# Создаем глобальный экземпляр
+debounce_policy = DebouncePolicy()
@@ -0,0 +1,294 @@
+import asyncio
+import uuid
+from typing import Optional
+
+from aiogram.exceptions import TelegramRetryAfter
+
+from app.config import settings
+from app.redis_db import get_shared_redis, is_redis_configured
+from app.services.logs import logger
+from app.services.rate_limiter import TokenBucket
+from app.services.telegram_notifier import create_telegram_forum_topic, send_alert
+from db.chat_crud import fill_chat_thread, get_chat_by_id, get_chats_without_thread
+
+TOPIC_LOCK_TTL = 300
+TOPIC_RETRY_DELAY = 30  # Пауза перед повтором, пока топик чата создает другой воркер
+PENDING_TTL = 86400
+FAILURES_TTL = 7 * 86400
+
+# Уведомление откладывается, только пока топик чата еще создается (проверка и запись атомарны)
+DEFER_ALERT_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('RPUSH', KEYS[2], ARGV[1])
+    redis.call('EXPIRE', KEYS[2], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+# Блокировку снимает только воркер, который ее взял
+RELEASE_CLAIM_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class ForumTopicWorker:
+    """
+    Фоновое создание топиков Telegram для новых чатов.
+    Чат сохраняется в БД без thread_id, топик создается отдельно (с лимитом и повторами),
+    после чего thread_id проставляется в чат, а отложенные уведомления досылаются в топик.
+    Название топика и отложенные уведомления хранятся в Redis (forum_topic:pending:<chat_id>,
+    forum_topic:alerts:<chat_id>), поэтому их видят все воркеры и они переживают перезапуск.
+    Если топик не удалось создать, чат повторяется при следующих перезапусках, пока число неудач
+    в Redis (forum_topic:failures:<chat_id>) не достигнет FORUM_TOPIC_MAX_FAILURES.
+    """
+
+    def __init__(self):
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._deferred: dict[str, list[str]] = {}  # chat_id -> уведомления, ждущие топик
+        self._bucket = TokenBucket(settings.FORUM_TOPIC_RATE_PER_MIN)
+        self._task: Optional[asyncio.Task] = None
+        self._retries: set[asyncio.Task] = set()
+        self.worker_id = uuid.uuid4().hex
+        self.created = 0
+        self.failed = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    @staticmethod
+    def _pending_key(chat_id) -> str:
+        return f"forum_topic:pending:{chat_id}"
+
+    @staticmethod
+    def _alerts_key(chat_id) -> str:
+        return f"forum_topic:alerts:{chat_id}"
+
+    @staticmethod
+    def _claim_key(chat_id) -> str:
+        return f"forum_topic:{chat_id}"
+
+    @staticmethod
+    def _failures_key(chat_id) -> str:
+        return f"forum_topic:failures:{chat_id}"
+
+    async def request(self, chat_id, topic_name: str, alert: Optional[str] = None) -> None:
+        """Ставит создание топика в очередь; alert будет отправлен в топик после его создания"""
+        key = str(chat_id)
+        if is_redis_configured():
+            try:
+                async with get_shared_redis().pipeline(transaction=True) as pipe:
+                    pipe.set(self._pending_key(key), topic_name, ex=PENDING_TTL)
+                    if alert:
+                        pipe.rpush(self._alerts_key(key), alert)
+                        pipe.expire(self._alerts_key(key), PENDING_TTL)
+                    await pipe.execute()
+                alert = None
+            except Exception as e:
+                logger.warning(f"[ForumTopics] Redis недоступен, уведомления чата {key} ждут топик в памяти: {e}")
+        self._enqueue(key, topic_name)
+        if alert:
+            self._deferred[key].append(alert)
+
+    def _enqueue(self, chat_id: str, topic_name: str) -> None:
+        if chat_id not in self._deferred:
+            self._deferred[chat_id] = []
+            self._queue.put_nowait((chat_id, topic_name))
+
+    async def defer_alert(self, chat_id, message: str) -> bool:
+        """Откладывает уведомление, если топик чата еще создается (в этом или другом воркере)"""
+        key = str(chat_id)
+        if is_redis_configured():
+            try:
+                if await get_shared_redis().eval(DEFER_ALERT_SCRIPT, 2, self._pending_key(key), self._alerts_key(key),
+                                                 message, PENDING_TTL):
+                    return True
+            except Exception as e:
+                logger.warning(f"[ForumTopics] Не удалось отложить уведомление чата {key} в Redis: {e}")
+        alerts = self._deferred.get(key)
+        if alerts is None:
+            return False
+        alerts.append(message)
+        return True
+
+    async def _topic_name(self, chat_id: str) -> str:
+        """Название, сохраненное при постановке в очередь, — иначе имя клиента потеряется при перезапуске"""
+        if is_redis_configured():
+            try:
+                topic_name = await get_shared_redis().get(self._pending_key(chat_id))
+                if topic_name:
+                    return topic_name
+            except Exception as e:
+                logger.warning(f"[ForumTopics] Не удалось получить название топика чата {chat_id}: {e}")
+        return f"Чат {chat_id}"
+
+    async def _take_alerts(self, chat_id: str) -> list[str]:
+        """Забирает отложенные уведомления и снимает отметку: новые уведомления пойдут сразу в топик"""
+        alerts = self._deferred.pop(chat_id, [])
+        if not is_redis_configured():
+            return alerts
+        try:
+            async with get_shared_redis().pipeline(transaction=True) as pipe:
+                pipe.delete(self._pending_key(chat_id))
+                pipe.lrange(self._alerts_key(chat_id), 0, -1)
+                pipe.delete(self._alerts_key(chat_id))
+                _, shared, _ = await pipe.execute()
+        except Exception as e:
+            logger.error(f"[ForumTopics] Не удалось забрать отложенные уведомления чата {chat_id} из Redis: {e}")
+            return alerts
+        return shared + alerts
+
+    async def start(self) -> None:
+        if self.running:
+            return
+        # Чаты, топик для которых не успели создать до перезапуска
+        try:
+            for chat in await get_chats_without_thread():
+                chat_id = str(chat.chat_id)
+                if await self._gave_up(chat_id):
+                    continue
+                self._enqueue(chat_id, await self._topic_name(chat_id))
+        except Exception as e:
+            logger.error(f"[ForumTopics] Не удалось получить чаты без топика: {e}")
+        if self._deferred:
+            logger.info(f"[ForumTopics] Восстановлено {len(self._deferred)} чатов без топика")
+        self._task = asyncio.create_task(self._run())
+        logger.info("[ForumTopics] Обработчик создания топиков запущен")
+
+    async def stop(self) -> None:
+        for task in list(self._retries):
+            task.cancel()
+        if self.running:
+            self._task.cancel()
+
+    async def _run(self) -> None:
+        while True:
+            chat_id, topic_name = await self._queue.get()
+            try:
+                await self._process(chat_id, topic_name)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"[ForumTopics] ❌ Ошибка обработки чата {chat_id}: {e}")
+
+    async def _claim(self, chat_id: str) -> bool:
+        """Несколько воркеров могут восстановить один и тот же чат — топик создает только один"""
+        if not is_redis_configured():
+            return True
+        try:
+            return bool(await get_shared_redis().set(self._claim_key(chat_id), self.worker_id, nx=True,
+                                                     ex=TOPIC_LOCK_TTL))
+        except Exception as e:
+            logger.warning(f"[ForumTopics] Redis недоступен, создаем топик без блокировки: {e}")
+            return True
+
+    async def _release(self, chat_id: str) -> None:
+        if not is_redis_configured():
+            return
+        try:
+            await get_shared_redis().eval(RELEASE_CLAIM_SCRIPT, 1, self._claim_key(chat_id), self.worker_id)
+        except Exception as e:
+            logger.warning(f"[ForumTopics] Не удалось снять блокировку топика чата {chat_id}: {e}")
+
+    def _retry_later(self, chat_id: str, topic_name: str) -> None:
+        task = asyncio.create_task(self._requeue(chat_id, topic_name))
+        self._retries.add(task)
+        task.add_done_callback(self._retries.discard)
+
+    async def _requeue(self, chat_id: str, topic_name: str) -> None:
+        await asyncio.sleep(TOPIC_RETRY_DELAY)
+        self._queue.put_nowait((chat_id, topic_name))
+
+    async def _record_failure(self, chat_id: str) -> None:
+        if not is_redis_configured():
+            return
+        try:
+            async with get_shared_redis().pipeline(transaction=True) as pipe:
+                pipe.incr(self._failures_key(chat_id))
+                pipe.expire(self._failures_key(chat_id), FAILURES_TTL)
+                await pipe.execute()
+        except Exception as e:
+            logger.warning(f"[ForumTopics] Не удалось записать неудачу создания топика чата {chat_id}: {e}")
+
+    async def _gave_up(self, chat_id: str) -> bool:
+        """Топик чата не создался FORUM_TOPIC_MAX_FAILURES раз — при перезапуске больше не пробуем"""
+        if not is_redis_configured():
+            return False
+        try:
+            failures = await get_shared_redis().get(self._failures_key(chat_id))
+        except Exception as e:
+            logger.warning(f"[ForumTopics] Не удалось получить число неудач топика чата {chat_id}: {e}")
+            return False
+        return int(failures or 0) >= settings.FORUM_TOPIC_MAX_FAILURES
+
+    async def _create(self, topic_name: str) -> Optional[int]:
+        for attempt in range(1, settings.FORUM_TOPIC_MAX_ATTEMPTS + 1):
+            await self._bucket.acquire()
+            try:
+                return await create_telegram_forum_topic(topic_name)
+            except TelegramRetryAfter as e:
+                logger.warning(f"[ForumTopics] Лимит Telegram, повтор через {e.retry_after}с")
+                self._bucket.pause(e.retry_after)
+            except Exception as e:
+                logger.warning(f"[ForumTopics] Не удалось создать топик '{topic_name}' (попытка {attempt}): {e}")
+                await asyncio.sleep(2 ** attempt)
+        return None
+
+    async def _process(self, chat_id: str, topic_name: str) -> None:
+        if not await self._claim(chat_id):
+            logger.info(f"[ForumTopics] Топик для чата {chat_id} создает другой процесс, "
+                        f"проверим через {TOPIC_RETRY_DELAY}с")
+            # Уведомления, оставшиеся в памяти, передаем ему через Redis
+            for alert in self._deferred.pop(chat_id, []):
+                if not await self.defer_alert(chat_id, alert):
+                    chat = await get_chat_by_id(chat_id)
+                    await self._send(alert, chat.thread_id if chat else None)
+            # Владелец блокировки мог упасть, не создав топик: тогда чат заберем после истечения блокировки
+            self._retry_later(chat_id, topic_name)
+            return
+        try:
+            await self._create_topic(chat_id, topic_name)
+        finally:
+            await self._release(chat_id)
+
+    async def _create_topic(self, chat_id: str, topic_name: str) -> None:
+        # Топик мог создать другой процесс, пока этот ждал блокировку
+        chat = await get_chat_by_id(chat_id)
+        thread_id = chat.thread_id if chat else None
+        if thread_id is None:
+            thread_id = await self._create(topic_name)
+            if thread_id is None:
+                self.failed += 1
+                await self._record_failure(chat_id)
+                logger.error(f"[ForumTopics] ❌ Топик для чата {chat_id} не создан, уведомления уйдут в общий чат")
+            else:
+                await fill_chat_thread(chat_id, thread_id)
+                self.created += 1
+                logger.info(f"[ForumTopics] ✅ Чату {chat_id} назначен топик {thread_id}")
+        # Забираем отложенные уведомления только после записи thread_id: новые уже найдут его в БД.
+        # Отметка forum_topic:pending снимается и при неудаче, иначе уведомления копились бы в Redis
+        for alert in await self._take_alerts(chat_id):
+            await self._send(alert, thread_id)
+
+    @staticmethod
+    async def _send(alert: str, thread_id: Optional[int]) -> None:
+        try:
+            await send_alert(alert, thread_id)
+        except Exception as e:
+            logger.error(f"[ForumTopics] ❌ Ошибка отправки отложенного уведомления: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "pending": len(self._deferred),
+            "created": self.created,
+            "failed": self.failed
+        }
+
+
+# Создаем глобальный экземпляр
+forum_topic_worker = ForumTopicWorker()
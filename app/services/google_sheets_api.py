@@ -1,13 +1,30 @@
 import httpx, asyncio
+import hashlib
 import json
 import re
+import time
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional
 from app.services.logs import logger
-from app.config import RANGE, SPREADSHEET_ID, API_KEY
+from app.services.catalog_snapshot import CatalogSnapshot
+from app.models.product import Product, StockItem
+from app.services.knowledge_index import knowledge_index
+from app.config import settings, RANGE, SPREADSHEET_ID, API_KEY, SIZE_MAPPING
 
 
 # 🔥 Нормализатор размеров
+CYRILLIC_TO_LATIN = str.maketrans({"с": "s", "х": "x", "л": "l", "м": "m"})
+NUMBER_PATTERN = re.compile(r"\d+")
+
+
 class SizeNormalizer:
-    def __init__(self):
+    """
+    Приводит заголовки колонок размеров к единому виду.
+    Все известные варианты написания заранее сведены в один словарь, результаты кэшируются (LRU).
+    """
+
+    def __init__(self, extra_mapping: Optional[dict] = None, cache_size: int = 4096):
         self.numeric_to_letter = {
             "42": "XS", "44": "S", "46": "S", "48": "M",
             "50": "L", "52": "XL", "54": "XXL", "56": "XXXL",
@@ -25,38 +42,51 @@ class SizeNormalizer:
             "XXXXXL": ["xxxxxl", "5xl", "5хл", "хххххл"]
         }
 
-    async def normalize(self, size_str: str) -> str:
+        # Вариант написания (после приведения кириллицы к латинице) -> размер
+        self.lookup = {}
+        for letter, variants in self.letter_variants.items():
+            for variant in (*variants, letter):
+                self.lookup.setdefault(self._fold(variant), letter)
+        # Дополнительные таблицы (обувь, детские размеры) имеют приоритет над встроенной
+        for variant, size in (extra_mapping or {}).items():
+            self.lookup[self._fold(variant)] = size
+        self.sizes = set(self.lookup.values()) | set(self.numeric_to_letter.values())
+
+        self.normalize = lru_cache(maxsize=cache_size)(self._normalize)
+
+    @staticmethod
+    def _fold(size_str) -> str:
+        return str(size_str).strip().lower().translate(CYRILLIC_TO_LATIN)
+
+    def _normalize(self, size_str: str) -> str:
         if not size_str:
             return ""
-        s = str(size_str).strip().lower()
+        s = self._fold(size_str)
 
-        # заменяем кириллицу на латиницу
-        replacements = {"с": "s", "х": "x", "л": "l", "м": "m"}
-        for old, new in replacements.items():
-            s = s.replace(old, new)
-
-        # буквенные размеры
-        for letter, variants in self.letter_variants.items():
-            if s in variants or s == letter.lower():
-                return letter
+        # буквенные размеры и дополнительные таблицы
+        size = self.lookup.get(s)
+        if size is not None:
+            return size
 
         # числовые размеры
-        numbers = re.findall(r"\d+", s)
-        if numbers:
-            num = numbers[0]
-            if num in self.numeric_to_letter:
-                return self.numeric_to_letter[num]
+        number = NUMBER_PATTERN.search(s)
+        if number and number.group() in self.numeric_to_letter:
+            return self.numeric_to_letter[number.group()]
 
         # EU/IT форматы
         if s.startswith(("eu", "it")):
-            digits = re.sub(r"\D", "", s)
+            digits = "".join(NUMBER_PATTERN.findall(s))
             if digits in self.numeric_to_letter:
                 return self.numeric_to_letter[digits]
 
         return str(size_str).upper()
 
+    def is_size(self, normalized: str) -> bool:
+        """Похоже ли нормализованное значение на размер"""
+        return normalized in self.sizes or bool(NUMBER_PATTERN.search(normalized))
 
-size_normalizer = SizeNormalizer()
+
+size_normalizer = SizeNormalizer(SIZE_MAPPING, settings.SIZE_NORMALIZER_CACHE_SIZE)
 
 
 # --- функции парсера ---
@@ -73,14 +103,30 @@ async def extract_ad_id_from_url(ad_url: str):
     return None
 
 
-async def parse_ids_from_cell(cell_value):
+KNOWLEDGE_SHEET_NAME = "knowledge_base"
+HEADER_MARKERS = {"id", "ид", "артикул", "код"}
+IDS_SPLIT_PATTERN = re.compile(r'[,\s]+')
+IN_STOCK = "Есть в наличии"
+OUT_OF_STOCK = "Нет в наличии"
+PHOTO_PATTERN = re.compile(r'(фото|photo|image|pic)', re.IGNORECASE)
+PHOTO_ID_PATTERN = re.compile(r'(?:фото|photo|image|pic)[ _-]*id|id[ _-]*(?:фото|photo|image|pic)', re.IGNORECASE)
+
+
+def parse_ids_from_cell(cell_value):
     if not cell_value:
         return []
     cell_value = str(cell_value).strip()
-    ids = re.split(r'[,\s]+', cell_value)
+    ids = IDS_SPLIT_PATTERN.split(cell_value)
     return [id_str.strip() for id_str in ids if id_str.strip().isdigit()]
 
 
+def _is_header_row(row) -> bool:
+    if not row:
+        return False
+    first_cell = (row[0].strip().lower() if isinstance(row[0], str) else "")
+    return first_cell in HEADER_MARKERS
+
+
 async def get_all_sheet_names():
     logger.info(f"[Parser] Получаем список листов с гугл таблицы")
     url = f"https://sheets.googleapis.com/v4/spreadsheets/{SPREADSHEET_ID}?key={API_KEY}"
@@ -117,18 +163,15 @@ async def get_all_sheet_names():
                     return []
 
 
-async def search_product_in_sheet(ad_id: str, sheet_name: str, max_retries: int = 3, retry_delay: int = 3):
+async def fetch_sheet_rows(sheet_name: str, max_retries: int = 3, retry_delay: int = 3):
     """
-    Ищем строку с нужным ID на листе. Возвращаем весь массив rows и индекс найденной строки.
-    Локальные заголовки будут определяться позже (поднимаясь вверх до ближайшей «шапки»).
+    Загружаем все строки листа.
 
     Args:
-        ad_id: ID товара для поиска
         sheet_name: Название листа
         max_retries: Максимальное количество попыток (по умолчанию 3)
         retry_delay: Задержка между попытками в секундах (по умолчанию 3)
     """
-    logger.info(f"[Parser] Поиск товара с ID {ad_id} в листе: {sheet_name}")
     url = f"https://sheets.googleapis.com/v4/spreadsheets/{SPREADSHEET_ID}/values/{sheet_name}!{RANGE}?majorDimension=ROWS&key={API_KEY}"
 
     for attempt in range(1, max_retries + 1):
@@ -141,43 +184,11 @@ async def search_product_in_sheet(ad_id: str, sheet_name: str, max_retries: int
                 if "values" not in data or not data["values"]:
                     return None
 
-                rows = data["values"]
-
-                # Находим первую «шапку» листа (не обязательно понадобится)
-                headers_row_index = None
-                for i, row in enumerate(rows):
-                    if row and isinstance(row[0], str) and row[0].strip().lower() in ["id", "ид", "артикул", "код"]:
-                        headers_row_index = i
-                        break
-
-                start_idx = headers_row_index + 1 if headers_row_index is not None else 0
-                found_row_index = None
-
-                for i in range(start_idx, len(rows)):
-                    row = rows[i]
-                    if not row:
-                        continue
-                    first_cell = row[0] if len(row) > 0 else ""
-                    ids_in_cell = await parse_ids_from_cell(first_cell)
-                    if ad_id in ids_in_cell:
-                        found_row_index = i
-                        break
-
-                if found_row_index is None:
-                    logger.info(f"[Parser] Товар с ID {ad_id} в листе {sheet_name} НЕ НАЙДЕН")
-                    return None
-
-                # Успешно нашли данные - возвращаем результат
-                logger.info(f"[Parser] Товар с ID {ad_id} найден в листе {sheet_name} на строке {found_row_index}")
-                return {
-                    'sheet_name': sheet_name,
-                    'found_row_index': found_row_index,
-                    'rows': rows
-                }
+                return data["values"]
 
             except httpx.HTTPStatusError as e:
                 # Специфичная обработка HTTP ошибок
-                logger.error(f"[Parser] HTTP ошибка при поиске в листе {sheet_name} (попытка {attempt}/{max_retries}): "
+                logger.error(f"[Parser] HTTP ошибка при загрузке листа {sheet_name} (попытка {attempt}/{max_retries}): "
                              f"Статус {e.response.status_code}, "
                              f"Ответ: {e.response.text}")
 
@@ -193,7 +204,7 @@ async def search_product_in_sheet(ad_id: str, sheet_name: str, max_retries: int
             except httpx.RequestError as e:
                 # Ошибки соединения, таймауты и т.д.
                 logger.error(
-                    f"[Parser] Ошибка запроса при поиске в листе {sheet_name} (попытка {attempt}/{max_retries}): "
+                    f"[Parser] Ошибка запроса при загрузке листа {sheet_name} (попытка {attempt}/{max_retries}): "
                     f"{type(e).__name__}: {str(e)}")
 
                 if attempt == max_retries:
@@ -220,7 +231,7 @@ async def search_product_in_sheet(ad_id: str, sheet_name: str, max_retries: int
             except Exception as e:
                 # Все остальные ошибки с полным стеком вызовов
                 logger.error(
-                    f"[Parser] Неожиданная ошибка при поиске в листе {sheet_name} (попытка {attempt}/{max_retries}): "
+                    f"[Parser] Неожиданная ошибка при загрузке листа {sheet_name} (попытка {attempt}/{max_retries}): "
                     f"{type(e).__name__}: {str(e)}")
 
                 if attempt == max_retries:
@@ -233,222 +244,549 @@ async def search_product_in_sheet(ad_id: str, sheet_name: str, max_retries: int
     # Этот код не должен выполняться, но на всякий случай
     return None
 
-async def fetch_google_sheet_stock(ad_url: str):
-    ad_id = await extract_ad_id_from_url(ad_url)
-    if not ad_id:
-        return None
-    sheet_names = await get_all_sheet_names()
-    for sheet_name in sheet_names:
-        if sheet_name.lower() == 'knowledge_base':
-            continue
-        result = await search_product_in_sheet(ad_id, sheet_name)
-        if result:
-            return await parse_product_from_sheet_data(result, ad_id)
-    return None
-
-
-async def _find_local_header_index(rows, start_from_index: int):
-    header_markers = {"id", "ид", "артикул", "код"}
-    i = start_from_index
-    while i >= 0:
-        row = rows[i] if i < len(rows) else []
-        first_cell = (row[0].strip().lower() if row and isinstance(row[0], str) else "")
-        if first_cell in header_markers:
-            return i
-        i -= 1
-    return None
 
-
-async def _is_new_header_row(row) -> bool:
-    if not row:
-        return False
-    first_cell = (row[0].strip().lower() if isinstance(row[0], str) else "")
-    return first_cell in {"id", "ид", "артикул", "код"}
-
-
-async def parse_product_from_sheet_data(sheet_data, ad_id: str):
+async def search_product_in_sheet(ad_id: str, sheet_name: str, max_retries: int = 3, retry_delay: int = 3):
     """
-    Для найденной строки:
-      1) поднимаемся вверх до ближайшей строки-шапки (id/ид/артикул/код),
-      2) используем её как локальные заголовки,
-      3) собираем строки блока до следующей шапки/пустой строки/строки другого товара,
-      4) парсим с локальными заголовками.
+    Ищем товар с нужным ID на листе. Лист разбирается целиком за один проход в отдельном потоке.
+    Возвращаем товар или None.
     """
-    logger.info("[Parser] Парсим найденный товар с листа")
-    try:
-        sheet_name = sheet_data['sheet_name']
-        rows = sheet_data['rows']
-        found_row_index = sheet_data['found_row_index']
-
-        # 1) Локальная шапка
-        header_row_index = await _find_local_header_index(rows, found_row_index - 1)
-        if header_row_index is None:
-            return None
-
-        local_headers = rows[header_row_index]
-
-        # 2) Собираем блок строк
-        product_rows = []
-        logger.info("[Parser] Парсим идентификаторы объявлений из ячейки")
-        found_ids = await parse_ids_from_cell(rows[found_row_index][0]) if rows[found_row_index] else []
-        current_index = found_row_index
-
-        while current_index < len(rows):
-            row = rows[current_index]
-            if not row:
-                break
-
-            if await _is_new_header_row(row) and current_index != found_row_index:
-                break
+    logger.info(f"[Parser] Поиск товара с ID {ad_id} в листе: {sheet_name}")
+    rows = await fetch_sheet_rows(sheet_name, max_retries, retry_delay)
+    if not rows:
+        return None
 
-            if current_index > found_row_index and len(row) > 0 and row[0]:
-                logger.info("[Parser] Парсим идентификаторы объявлений из ячейки")
-                current_ids = await parse_ids_from_cell(row[0])
-                if current_ids and not any(_id in found_ids for _id in current_ids):
-                    break
+    products = await asyncio.to_thread(parse_sheet, rows, sheet_name)
+    product = products.get(ad_id)
+    if product is None:
+        logger.info(f"[Parser] Товар с ID {ad_id} в листе {sheet_name} НЕ НАЙДЕН")
+        return None
 
-            if len(row) > 3:
-                product_rows.append(row)
+    logger.info(f"[Parser] Товар с ID {ad_id} найден в листе {sheet_name}")
+    return product
 
-            current_index += 1
 
-        if not product_rows:
+async def fetch_google_sheet_stock(ad_url: str) -> Optional[Product]:
+    ad_id = await extract_ad_id_from_url(ad_url)
+    if not ad_id:
+        return None
+    if settings.CATALOG_ENABLED:
+        result = await product_catalog.lookup(ad_id)
+        if not result:
             return None
+        logger.info(f"[Parser] Товар с ID {ad_id} из каталога, возраст данных {result.age_seconds:.0f}с")
+        return result.product
+    sheet_names = await get_all_sheet_names()
+    for sheet_name in sheet_names:
+        if sheet_name.lower() == KNOWLEDGE_SHEET_NAME:
+            continue
+        product = await search_product_in_sheet(ad_id, sheet_name)
+        if product:
+            return product
+    return None
 
-        return await parse_stock_with_all_info(local_headers, product_rows, ad_id, sheet_name)
 
-    except Exception as e:
-        logger.error(f"[Parser] Ошибка при парсинге данных из листа: {e}")
-        return None
+class _BlockColumns:
+    """Роли колонок блока товаров, определяются один раз по строке-шапке"""
 
+    __slots__ = ("width", "name", "price", "color", "description", "size_info", "size_indexes", "size_names",
+                 "photo")
 
-async def parse_stock_with_all_info(headers, product_rows, ad_id: str, category: str):
-    try:
-        async def safe_get(lst, index, default=''):
-            try:
-                value = lst[index] if index < len(lst) else default
-                if value is None:
-                    return default
-                return value.strip() if isinstance(value, str) else value
-            except (IndexError, TypeError):
-                return default
-
+    def __init__(self, headers):
         header_lower = [(h.lower().strip() if isinstance(h, str) else "") for h in headers]
+        self.width = len(headers)
+        self.name = 1 if len(headers) > 1 else None
+        self.price = 2 if len(headers) > 2 else None
 
-        name_col = 1 if len(headers) > 1 else None
-        price_col = 2 if len(headers) > 2 else None
-
-        color_col = None
+        self.color = None
         for i, h in enumerate(header_lower):
             if h and ("цвет" in h or "color" in h):
-                color_col = i
+                self.color = i
                 break
-        if color_col is None:
-            color_col = 3 if len(headers) > 3 else None
+        if self.color is None:
+            self.color = 3 if len(headers) > 3 else None
 
-        description_col = None
-        size_info_col = None
+        self.description = None
+        self.size_info = None
         for i, h in enumerate(header_lower):
             if not h:
                 continue
-            if description_col is None and ("описание" in h or "description" in h):
-                description_col = i
-            elif size_info_col is None and ("размер" in h and "описан" not in h):
-                size_info_col = i
+            if self.description is None and ("описание" in h or "description" in h):
+                self.description = i
+            elif self.size_info is None and ("размер" in h and "описан" not in h):
+                self.size_info = i
 
-        base_idx = (color_col + 1) if color_col is not None else ((price_col + 1) if price_col is not None else 4)
+        base_idx = (self.color + 1) if self.color is not None else ((self.price + 1) if self.price is not None else 4)
 
-        size_columns = {}
+        # Колонки размеров: индексы и нормализованные названия
+        self.size_indexes = []
+        self.size_names = []
         for i in range(base_idx, len(headers)):
-            header_text = headers[i].strip() if i < len(headers) and isinstance(headers[i], str) else ""
+            header_text = headers[i].strip() if isinstance(headers[i], str) else ""
             if not header_text:
                 continue
-            normalized = await size_normalizer.normalize(header_text)
-            if normalized in ['XS', 'S', 'M', 'L', 'XL', 'XXL', 'XXXL', 'XXXXL', 'XXXXXL'] or re.search(r'\d+', normalized):
-                size_columns[i] = normalized
-
-        # Photo column
-        photo_col = None
-        photo_pattern = re.compile(r'(фото|photo|image|pic)', re.IGNORECASE)
-        photo_id_pattern = re.compile(r'(?:фото|photo|image|pic)[ _-]*id|id[ _-]*(?:фото|photo|image|pic)', re.IGNORECASE)
+            normalized = size_normalizer.normalize(header_text)
+            if size_normalizer.is_size(normalized):
+                self.size_indexes.append(i)
+                self.size_names.append(normalized)
+
+        self.photo = None
         for i in range(base_idx, len(headers)):
             h = header_lower[i]
             if not h or h == "id":
                 continue
-            if photo_pattern.search(h) or photo_id_pattern.search(h):
-                photo_col = i
+            if PHOTO_PATTERN.search(h) or PHOTO_ID_PATTERN.search(h):
+                self.photo = i
                 break
-        if photo_col is None and size_columns:
-            last_size_idx = max(size_columns.keys())
-            candidate = last_size_idx + 1
+        if self.photo is None and self.size_indexes:
+            candidate = max(self.size_indexes) + 1
             if candidate < len(headers):
                 cand_header = header_lower[candidate]
                 if "описание" in cand_header or "description" in cand_header:
                     if candidate + 1 < len(headers):
                         candidate += 1
-                photo_col = candidate
-
-        first_row = product_rows[0]
-        product = {
-            'id': ad_id,   # 👈 теперь только цифры!
-            'category': category,
-            'name': await safe_get(first_row, name_col) if name_col is not None else '',
-            'price': await safe_get(first_row, price_col, '') if price_col is not None else '',
-            'description': await safe_get(first_row, description_col) if description_col is not None else '',
-            'size_info': await safe_get(first_row, size_info_col) if size_info_col is not None else '',
-            'payment_method': '',
-            'delivery_method': '',
-            'photo_ids': '',
-            'stock': []
+                self.photo = candidate
+
+
+def _cell(row, index, default=''):
+    if index is None or index >= len(row):
+        return default
+    value = row[index]
+    if value is None:
+        return default
+    return value.strip() if isinstance(value, str) else value
+
+
+def _block_end(rows, start: int, found_ids) -> int:
+    """Конец блока товара: пустая строка, новая шапка или строка другого товара"""
+    index = start + 1
+    while index < len(rows):
+        row = rows[index]
+        if not row or _is_header_row(row):
+            break
+        if row[0]:
+            current_ids = parse_ids_from_cell(row[0])
+            if current_ids and not any(_id in found_ids for _id in current_ids):
+                break
+        index += 1
+    return index
+
+
+def _build_product(columns: _BlockColumns, product_rows, category: str) -> Product:
+    """Товар блока без id; копии с id и готовым prompt создает parse_sheet"""
+    first_row = product_rows[0]
+    photo_ids = ''
+    if columns.photo is not None:
+        photos = (str(_cell(row, columns.photo)).strip() for row in product_rows)
+        photo_ids = ", ".join(dict.fromkeys(photo for photo in photos if photo))
+
+    stock = []
+
+    for row in product_rows:
+        color_val = _cell(row, columns.color)
+        if not color_val:
+            continue
+        # Дополняем короткую строку до ширины шапки, чтобы брать ячейки размеров напрямую по индексам
+        if len(row) < columns.width:
+            row = row + [''] * (columns.width - len(row))
+        quantities = [str(row[i]).strip() if row[i] is not None else '' for i in columns.size_indexes]
+        # Несколько колонок могут нормализоваться в один размер — учитывается последняя
+        sizes = {name: IN_STOCK if q.isdigit() and int(q) > 0 else OUT_OF_STOCK
+                 for name, q in zip(columns.size_names, quantities)}
+        stock.append(StockItem(color=color_val, sizes=sizes, has_available_sizes=IN_STOCK in sizes.values()))
+
+    return Product(
+        id='',
+        category=category,
+        name=_cell(first_row, columns.name),
+        price=_cell(first_row, columns.price),
+        description=_cell(first_row, columns.description),
+        size_info=_cell(first_row, columns.size_info),
+        payment_method='',
+        delivery_method='',
+        photo_ids=photo_ids,
+        stock=stock,
+        has_stock=any(item.has_available_sizes for item in stock),
+        available_colors=[item.color for item in stock if item.has_available_sizes]
+    )
+
+
+def parse_sheet(rows, category: str) -> dict:
+    """
+    Разбирает лист за один проход: строки-шапки (id/ид/артикул/код) делят лист на блоки,
+    внутри блока строка с ID начинает товар, который продолжается до пустой строки,
+    следующей шапки или строки другого товара. Роли колонок определяются один раз на блок.
+    Синхронная функция — вызывается через asyncio.to_thread.
+
+    Returns:
+        {ad_id: товар}; у всех ID из ячейки общие данные, prompt рендерится один раз на блок
+    """
+    products = {}
+    headers = None
+    columns = None
+
+    for index, row in enumerate(rows):
+        if not row:
+            continue
+        if _is_header_row(row):
+            headers, columns = row, None
+            continue
+        if headers is None or not row[0]:
+            continue
+
+        ids = parse_ids_from_cell(row[0])
+        new_ids = [_id for _id in ids if _id not in products]
+        if not new_ids:
+            continue
+
+        if columns is None:
+            columns = _BlockColumns(headers)
+        end = _block_end(rows, index, set(ids))
+        product_rows = [r for r in rows[index:end] if len(r) > 3]
+
+        product = body = None
+        if product_rows:
+            try:
+                product = _build_product(columns, product_rows, category)
+                body = product.render_body()
+            except Exception as e:
+                logger.error(f"[Parser] Ошибка при парсинге строки {index} листа {category}: {e}")
+        for _id in new_ids:
+            products[_id] = product.with_id(_id, body) if body is not None else None
+
+    return {_id: product for _id, product in products.items() if product is not None}
+
+
+@dataclass
+class CatalogLookup:
+    """Товар из каталога и возраст данных (сколько секунд назад сверены с Google)"""
+    product: Product
+    age_seconds: float
+
+
+class _SheetState:
+    """Разобранный лист каталога"""
+
+    __slots__ = ("content_hash", "products")
+
+    def __init__(self, content_hash: str, products: dict):
+        self.content_hash = content_hash
+        self.products = products
+
+
+def _content_hash(values) -> str:
+    return hashlib.blake2b(
+        json.dumps(values, ensure_ascii=False, separators=(",", ":")).encode(), digest_size=16
+    ).hexdigest()
+
+
+def _parse_changed_sheet(values, sheet_name: str, previous_hash: Optional[str]):
+    """Хэш содержимого листа; лист разбирается, только если хэш изменился"""
+    content_hash = _content_hash(values)
+    if content_hash == previous_hash:
+        return content_hash, None
+    return content_hash, parse_sheet(values, sheet_name)
+
+
+class ProductCatalog:
+    """
+    Каталог товаров в памяти: индекс ad_id -> товар по всем листам таблицы.
+    Обновление инкрементальное: если Drive сообщает, что таблица не менялась (modifiedTime), листы
+    не скачиваются; иначе все листы загружаются одним batchGet, но заново разбираются только листы
+    с изменившимся хэшем содержимого, и в индексе заменяются только их ID.
+    """
+
+    def __init__(self):
+        self._sheets: dict[str, _SheetState] = {}
+        self._order: list[str] = []  # Порядок листов: при повторе ID берется товар с первого листа
+        self._index: dict[str, Product] = {}
+        self._revision: Optional[str] = None
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._revalidation: Optional[asyncio.Task] = None
+        self._knowledge_hash: Optional[str] = None
+        self._knowledge_checked_at: Optional[float] = None
+        self._knowledge_task: Optional[asyncio.Task] = None
+        self.snapshot = CatalogSnapshot(settings.CATALOG_SNAPSHOT_PATH)
+        self.loaded = False
+        self.confirmed_at: Optional[float] = None  # Когда данные последний раз сверены с Google (time.time)
+        self.last_refresh_at = 0.0
+        self.refreshes = 0
+        self.parsed_sheets = 0
+        self.stale_lookups = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    @property
+    def age(self) -> Optional[float]:
+        """Возраст данных в секундах"""
+        return time.time() - self.confirmed_at if self.confirmed_at is not None else None
+
+    async def start(self) -> None:
+        if self.running:
+            return
+        await self.load_snapshot()
+        self._task = asyncio.create_task(self._run())
+        logger.info("[Catalog] Фоновое обновление каталога запущено")
+
+    async def stop(self) -> None:
+        if self.running:
+            self._task.cancel()
+
+    async def _run(self) -> None:
+        while True:
+            await self.refresh()
+            await asyncio.sleep(settings.CATALOG_REFRESH_INTERVAL)
+
+    async def load_snapshot(self) -> bool:
+        """Поднимает каталог из снимка на диске, пока Google не ответил"""
+        if self.loaded:
+            return True
+        if not settings.CATALOG_SNAPSHOT_ENABLED:
+            return False
+        data = await asyncio.to_thread(self.snapshot.load)
+        if not data:
+            return False
+        for name, content_hash, products in data["sheets"]:
+            self._sheets[name] = _SheetState(content_hash, products)
+        self._order = [name for name, _, _ in data["sheets"]]
+        self._reindex(set().union(*(state.products for state in self._sheets.values())))
+        self._revision = data["revision"]
+        self.confirmed_at = data["confirmed_at"]
+        self.loaded = True
+        logger.info(f"[Catalog] Каталог загружен из снимка: {len(self._index)} товаров, "
+                    f"возраст {self.age:.0f}с")
+        return True
+
+    async def lookup(self, ad_id: str) -> Optional[CatalogLookup]:
+        """
+        Ответ сразу из каталога в памяти (stale-while-revalidate): устаревшие данные отдаются,
+        а обновление запускается в фоне. Только если ID не найден, ждем обновления не дольше
+        CATALOG_MISS_REFRESH_TIMEOUT — новое объявление могло появиться после последней сверки.
+        """
+        age = self.age
+        if age is None or age > settings.CATALOG_REFRESH_INTERVAL:
+            self._revalidate()
+
+        product = self._index.get(ad_id)
+        if product is None and time.monotonic() - self.last_refresh_at > settings.CATALOG_MISS_REFRESH_INTERVAL:
+            try:
+                await asyncio.wait_for(asyncio.shield(self._revalidate()), settings.CATALOG_MISS_REFRESH_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning(f"[Catalog] Обновление каталога не успело для ID {ad_id}, продолжаем в фоне")
+            product = self._index.get(ad_id)
+
+        if product is None:
+            logger.info(f"[Catalog] Товар с ID {ad_id} не найден в каталоге")
+            return None
+
+        age = self.age or 0.0
+        if age > settings.CATALOG_REFRESH_INTERVAL:
+            self.stale_lookups += 1
+            logger.warning(f"[Catalog] Данные о товаре {ad_id} устарели: {age:.0f}с")
+        return CatalogLookup(product, age)
+
+    async def get(self, ad_id: str) -> Optional[Product]:
+        result = await self.lookup(ad_id)
+        return result.product if result else None
+
+    def _revalidate(self) -> asyncio.Task:
+        """Одно фоновое обновление на всех, кто его ждет"""
+        if self._revalidation is None or self._revalidation.done():
+            self._revalidation = asyncio.create_task(self.refresh())
+        return self._revalidation
+
+    async def refresh(self) -> int:
+        """Обновляет каталог; возвращает число заново разобранных листов"""
+        started = time.monotonic()
+        async with self._lock:
+            # Пока ждали блокировку, каталог мог обновить другой запрос
+            if self.last_refresh_at > started:
+                return 0
+            try:
+                return await self._refresh()
+            except Exception as e:
+                logger.error(f"[Catalog] Ошибка обновления каталога: {e}")
+                return 0
+            finally:
+                self.last_refresh_at = time.monotonic()
+
+    async def _refresh(self) -> int:
+        revision = await self._fetch_revision()
+        if revision is not None and revision == self._revision and self.loaded:
+            logger.info("[Catalog] Таблица не менялась, обновление не требуется")
+            # После перезапуска каталог поднят из снимка, а индекса базы знаний в снимке нет
+            if settings.KNOWLEDGE_BASE_ENABLED and self._knowledge_hash is None:
+                await self.refresh_knowledge()
+            await self._confirm(revision, {}, set())
+            return 0
+
+        all_names = await get_all_sheet_names()
+        sheet_names = [name for name in all_names if name.lower() != KNOWLEDGE_SHEET_NAME]
+        if not sheet_names:
+            return 0  # Google недоступен — оставляем текущий каталог
+        # База знаний загружается тем же запросом, индекс перестраивается вместе с каталогом
+        knowledge_sheet = next((name for name in all_names if name.lower() == KNOWLEDGE_SHEET_NAME), None)
+        if not settings.KNOWLEDGE_BASE_ENABLED:
+            knowledge_sheet = None
+        values = await self._fetch_values(sheet_names + ([knowledge_sheet] if knowledge_sheet else []))
+        if values is None:
+            return 0
+        if knowledge_sheet:
+            await self._refresh_knowledge(values.pop())
+            self._knowledge_checked_at = time.monotonic()
+
+        changed = {}
+        for sheet_name, rows in zip(sheet_names, values):
+            state = self._sheets.get(sheet_name)
+            content_hash, products = await asyncio.to_thread(
+                _parse_changed_sheet, rows, sheet_name, state.content_hash if state else None
+            )
+            if products is not None:
+                changed[sheet_name] = (content_hash, products)
+
+        # Меняем листы и их ID в индексе без await — запросы видят либо старый, либо новый товар
+        affected = set()
+        for sheet_name, (content_hash, products) in changed.items():
+            state = self._sheets.get(sheet_name)
+            if state:
+                affected.update(state.products)
+            affected.update(products)
+            self._sheets[sheet_name] = _SheetState(content_hash, products)
+        removed = set(self._sheets) - set(sheet_names)
+        for sheet_name in removed:
+            affected.update(self._sheets.pop(sheet_name).products)
+        self._order = sheet_names
+        self._reindex(affected)
+
+        self.loaded = True
+        self.refreshes += 1
+        self.parsed_sheets += len(changed)
+        await self._confirm(revision, changed, removed)
+        logger.info(f"[Catalog] Обновлено листов: {len(changed)} из {len(sheet_names)}, "
+                    f"удалено: {len(removed)}, товаров в индексе: {len(self._index)}")
+        return len(changed)
+
+    async def refresh_knowledge(self) -> None:
+        """Загружает только лист базы знаний (если листа нет, индекс пустой)"""
+        self._knowledge_checked_at = time.monotonic()
+        all_names = await get_all_sheet_names()
+        if not all_names:
+            return  # Google недоступен
+        knowledge_sheet = next((name for name in all_names if name.lower() == KNOWLEDGE_SHEET_NAME), None)
+        rows = []
+        if knowledge_sheet:
+            values = await self._fetch_values([knowledge_sheet])
+            if values is None:
+                return
+            rows = values[0]
+        await self._refresh_knowledge(rows)
+
+    async def ensure_knowledge(self) -> None:
+        """
+        Индекс базы знаний для ответа. Обычно его строит обновление каталога; если индекса еще нет
+        или каталог выключен, лист загружается отдельно — не чаще раза в CATALOG_MISS_REFRESH_INTERVAL,
+        а при выключенном каталоге перечитывается в фоне раз в CATALOG_REFRESH_INTERVAL.
+        """
+        if not settings.KNOWLEDGE_BASE_ENABLED:
+            return
+        since_check = (time.monotonic() - self._knowledge_checked_at
+                       if self._knowledge_checked_at is not None else None)
+        if self._knowledge_hash is None:
+            if since_check is not None and since_check < settings.CATALOG_MISS_REFRESH_INTERVAL:
+                return
+            await asyncio.shield(self._refresh_knowledge_once())
+        elif not settings.CATALOG_ENABLED and since_check > settings.CATALOG_REFRESH_INTERVAL:
+            self._refresh_knowledge_once()
+
+    def _refresh_knowledge_once(self) -> asyncio.Task:
+        if self._knowledge_task is None or self._knowledge_task.done():
+            self._knowledge_task = asyncio.create_task(self.refresh_knowledge())
+        return self._knowledge_task
+
+    async def _refresh_knowledge(self, rows) -> None:
+        content_hash = _content_hash(rows)
+        if content_hash == self._knowledge_hash:
+            return
+        await asyncio.to_thread(knowledge_index.build, parse_knowledge_rows(rows))
+        self._knowledge_hash = content_hash
+
+    def _reindex(self, ad_ids: set) -> None:
+        for ad_id in ad_ids:
+            product = next((self._sheets[name].products[ad_id] for name in self._order
+                            if ad_id in self._sheets[name].products), None)
+            if product is None:
+                self._index.pop(ad_id, None)
+            else:
+                self._index[ad_id] = product
+
+    async def _confirm(self, revision: Optional[str], changed: dict, removed: set) -> None:
+        """Данные сверены с Google: обновляем возраст и сохраняем измененные листы в снимок"""
+        self._revision = revision
+        self.confirmed_at = time.time()
+        if settings.CATALOG_SNAPSHOT_ENABLED:
+            await asyncio.to_thread(self.snapshot.save, revision, self.confirmed_at, list(self._order), changed, removed)
+
+    async def _fetch_revision(self) -> Optional[str]:
+        """modifiedTime таблицы из Drive API (если ключ имеет к нему доступ)"""
+        url = f"https://www.googleapis.com/drive/v3/files/{SPREADSHEET_ID}?fields=modifiedTime&key={API_KEY}"
+        try:
+            async with httpx.AsyncClient(timeout=10) as client:
+                response = await client.get(url)
+                response.raise_for_status()
+                return response.json().get("modifiedTime")
+        except Exception as e:
+            logger.debug(f"[Catalog] modifiedTime недоступен, сравниваем хэши листов: {e}")
+            return None
+
+    async def _fetch_values(self, sheet_names: list[str]) -> Optional[list]:
+        """Все листы одним запросом values:batchGet"""
+        url = f"https://sheets.googleapis.com/v4/spreadsheets/{SPREADSHEET_ID}/values:batchGet"
+        params = [("ranges", f"{name}!{RANGE}") for name in sheet_names]
+        params += [("majorDimension", "ROWS"), ("key", API_KEY)]
+        try:
+            async with httpx.AsyncClient(timeout=30) as client:
+                response = await client.get(url, params=params)
+                response.raise_for_status()
+                value_ranges = response.json().get("valueRanges", [])
+        except Exception as e:
+            logger.error(f"[Catalog] Ошибка загрузки листов: {type(e).__name__}: {e}")
+            return None
+        if len(value_ranges) != len(sheet_names):
+            logger.error(f"[Catalog] Получено {len(value_ranges)} диапазонов вместо {len(sheet_names)}")
+            return None
+        return [value_range.get("values", []) for value_range in value_ranges]
+
+    def stats(self) -> dict:
+        return {
+            "loaded": self.loaded,
+            "sheets": len(self._sheets),
+            "products": len(self._index),
+            "revision": self._revision,
+            "refreshes": self.refreshes,
+            "parsed_sheets": self.parsed_sheets,
+            "age_seconds": round(self.age, 1) if self.age is not None else None,
+            "stale_lookups": self.stale_lookups
         }
 
-        if photo_col is not None:
-            photos = []
-            for row in product_rows:
-                val = await safe_get(row, photo_col, '')
-                if val:
-                    photos.append(str(val).strip())
-            if photos:
-                uniq = []
-                seen = set()
-                for p in photos:
-                    if p not in seen:
-                        seen.add(p)
-                        uniq.append(p)
-                product['photo_ids'] = ", ".join(uniq)
-
-        for row in product_rows:
-            color_val = await safe_get(row, color_col) if color_col is not None else ''
-            if not color_val:
-                continue
-            stock_item = {'color': color_val, 'sizes': {}}
-            for col_index, size_name in size_columns.items():
-                quantity_raw = await safe_get(row, col_index, '0')
-                try:
-                    quantity = int(quantity_raw) if str(quantity_raw).isdigit() else 0
-                except ValueError:
-                    quantity = 0
-                stock_item['sizes'][size_name] = "Есть в наличии" if quantity > 0 else "Нет в наличии"
-            stock_item['has_available_sizes'] = any(v == "Есть в наличии" for v in stock_item['sizes'].values())
-            product['stock'].append(stock_item)
-
-        product['has_stock'] = any(item['has_available_sizes'] for item in product['stock'])
-        product['available_colors'] = [item['color'] for item in product['stock'] if item['has_available_sizes']]
-
-        json_result = json.dumps(product, ensure_ascii=False, indent=4)
-        print("=== JSON результат парсера ===")
-        print(json_result)
-        print("=== Конец JSON ===")
-
-        return json_result
-
-    except Exception as e:
-        logger.error(f'[Parser] Ошибка при парсинге строки из документа: {e}')
-        return None
+
+# Создаем глобальный экземпляр
+product_catalog = ProductCatalog()
+
+
+def parse_knowledge_rows(rows) -> list[dict]:
+    result = []
+    for row in rows:
+        if len(row) >= 2:
+            result.append({'question': row[0], 'answer_example': row[1]})
+        elif len(row) == 1:
+            result.append({'question': row[0], 'answer_example': ''})
+    return result
 
 
 async def get_knowledge_base():
-    knowledge_sheet_names = ['knowledge_base']
+    knowledge_sheet_names = [KNOWLEDGE_SHEET_NAME]
     for sheet_name in knowledge_sheet_names:
         url = f"https://sheets.googleapis.com/v4/spreadsheets/{SPREADSHEET_ID}/values/{sheet_name}!{RANGE}?majorDimension=ROWS&key={API_KEY}"
         async with httpx.AsyncClient() as client:
@@ -458,12 +796,7 @@ async def get_knowledge_base():
                 data = response.json()
                 if "values" not in data or not data["values"]:
                     continue
-                result = []
-                for row in data["values"]:
-                    if len(row) >= 2:
-                        result.append({'question': row[0], 'answer_example': row[1]})
-                    elif len(row) == 1:
-                        result.append({'question': row[0], 'answer_example': ''})
+                result = parse_knowledge_rows(data["values"])
                 return json.dumps(result, ensure_ascii=False, indent=2)
             except Exception as e:
                 logger.error(f"[Parser] Ошибка при чтении листа {sheet_name}: {e}")
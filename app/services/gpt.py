@@ -2,7 +2,7 @@ from app.services.openai_assistant import assistant_manager
 from app.services.logs import logger
 
 # Асинхронная генерация ответа на сообщение клиента
-async def process_message(client_id: str, user_id: str, chat_id: str, message: str, ad_url: str, client_name: str, chat_url: str):
+async def process_message(client_id: str, user_id: str, chat_id: str, message: str, ad_url: str, client_name: str, chat_url: str, on_text=None):
     """
     Process a client message using the OpenAI Assistant API.
     This function now delegates to the AssistantManager.
@@ -14,5 +14,6 @@ async def process_message(client_id: str, user_id: str, chat_id: str, message: s
         message=message,
         ad_url=ad_url,
         client_name=client_name,
-        chat_url=chat_url
+        chat_url=chat_url,
+        on_text=on_text
     )
\ No newline at end of file
@@ -0,0 +1,120 @@
+import math
+import re
+from collections import Counter
+from typing import Optional
+
+from app.services.logs import logger
+
+# Проверяем наличие snowballstemmer для качественного стемминга русского языка
+try:
+    import snowballstemmer
+
+    SNOWBALL_AVAILABLE = True
+except ImportError:
+    SNOWBALL_AVAILABLE = False
+
+TOKEN_PATTERN = re.compile(r"[а-яa-z0-9]+")
+STOP_WORDS = {
+    "и", "в", "во", "на", "с", "со", "по", "к", "ко", "у", "о", "об", "от", "до", "за", "из", "для", "а", "но",
+    "или", "ли", "же", "бы", "не", "то", "это", "как", "что", "так", "вы", "я", "мы", "он", "она", "они",
+    "мне", "вам", "вас", "есть", "ну", "да", "нет", "можно", "какой", "какая", "какие", "подскажите",
+    "скажите", "здравствуйте", "добрый", "день", "пожалуйста"
+}
+# Окончания для упрощенного стемминга, если snowballstemmer не установлен (сначала длинные)
+RUSSIAN_ENDINGS = sorted((
+    "иями", "ями", "ами", "ого", "его", "ому", "ему", "ыми", "ими", "ией", "ах", "ях", "ов", "ев", "ей",
+    "ой", "ый", "ий", "ая", "яя", "ое", "ее", "ые", "ие", "ую", "юю", "ом", "ем", "ам", "ям", "ть", "ешь",
+    "ет", "ут", "ют", "ит", "ат", "ят", "ла", "ло", "ли", "а", "я", "о", "е", "ы", "и", "у", "ю", "ь", "й"
+), key=len, reverse=True)
+
+
+def _light_stem(word: str) -> str:
+    for ending in RUSSIAN_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= 3:
+            return word[:-len(ending)]
+    return word
+
+
+class KnowledgeIndex:
+    """
+    Поисковый индекс BM25 по базе знаний (вопрос — ответ) в памяти.
+    Вместо всей базы в контекст ассистента попадают только несколько подходящих пар,
+    поэтому стоимость FAQ в токенах остается небольшой и постоянной.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._stemmer = snowballstemmer.stemmer("russian") if SNOWBALL_AVAILABLE else None
+        # (записи, термы документов, длины документов, средняя длина, idf) — заменяется одним присваиванием
+        self._index: tuple = ([], [], [], 0.0, {})
+        self.searches = 0
+        self.hits = 0
+
+    def tokenize(self, text: str) -> list[str]:
+        words = [w for w in TOKEN_PATTERN.findall(str(text).lower().replace("ё", "е")) if w not in STOP_WORDS]
+        if self._stemmer is not None:
+            return self._stemmer.stemWords(words)
+        return [_light_stem(word) for word in words]
+
+    def build(self, entries: list[dict]) -> None:
+        """Строит индекс; entries — [{"question", "answer_example"}]. Синхронно, вызывается в потоке"""
+        # Вопрос учитывается дважды: совпадение с вопросом важнее совпадения с ответом
+        docs = [Counter(self.tokenize(f"{e['question']} {e['question']} {e['answer_example']}")) for e in entries]
+        lengths = [sum(doc.values()) for doc in docs]
+        document_frequency = Counter(term for doc in docs for term in doc)
+        total = len(docs)
+        idf = {term: math.log(1 + (total - df + 0.5) / (df + 0.5)) for term, df in document_frequency.items()}
+
+        # Индекс строится в потоке, поэтому поиск должен видеть либо старый, либо новый индекс целиком
+        self._index = (list(entries), docs, lengths, (sum(lengths) / total) if total else 0.0, idf)
+        logger.info(f"[KnowledgeIndex] Индекс построен: {total} записей, {len(idf)} термов")
+
+    @property
+    def size(self) -> int:
+        return len(self._index[0])
+
+    def search(self, text: str, top_k: int = 3, min_score: float = 0.0) -> list[dict]:
+        """Возвращает до top_k наиболее релевантных пар вопрос-ответ"""
+        self.searches += 1
+        entries, docs, lengths, avg_length, idf = self._index
+        terms = set(self.tokenize(text)) & idf.keys()
+        if not terms:
+            return []
+
+        scores = []
+        for index, doc in enumerate(docs):
+            length_norm = self.k1 * (1 - self.b + self.b * lengths[index] / (avg_length or 1))
+            score = 0.0
+            for term in terms:
+                frequency = doc.get(term)
+                if frequency:
+                    score += idf[term] * frequency * (self.k1 + 1) / (frequency + length_norm)
+            if score > min_score:
+                scores.append((score, index))
+
+        scores.sort(reverse=True)
+        results = [entries[index] for _, index in scores[:top_k]]
+        if results:
+            self.hits += 1
+        return results
+
+    @staticmethod
+    def render(entries: list[dict]) -> Optional[str]:
+        """Компактное представление для контекста ассистента"""
+        if not entries:
+            return None
+        return "\n".join(f"Q: {e['question']}\nA: {e['answer_example']}" for e in entries)
+
+    def stats(self) -> dict:
+        return {
+            "entries": self.size,
+            "terms": len(self._index[4]),
+            "stemmer": "snowball" if self._stemmer is not None else "light",
+            "searches": self.searches,
+            "hits": self.hits
+        }
+
+
+# Создаем глобальный экземпляр
+knowledge_index = KnowledgeIndex()
@@ -1,20 +1,27 @@
+import asyncio
 import json
 import re
+import time
 
-from app.config import OPENAI_API_KEY, OPENAI_ASSISTANT_ID, prompt, TELEGRAM_ESCALATION_THREAD_ID
+from app.config import settings, OPENAI_API_KEY, OPENAI_ASSISTANT_ID, prompt
 from app.services.logs import logger
+from app.services.knowledge_index import knowledge_index
+from app.services.answer_cache import answer_cache, context_version
+from app.services.assistant_tools import TOOLS, TOOL_HANDLERS, ToolContext, ToolResult
+from app.services.chat_engine import EngineReply, chat_completions_engine
+from app.services.thread_compaction import thread_compactor
+from app.services.usage_tracker import usage_tracker, usage_tokens
 from openai import OpenAI
-from db.messages_crud import create_message
-from db.escalation_crud import create_escalation
-from db.returns_crud import create_return
-from db.orders_crud import create_order
-from db.chat_crud import update_chat
+from db.messages_crud import (
+    create_message, get_latest_message_by_chat_id_and_author_id, count_messages_by_chat_id_and_author_id
+)
 
 
 class AssistantManager:
     def __init__(self):
         self.client = OpenAI(api_key=OPENAI_API_KEY)
         self.assistant_id = OPENAI_ASSISTANT_ID
+        self._background: set[asyncio.Task] = set()
 
     async def create_assistant(self):
         """
@@ -27,64 +34,7 @@ class AssistantManager:
             assistant = self.client.beta.assistants.create(
                 name="Avito Sales Assistant",
                 instructions=prompt,
-                tools=[
-                    {
-                        "type": "function",
-                        "function": {
-                            "name": "escalation",
-                            "description": "Client wants to be connected with manager or operator, or assistant cannot help the client",
-                            "parameters": {
-                                "type": "object",
-                                "properties": {
-                                    "reason": {"type": "string", "description": "Reason for escalation"},
-                                },
-                                "required": ["reason"]
-                            }
-                        }
-                    },
-                    {
-                        "type": "function",
-                        "function": {
-                            "name": "create_order",
-                            "description": "Create an order for a product",
-                            "parameters": {
-                                "type": "object",
-                                "properties": {
-                                    "size": {"type": "string", "description": "Size of the product"},
-                                    "color": {"type": "string", "description": "Color of the product"},
-                                },
-                                "required": ["size", "color"]
-                            }
-                        }
-                    },
-                    {
-                        "type": "function",
-                        "function": {
-                            "name": "initiate_return",
-                            "description": "Initiate a return for a product",
-                            "parameters": {
-                                "type": "object",
-                                "properties": {
-                                    "date_of_order": {"type": "string", "description": "Date of the order"},
-                                    "reason": {"type": "string", "description": "Reason for return"},
-                                },
-                                "required": ["date_of_order", "reason"]
-                            }
-                        }
-                    },
-                    {
-                        "type": "function",
-                        "function": {
-                            "name": "finish_communication",
-                            "description": "Finish communication when client sends a final message like 'Thank you', 'Order placed', 'Thanks, I ordered' or any other message indicating the conversation goal has been achieved and no further assistance is needed",
-                            "parameters": {
-                                "type": "object",
-                                "properties": {},
-                                "required": []
-                            }
-                        }
-                    }
-                ],
+                tools=TOOLS,
                 model="gpt-4o-mini"  # You can adjust this to the model you want
             )
 
@@ -129,10 +79,70 @@ class AssistantManager:
             logger.info(f"[Assistant] Created new OpenAI thread: {thread.id}")
             return thread.id
 
-    async def process_message(self, client_id, user_id, chat_id, message, ad_url, client_name, chat_url):
+    def _spawn(self, coro) -> None:
+        task = asyncio.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def _answer_cache_key(self, chat_id, user_id, stock_data, knowledge_base, clean_text):
+        """
+        Cache key for the message, or None when a cached answer must not be used:
+        the first reply in a chat (it has to greet the client) and a question the client repeats
+        after getting the same answer (most likely it did not help).
+        """
+        key = answer_cache.key(stock_data.id, context_version(stock_data.prompt, knowledge_base), clean_text)
+        if key is None:
+            answer_cache.skipped += 1
+            return None
+
+        last_reply = await get_latest_message_by_chat_id_and_author_id(chat_id, user_id)
+        if not last_reply:
+            answer_cache.skipped += 1
+            return None
+
+        cached = await answer_cache.peek(key)
+        if cached is not None and cached == last_reply:
+            answer_cache.skipped += 1
+            return None
+        return key
+
+    async def _answer_cacheable(self, chat_id, client_id) -> bool:
+        """
+        Whether the reply may be stored for other chats: the run saw the whole thread, so only a reply
+        given before the client shared anything beyond a greeting does not depend on this chat's history.
+        """
+        count = await count_messages_by_chat_id_and_author_id(chat_id, client_id)
+        if count is None or count > settings.ANSWER_CACHE_STORE_MAX_CLIENT_MESSAGES:
+            answer_cache.skipped += 1
+            return False
+        return True
+
+    async def _append_cached_exchange(self, user_id, chat_id, question, reply):
+        """Adds the cached exchange to the conversation history so later turns see the whole conversation"""
+        try:
+            if settings.CONVERSATION_ENGINE == "chat_completions":
+                await chat_completions_engine.save_history(user_id, chat_id, [
+                    {"role": "user", "content": question},
+                    {"role": "assistant", "content": reply}
+                ])
+                return
+            thread_id = await self.get_or_create_thread(chat_id)
+            await asyncio.to_thread(
+                self.client.beta.threads.messages.create, thread_id=thread_id, role="user", content=question
+            )
+            await asyncio.to_thread(
+                self.client.beta.threads.messages.create, thread_id=thread_id, role="assistant", content=reply
+            )
+            if settings.THREAD_COMPACTION_ENABLED:
+                await thread_compactor.after_turn(chat_id, thread_id, 2, None)
+        except Exception as e:
+            logger.error(f"[Assistant] Failed to append cached answer to thread for chat {chat_id}: {e}")
+
+    async def process_message(self, client_id, user_id, chat_id, message, ad_url, client_name, chat_url, on_text=None):
         """
         Process a message using the Assistants API.
         This replaces the old process_message function.
+        on_text receives reply fragments as they are generated (chat_completions engine only).
         """
         logger.info(f"[Assistant] Processing message in chat {chat_id}")
 
@@ -167,10 +177,8 @@ class AssistantManager:
         await create_message(chat_id, client_id, from_assistant=False, message=clean_text)
 
         try:
-            thread_id = await self.get_or_create_thread(chat_id)
-
             # Get stock information
-            from app.services.google_sheets_api import fetch_google_sheet_stock, get_knowledge_base
+            from app.services.google_sheets_api import fetch_google_sheet_stock, product_catalog
 
             # Retrieve stock information
             logger.info(f"[Assistant] Getting stock info for {ad_url}")
@@ -180,155 +188,70 @@ class AssistantManager:
                 logger.warning(f"[Assistant] No stock data found for {ad_url}")
                 return None
 
-            # Get knowledge base
-            logger.info(f"[Assistant] Getting knowledge base")
-            # knowledge_base = await get_knowledge_base() # Комментируем, чтобы было сэкономить токены
+            # Get only the knowledge base entries relevant to the message
+            knowledge_base = None
+            if settings.KNOWLEDGE_BASE_ENABLED:
+                await product_catalog.ensure_knowledge()
+                entries = knowledge_index.search(clean_text, settings.KNOWLEDGE_TOP_K, settings.KNOWLEDGE_MIN_SCORE)
+                knowledge_base = knowledge_index.render(entries)
+                logger.info(f"[Assistant] Knowledge base entries found: {len(entries)}")
 
             # Add context as a system message
             # Note: With Assistants API we use a new message for the context to ensure it's used
             context_message = f"""
-            # STOCK AVAILABILITY AND INFORMATION: {stock_data}
+            # STOCK AVAILABILITY AND INFORMATION: {stock_data.prompt}
             """
-
-            # Add the context message to the thread
-            self.client.beta.threads.messages.create(
-                thread_id=thread_id,
-                role="user",
-                content=context_message
-            )
-
-            # Add the user message to the thread
-            self.client.beta.threads.messages.create(
-                thread_id=thread_id,
-                role="user",
-                content=clean_text
-            )
-
-            # Run the assistant
-            run = self.client.beta.threads.runs.create_and_poll(
-                thread_id=thread_id,
-                assistant_id=self.assistant_id
-            )
-            function_name = None
-            # Handle tool calls/function calls if any
-            if run.required_action:
-                tool_outputs = []
-
-                for tool_call in run.required_action.submit_tool_outputs.tool_calls:
-                    function_name = tool_call.function.name
-                    arguments = json.loads(tool_call.function.arguments)
-
-                    # Handle escalation
-                    if function_name == "escalation":
-                        reason = arguments.get("reason")
-
-                        # Create an escalation in the database
-                        await create_escalation(chat_id, client_id, client_name, chat_url, reason)
-
-                        # Отключает бота в чате, если была эскалация
-                        await update_chat(chat_id, under_assistant=False)
-
-                        # Notify via Telegram
-                        from app.services.telegram_notifier import send_alert
-                        await send_alert(f"❗️Требуется срочное внимание менеджера\n\n"
-                                         f"Товар: {ad_url}\n"
-                                         f"Причина: {reason}\n"
-                                         f"Ссылка на чат: {chat_url}", thread_id=TELEGRAM_ESCALATION_THREAD_ID)
-
-                        # Add the tool output
-                        tool_outputs.append({
-                            "tool_call_id": tool_call.id,
-                            "output": json.dumps({"status": "success", "message": "Escalation created"})
-                        })
-
-                    # Handle create order
-                    elif function_name == "create_order":
-                        size = arguments.get("size")
-                        color = arguments.get("color")
-
-                        # Get good_name from stock data
-                        stock = json.loads(stock_data)
-                        good_name = stock.get('name')
-
-                        # Create an order in the database
-                        await create_order(chat_id, client_id, client_name, color, size, ad_url, good_name)
-
-                        # Notify via Telegram
-                        from app.services.telegram_notifier import send_alert
-                        await send_alert(f"Новый заказ\n\n"
-                                         f"Товар: {ad_url}\n"
-                                         f"Размер: {size}\n"
-                                         f"Цвет: {color}", thread_id=138)
-
-                        # Add the tool output
-                        tool_outputs.append({
-                            "tool_call_id": tool_call.id,
-                            "output": json.dumps({"status": "success", "message": "Order created"})
-                        })
-
-                    # Handle initiate return
-                    elif function_name == "initiate_return":
-                        date_of_order = arguments.get("date_of_order")
-                        reason = arguments.get("reason")
-
-                        # Create a return in the database
-                        await create_return(chat_id, client_id, client_name, reason, ad_url)
-
-                        # Notify via Telegram
-                        from app.services.telegram_notifier import send_alert
-                        await send_alert(f"Новая заявка на возврат\n\n"
-                                         f"Товар: {ad_url}\n"
-                                         f"Заказ от: {date_of_order}\n"
-                                         f"Причина: {reason}", thread_id=76)
-
-                        # Add the tool output
-                        tool_outputs.append({
-                            "tool_call_id": tool_call.id,
-                            "output": json.dumps({"status": "success", "message": "Return initiated"})
-                        })
-
-                    # Handle finish_communication
-                    elif function_name == "finish_communication":
-                        logger.info(f"[Assistant] Communication finished in chat {chat_id}")
-
-                        # Add the tool output
-                        tool_outputs.append({
-                            "tool_call_id": tool_call.id,
-                            "output": json.dumps({"status": "success", "message": "Communication finished"})
-                        })
-
-
-                # Submit the tool outputs and wait for completion
-                if tool_outputs:
-
-                    run = self.client.beta.threads.runs.submit_tool_outputs_and_poll(
-                        thread_id=thread_id,
-                        run_id=run.id,
-                        tool_outputs=tool_outputs
-                    )
-            # Тут эта проверка, так как обязательно нужно условие выше. Если выйти из функции раньше, то заблокируем тред
-            if function_name == 'finish_communication':
+            if knowledge_base:
+                context_message += f"# FAQ:\n{knowledge_base}\n"
+
+            # Repeated questions about the same ad are answered from the cache without a run
+            cache_key = None
+            if settings.ANSWER_CACHE_ENABLED:
+                cache_key = await self._answer_cache_key(chat_id, user_id, stock_data, knowledge_base, clean_text)
+                if cache_key:
+                    reply = await answer_cache.get(cache_key)
+                    if reply:
+                        logger.info(f"[Assistant] Answer cache hit in chat {chat_id}")
+                        self._spawn(self._append_cached_exchange(user_id, chat_id, clean_text, reply))
+                        await create_message(chat_id, user_id, from_assistant=True, message=reply)
+                        return reply
+
+            economy = await usage_tracker.over_budget(chat_id)
+            run_started = time.monotonic()
+            tool_context = ToolContext(chat_id, client_id, client_name, chat_url, ad_url, stock_data.name)
+
+            async def handle_tools(calls):
+                return await self.handle_tool_calls(calls, tool_context)
+
+            if settings.CONVERSATION_ENGINE == "chat_completions":
+                result = await chat_completions_engine.respond(user_id, chat_id, clean_text, context_message, handle_tools,
+                                                               on_text=on_text, economy=economy)
+            else:
+                thread_id = await self.get_or_create_thread(chat_id)
+                if settings.THREAD_COMPACTION_ENABLED:
+                    # A thread idle for too long is replaced by a summary before the turn
+                    thread_id = await thread_compactor.before_turn(chat_id, thread_id)
+                result = await self._run_thread(thread_id, clean_text, context_message, handle_tools, economy)
+                if settings.THREAD_COMPACTION_ENABLED:
+                    # Context, message and reply; an oversized thread is compacted before the next message
+                    self._spawn(thread_compactor.after_turn(chat_id, thread_id, 3, result.prompt_tokens))
+
+            self._spawn(usage_tracker.record_turn(
+                chat_id, stock_data.id, result.model, result.prompt_tokens, result.completion_tokens, result.tools,
+                time.monotonic() - run_started
+            ))
+
+            if result.function_name == 'finish_communication':
                 return "Communication finished"
 
-
-            # Get the messages after the run is complete
-            messages = self.client.beta.threads.messages.list(
-                thread_id=thread_id
-            )
-
-            # Get the last assistant message
-            assistant_messages = [
-                msg for msg in messages.data
-                if msg.role == "assistant"
-            ]
-
-            if not assistant_messages:
-                logger.error(f"[Assistant] No assistant messages found in thread {thread_id}")
+            reply = result.text
+            if reply is None:
                 return None
 
-            # Get the most recent assistant message
-            last_assistant_message = assistant_messages[0]
-            reply = last_assistant_message.content[0].text.value if last_assistant_message.content else ""
+            if cache_key and reply and result.function_name is None:
+                answer_cache.record_run(time.monotonic() - run_started)
+                if await self._answer_cacheable(chat_id, client_id):
+                    await answer_cache.set(cache_key, reply)
 
             # Save the response to the database
             await create_message(chat_id, user_id, from_assistant=True, message=reply)
@@ -340,6 +263,124 @@ class AssistantManager:
             logger.error(f"[Assistant] Error processing message: {e}")
             return None
 
+    async def _run_thread(self, thread_id, clean_text, context_message, handle_tools, economy=False) -> EngineReply:
+        """
+        One turn through the Assistants API: context and message go to the thread, then a run.
+        economy — the chat is over its token budget: a cheaper model and only the last messages of the thread.
+        """
+        # Add the context message to the thread
+        self.client.beta.threads.messages.create(
+            thread_id=thread_id,
+            role="user",
+            content=context_message
+        )
+
+        # Add the user message to the thread
+        self.client.beta.threads.messages.create(
+            thread_id=thread_id,
+            role="user",
+            content=clean_text
+        )
+
+        # Run the assistant
+        budget_options = {}
+        if economy:
+            budget_options = {
+                "model": settings.BUDGET_MODEL,
+                "truncation_strategy": {"type": "last_messages", "last_messages": settings.BUDGET_HISTORY_LIMIT}
+            }
+        run = self.client.beta.threads.runs.create_and_poll(
+            thread_id=thread_id,
+            assistant_id=self.assistant_id,
+            **budget_options
+        )
+        result = EngineReply(None)
+        # Handle tool calls/function calls if any
+        if run.required_action:
+            tool_calls = run.required_action.submit_tool_outputs.tool_calls
+            result.tools = [tool_call.function.name for tool_call in tool_calls]
+            if tool_calls:
+                result.function_name = tool_calls[-1].function.name
+
+            # All calls run concurrently; outputs are submitted as soon as the DB writes finish
+            outputs = await handle_tools([
+                (tool_call.function.name, json.loads(tool_call.function.arguments)) for tool_call in tool_calls
+            ])
+            tool_outputs = [
+                {"tool_call_id": tool_call.id, "output": json.dumps(output)}
+                for tool_call, output in zip(tool_calls, outputs)
+            ]
+
+            # Submit the tool outputs and wait for completion
+            if tool_outputs:
+
+                run = self.client.beta.threads.runs.submit_tool_outputs_and_poll(
+                    thread_id=thread_id,
+                    run_id=run.id,
+                    tool_outputs=tool_outputs
+                )
+        # Token usage of the whole run (including the part after the tool outputs)
+        result.model = getattr(run, "model", None)
+        result.prompt_tokens, result.completion_tokens = usage_tokens(getattr(run, "usage", None))
+
+        # Тут эта проверка, так как обязательно нужно условие выше. Если выйти из функции раньше, то заблокируем тред
+        if result.function_name == 'finish_communication':
+            return result
+
+
+        # Get the messages after the run is complete
+        messages = self.client.beta.threads.messages.list(
+            thread_id=thread_id
+        )
+
+        # Get the last assistant message
+        assistant_messages = [
+            msg for msg in messages.data
+            if msg.role == "assistant"
+        ]
+
+        if not assistant_messages:
+            logger.error(f"[Assistant] No assistant messages found in thread {thread_id}")
+            return result
+
+        # Get the most recent assistant message
+        last_assistant_message = assistant_messages[0]
+        result.text = last_assistant_message.content[0].text.value if last_assistant_message.content else ""
+        return result
+
+    async def handle_tool_calls(self, calls, context: ToolContext) -> list[dict]:
+        """
+        Executes the function calls of one turn concurrently and returns their outputs in order.
+        Only the DB writes are awaited; Telegram alerts are sent in the background.
+        A failed call gets an error output, so the other calls of the turn still take effect.
+        """
+        results = await asyncio.gather(
+            *(self._handle_tool_call(name, arguments, context) for name, arguments in calls), return_exceptions=True
+        )
+        outputs = []
+        for (function_name, _), result in zip(calls, results):
+            if isinstance(result, Exception):
+                logger.error(f"[Assistant] Function {function_name} failed in chat {context.chat_id}: {result}")
+                outputs.append({"status": "error", "message": f"Function {function_name} failed"})
+                continue
+            if result.alert:
+                self._spawn(self._send_alert(*result.alert))
+            outputs.append(result.output)
+        return outputs
+
+    async def _handle_tool_call(self, function_name, arguments, context: ToolContext) -> ToolResult:
+        handler = TOOL_HANDLERS.get(function_name)
+        if handler is None:
+            logger.error(f"[Assistant] Unknown function call {function_name} in chat {context.chat_id}")
+            return ToolResult({"status": "error", "message": f"Unknown function {function_name}"})
+        return await handler(arguments, context)
+
+    async def _send_alert(self, message, thread_id):
+        from app.services.telegram_notifier import send_alert
+        try:
+            await send_alert(message, thread_id=thread_id)
+        except Exception as e:
+            logger.error(f"[Assistant] Failed to send Telegram alert: {e}")
 
 # Create a singleton instance
 assistant_manager = AssistantManager()
\ No newline at end of file
@@ -0,0 +1,47 @@
+import asyncio
+import time
+from typing import Optional
+
+
+class TokenBucket:
+    """Token bucket для ограничения частоты запросов к внешним API"""
+
+    def __init__(self, rate_per_minute: float, capacity: Optional[int] = None):
+        self.rate = rate_per_minute / 60.0  # Токенов в секунду
+        self.capacity = capacity or max(1, int(rate_per_minute))
+        self.tokens = float(self.capacity)
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        start = max(self._updated_at, self._paused_until)
+        if now > start:
+            self.tokens = min(self.capacity, self.tokens + (now - start) * self.rate)
+        self._updated_at = now
+
+    def delay(self) -> float:
+        """Сколько секунд ждать до появления токена (0 — токен есть)"""
+        self._refill()
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def try_acquire(self) -> bool:
+        if self.delay() > 0:
+            return False
+        self.tokens -= 1
+        return True
+
+    async def acquire(self) -> None:
+        while not self.try_acquire():
+            await asyncio.sleep(self.delay())
+
+    def pause(self, seconds: float) -> None:
+        """Блокирует выдачу токенов (например, по retry_after от API); после паузы доступен один запрос"""
+        self._refill()
+        self.tokens = 1.0
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
@@ -0,0 +1,162 @@
+import asyncio
+import re
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Optional
+
+from app.config import settings
+from app.services.logs import logger
+
+# Граница части ответа: конец предложения или перевод строки (пункт списка, абзац)
+BOUNDARY_PATTERN = re.compile(r"(?<=[.!?…])\s+|\n+")
+
+SendFunc = Callable[[int, str, str], Awaitable[None]]
+
+
+def split_point(text: str, min_chars: int) -> Optional[int]:
+    """Позиция первой границы после min_chars символов или None, если часть еще не готова"""
+    for match in BOUNDARY_PATTERN.finditer(text, min_chars):
+        if text[:match.start()].strip():
+            return match.end()
+    return None
+
+
+class ReplyStream:
+    """
+    Один ответ, который отправляется в Авито частями по мере генерации.
+    feed вызывается движком на каждый фрагмент текста; готовые части уходят по порядку из фоновой задачи.
+    """
+
+    def __init__(self, streamer: "ReplyStreamer", user_id, chat_id: str, send: SendFunc):
+        self.streamer = streamer
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.send = send
+        self.sent: list[str] = []
+        self._buffer = ""
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+        self._started = time.monotonic()
+
+    def feed(self, delta: str) -> None:
+        self._buffer += delta
+        while True:
+            # Первая часть — как можно раньше, следующие крупнее, чтобы не дробить ответ на много сообщений
+            min_chars = settings.REPLY_STREAM_CHUNK_CHARS if self._task else settings.REPLY_STREAM_FIRST_CHUNK_CHARS
+            cut = split_point(self._buffer, min_chars)
+            if cut is None:
+                return
+            self._enqueue(self._buffer[:cut])
+            self._buffer = self._buffer[cut:]
+
+    def _enqueue(self, chunk: str) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        self._queue.put_nowait(chunk)
+
+    async def _run(self) -> None:
+        # Части разных ответов одного чата не перемешиваются
+        async with self.streamer.chat_lock(self.chat_id):
+            while (chunk := await self._queue.get()) is not None:
+                try:
+                    await self.send(self.user_id, self.chat_id, chunk.strip())
+                except Exception as e:
+                    self.streamer.send_errors += 1
+                    logger.error(f"[ReplyStream] Ошибка отправки части ответа в чат {self.chat_id}: {e}")
+                    await self._send_rest(chunk)
+                    return
+                if not self.sent:
+                    self.streamer.record_first_chunk(time.monotonic() - self._started)
+                self.sent.append(chunk.strip())
+                self.streamer.chunks_sent += 1
+
+    async def _send_rest(self, chunk: str) -> None:
+        """После ошибки дожидается конца ответа и отправляет все неотправленное одним сообщением"""
+        parts = [chunk]
+        while (chunk := await self._queue.get()) is not None:
+            parts.append(chunk)
+        if not self.sent:
+            # Клиент не получил ни одной части — ответ целиком отправит вызывающий код
+            return
+        rest = "".join(parts).strip()
+        try:
+            await self.send(self.user_id, self.chat_id, rest)
+        except Exception as e:
+            self.streamer.send_errors += 1
+            logger.error(f"[ReplyStream] Не удалось отправить остаток ответа в чат {self.chat_id}: {e}")
+            return
+        self.sent.append(rest)
+        self.streamer.chunks_sent += 1
+
+    async def finish(self) -> bool:
+        """
+        Дожидается отправки. True — ответ уже ушел клиенту частями (остаток дописан),
+        False — ни одна часть не дошла, ответ нужно отправить целиком как обычно.
+        """
+        if self._task is None:
+            return False
+        if self._buffer.strip():
+            self._queue.put_nowait(self._buffer)
+        self._buffer = ""
+        self._queue.put_nowait(None)
+        try:
+            await self._task
+        except Exception as e:
+            self.streamer.send_errors += 1
+            logger.error(f"[ReplyStream] Ошибка отправки части ответа в чат {self.chat_id}: {e}")
+        self.streamer.streamed_replies += 1
+        return bool(self.sent)
+
+
+class ReplyStreamer:
+    """Потоковая отправка длинных ответов в Авито с порядком частей внутри чата"""
+
+    def __init__(self):
+        self._locks: dict[str, asyncio.Lock] = {}
+        self._lock_users: defaultdict[str, int] = defaultdict(int)
+        self.streamed_replies = 0
+        self.chunks_sent = 0
+        self.send_errors = 0
+        self.first_chunk_seconds_avg = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        # Assistants API отдает ответ только после завершения запуска, поток есть только у chat_completions
+        return settings.REPLY_STREAMING_ENABLED and settings.CONVERSATION_ENGINE == "chat_completions"
+
+    def open(self, user_id, chat_id: str, send: SendFunc) -> ReplyStream:
+        return ReplyStream(self, user_id, chat_id, send)
+
+    @asynccontextmanager
+    async def chat_lock(self, chat_id: str):
+        lock = self._locks.setdefault(chat_id, asyncio.Lock())
+        self._lock_users[chat_id] += 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._lock_users[chat_id] -= 1
+            if not self._lock_users[chat_id]:
+                del self._lock_users[chat_id]
+                self._locks.pop(chat_id, None)
+
+    def record_first_chunk(self, seconds: float) -> None:
+        if self.first_chunk_seconds_avg:
+            self.first_chunk_seconds_avg = 0.9 * self.first_chunk_seconds_avg + 0.1 * seconds
+        else:
+            self.first_chunk_seconds_avg = seconds
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "streamed_replies": self.streamed_replies,
+            "chunks_sent": self.chunks_sent,
+            "send_errors": self.send_errors,
+            "first_chunk_seconds_avg": round(self.first_chunk_seconds_avg, 3),
+            "active_chats": len(self._locks)
+        }
+
+
+# Создаем глобальный экземпляр
+reply_streamer = ReplyStreamer()
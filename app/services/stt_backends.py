@@ -0,0 +1,148 @@
+import asyncio
+import multiprocessing
+from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+from app.config import settings
+from app.services.audio_downloader import AudioSource
+from app.services.logs import logger
+from app.services import stt_worker
+
+# Проверяем наличие faster-whisper для локального распознавания
+try:
+    import faster_whisper  # noqa: F401
+
+    FASTER_WHISPER_AVAILABLE = True
+except ImportError:
+    FASTER_WHISPER_AVAILABLE = False
+
+LANGUAGE = "ru"
+
+
+class SpeechToTextBackend(ABC):
+    """Интерфейс бэкенда распознавания речи"""
+
+    name = "base"
+
+    @abstractmethod
+    async def transcribe(self, audio: AudioSource) -> str:
+        """Текст голосового сообщения"""
+
+
+class WhisperAPIBackend(SpeechToTextBackend):
+    """Распознавание через OpenAI Whisper API"""
+
+    name = "whisper-api"
+
+    def __init__(self, client, model: str):
+        self.client = client
+        self.model = model
+
+    async def transcribe(self, audio: AudioSource) -> str:
+        with audio.open() as audio_file:
+            # Синхронный клиент OpenAI вызываем в потоке, чтобы распознавания шли параллельно
+            response = await asyncio.to_thread(
+                self.client.audio.transcriptions.create,
+                model=self.model,
+                file=(audio.filename, audio_file),
+                language=LANGUAGE,  # Указываем русский язык для лучшего качества
+                response_format="text",
+                temperature=0.0  # Минимальная температура для более точного распознавания
+            )
+        # Whisper возвращает строку при response_format="text"
+        return response.strip() if isinstance(response, str) else str(response).strip()
+
+
+class LocalWhisperBackend(SpeechToTextBackend):
+    """
+    Локальное распознавание faster-whisper (CTranslate2, int8 на CPU).
+    Модель загружается в процессах пула при старте, поэтому запросы не ждут ее загрузки.
+    """
+
+    name = "faster-whisper"
+
+    def __init__(self):
+        self.model_size = settings.STT_LOCAL_MODEL
+        self.workers = settings.STT_LOCAL_WORKERS
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._restart: Optional[asyncio.Task] = None
+        self.recycles = 0
+
+    @property
+    def model(self) -> str:
+        """Название для кэша распознаваний, например faster-whisper-small"""
+        return f"{self.name}-{self.model_size}"
+
+    @property
+    def available(self) -> bool:
+        return FASTER_WHISPER_AVAILABLE
+
+    @property
+    def running(self) -> bool:
+        return self._pool is not None
+
+    async def start(self) -> None:
+        if self._pool is not None:
+            return
+        if not self.available:
+            logger.warning("[STT] faster-whisper не установлен, локальное распознавание недоступно")
+            return
+
+        # spawn: форк процесса с запущенным event loop и соединениями небезопасен
+        self._pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=stt_worker.init_worker,
+            initargs=(self.model_size, settings.STT_LOCAL_COMPUTE_TYPE, settings.STT_LOCAL_CPU_THREADS)
+        )
+        loop = asyncio.get_running_loop()
+        try:
+            await asyncio.gather(*(loop.run_in_executor(self._pool, stt_worker.warmup) for _ in range(self.workers)))
+            logger.info(f"[STT] Локальная модель {self.model_size} загружена в {self.workers} процесс(ах)")
+        except Exception as e:
+            logger.error(f"[STT] Не удалось загрузить локальную модель: {e}")
+            await self.stop()
+
+    async def stop(self) -> None:
+        if self._restart is not None and self._restart is not asyncio.current_task():
+            self._restart.cancel()
+        self._restart = None
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    async def transcribe(self, audio: AudioSource) -> str:
+        if self._pool is None:
+            raise RuntimeError("Локальное распознавание не запущено")
+        data = await asyncio.to_thread(audio.read_bytes)
+        loop = asyncio.get_running_loop()
+        pool = self._pool
+        try:
+            return await asyncio.wait_for(
+                loop.run_in_executor(pool, stt_worker.transcribe, data, LANGUAGE),
+                settings.STT_LOCAL_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            # wait_for не освобождает процесс: зависшее распознавание держало бы его для всех следующих
+            await self._recycle(pool)
+            raise
+
+    async def _recycle(self, pool: ProcessPoolExecutor) -> None:
+        """Завершает процессы пула с зависшим распознаванием и запускает новый пул в фоне"""
+        if self._pool is not pool:
+            return  # Пул уже пересоздан другим запросом
+        self._pool = None
+        self.recycles += 1
+        logger.warning(f"[STT] Распознавание дольше {settings.STT_LOCAL_TIMEOUT}с, пул процессов пересоздается")
+        # Публичного способа остановить занятый процесс у ProcessPoolExecutor нет
+        processes = list((getattr(pool, "_processes", None) or {}).values())
+        pool.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            process.terminate()
+        # Модель загружается в новый пул в фоне, запрос с таймаутом уйдет в API
+        self._restart = asyncio.create_task(self.start())
+
+
+# Создаем глобальный экземпляр
+local_whisper_backend = LocalWhisperBackend()
@@ -0,0 +1,24 @@
+"""
+Код, выполняемый в процессах пула локального распознавания.
+Модуль намеренно не импортирует приложение: процессы запускаются через spawn и грузят только модель.
+"""
+import io
+
+_model = None
+
+
+def init_worker(model_size: str, compute_type: str, cpu_threads: int) -> None:
+    """Загружает модель один раз при старте процесса"""
+    global _model
+    from faster_whisper import WhisperModel
+
+    _model = WhisperModel(model_size, device="cpu", compute_type=compute_type, cpu_threads=cpu_threads)
+
+
+def warmup() -> bool:
+    return _model is not None
+
+
+def transcribe(data: bytes, language: str) -> str:
+    segments, _ = _model.transcribe(io.BytesIO(data), language=language, beam_size=1, vad_filter=True)
+    return " ".join(segment.text.strip() for segment in segments).strip()
@@ -2,14 +2,29 @@ import asyncio
 
 from aiogram.types import ForumTopicCreated
 from app.services.logs import logger
-from app.config import TELEGRAM_CHAT_ID
+from app.config import TELEGRAM_CHAT_ID, settings
 from app.services.telegram_bot import bot
+from app.services.telegram_outbox import TelegramOutbox
+
+
+async def _deliver_alert(message: str, thread_id):
+    await bot.send_message(chat_id=TELEGRAM_CHAT_ID, text=message, message_thread_id=thread_id)
+
+
+telegram_outbox = TelegramOutbox(_deliver_alert)
+
 
 # ✅ Отправка сообщения в чат
 async def send_alert(message: str, thread_id: int):
+    if settings.TELEGRAM_OUTBOX_ENABLED and telegram_outbox.running:
+        # Отправит фоновый отправитель с учетом лимитов Telegram
+        telegram_outbox.enqueue(message, thread_id)
+        logger.info(f"[API] Уведомление для треда {thread_id} поставлено в очередь")
+        return
+
     logger.info(f"[API] Отправка уведомления в телеграм по треду {thread_id}")
     try:
-        await bot.send_message(chat_id=TELEGRAM_CHAT_ID, text=message, message_thread_id=thread_id)
+        await _deliver_alert(message, thread_id)
         logger.info("[API] ✅ Уведомление успешно отправлено в Telegram")
     except Exception as e:
         logger.error(f"[API] ❌ Ошибка при отправке уведомления в Telegram: {e}")
@@ -0,0 +1,321 @@
+import asyncio
+import json
+import uuid
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Optional, Union
+
+from aiogram.exceptions import TelegramRetryAfter
+
+from app.config import settings
+from app.redis_db import get_shared_redis, is_redis_configured
+from app.services.cache import LRUCache
+from app.services.logs import logger
+from app.services.rate_limiter import TokenBucket
+
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
+OUTBOX_REDIS_KEY = "telegram_outbox"  # Общий список прежних версий — разбирается как осиротевший
+OUTBOX_WORKERS_KEY = "telegram_outbox:workers"
+
+ThreadId = Union[int, str, None]
+
+
+@dataclass
+class OutboxItem:
+    text: str
+    thread_id: ThreadId
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    attempts: int = 0
+
+    def dump(self) -> str:
+        return json.dumps({"id": self.id, "text": self.text, "thread_id": self.thread_id}, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, raw: str) -> "OutboxItem":
+        data = json.loads(raw)
+        return cls(text=data["text"], thread_id=data["thread_id"], id=data["id"])
+
+
+class TelegramOutbox:
+    """
+    Очередь исходящих уведомлений в Telegram.
+    Отправитель соблюдает лимиты группы и отдельных тредов, учитывает retry_after
+    и склеивает подряд идущие уведомления одного треда в одно сообщение (до 4096 символов).
+    Неотправленные уведомления каждый воркер хранит в своем списке Redis под арендой с продлением;
+    списки воркеров, чья аренда истекла, другие воркеры забирают по одному элементу (LMOVE).
+    """
+
+    def __init__(self, deliver: Callable[[str, ThreadId], Awaitable]):
+        self._deliver = deliver
+        self.worker_id = uuid.uuid4().hex
+        self._lease_task: Optional[asyncio.Task] = None
+        self._pending: "OrderedDict[str, deque[OutboxItem]]" = OrderedDict()
+        self._wakeup = asyncio.Event()
+        self._group_bucket = TokenBucket(settings.TELEGRAM_GROUP_RATE_PER_MIN, settings.TELEGRAM_GROUP_BURST)
+        # Лимиты тредов; бакет, простоявший дольше полного восполнения и самой долгой паузы, вытесняется
+        self._thread_buckets = LRUCache(
+            maxsize=settings.CHAT_CACHE_SIZE,
+            ttl=settings.TELEGRAM_THREAD_BURST * 60 / settings.TELEGRAM_THREAD_RATE_PER_MIN
+            + 2 ** settings.TELEGRAM_OUTBOX_MAX_ATTEMPTS
+        )
+        self._persisting: dict[str, asyncio.Task] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._background: set[asyncio.Task] = set()
+        self._in_flight = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.failed = 0
+        self.retry_after_hits = 0
+        self.adopted = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    @property
+    def persistent(self) -> bool:
+        return settings.TELEGRAM_OUTBOX_PERSIST and is_redis_configured()
+
+    @staticmethod
+    def _queue_key(worker_id: str) -> str:
+        return f"telegram_outbox:{worker_id}"
+
+    @staticmethod
+    def _lease_key(worker_id: str) -> str:
+        return f"telegram_outbox:lease:{worker_id}"
+
+    def pending_count(self) -> int:
+        return sum(len(items) for items in self._pending.values())
+
+    def enqueue(self, text: str, thread_id: ThreadId) -> None:
+        """Ставит уведомление в очередь, не дожидаясь отправки"""
+        for start in range(0, max(len(text), 1), TELEGRAM_MAX_MESSAGE_LENGTH):
+            item = OutboxItem(text=text[start:start + TELEGRAM_MAX_MESSAGE_LENGTH], thread_id=thread_id)
+            self._append(item)
+            if self.persistent:
+                self._persisting[item.id] = self._spawn(self._persist(item))
+        self._wakeup.set()
+
+    def _append(self, item: OutboxItem) -> None:
+        self._pending.setdefault(str(item.thread_id), deque()).append(item)
+
+    def _requeue(self, key: str, items: list[OutboxItem]) -> None:
+        """Возвращает неотправленную пачку в начало очереди треда"""
+        queue = self._pending.setdefault(key, deque())
+        queue.extendleft(reversed(items))
+        self._pending.move_to_end(key, last=False)
+
+    def _spawn(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+        return task
+
+    def _thread_bucket(self, key: str) -> TokenBucket:
+        bucket = self._thread_buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(settings.TELEGRAM_THREAD_RATE_PER_MIN, settings.TELEGRAM_THREAD_BURST)
+        # Повторная запись продлевает срок: вытесняются только простаивающие бакеты
+        self._thread_buckets.set(key, bucket)
+        return bucket
+
+    def _take_batch(self, key: str) -> list[OutboxItem]:
+        """Забирает из очереди треда столько уведомлений, сколько влезает в одно сообщение"""
+        queue = self._pending[key]
+        batch = [queue.popleft()]
+        length = len(batch[0].text)
+        while queue and length + 1 + len(queue[0].text) <= TELEGRAM_MAX_MESSAGE_LENGTH:
+            item = queue.popleft()
+            length += 1 + len(item.text)
+            batch.append(item)
+        if not queue:
+            del self._pending[key]
+        return batch
+
+    async def _persist(self, item: OutboxItem) -> None:
+        try:
+            await get_shared_redis().rpush(self._queue_key(self.worker_id), item.dump())
+        except Exception as e:
+            logger.warning(f"[TelegramOutbox] Не удалось сохранить уведомление в Redis: {e}")
+        finally:
+            self._persisting.pop(item.id, None)
+
+    async def _forget(self, items: list[OutboxItem]) -> None:
+        # LREM не должен обогнать RPUSH: иначе отправленное уведомление останется в Redis и уйдет повторно
+        persisting = [self._persisting[item.id] for item in items if item.id in self._persisting]
+        if persisting:
+            await asyncio.gather(*persisting, return_exceptions=True)
+        try:
+            redis = get_shared_redis()
+            for item in items:
+                await redis.lrem(self._queue_key(self.worker_id), 1, item.dump())
+        except Exception as e:
+            logger.warning(f"[TelegramOutbox] Не удалось удалить уведомления из Redis: {e}")
+
+    async def _renew_lease(self) -> None:
+        redis = get_shared_redis()
+        async with redis.pipeline(transaction=False) as pipe:
+            pipe.set(self._lease_key(self.worker_id), "1", ex=settings.TELEGRAM_OUTBOX_LEASE_SECONDS)
+            pipe.sadd(OUTBOX_WORKERS_KEY, self.worker_id)
+            await pipe.execute()
+
+    async def _adopt(self, queue_key: str) -> int:
+        """Переносит уведомления из чужого списка в свой по одному: каждое забирает только один воркер"""
+        redis = get_shared_redis()
+        count = 0
+        while True:
+            raw = await redis.lmove(queue_key, self._queue_key(self.worker_id), "LEFT", "RIGHT")
+            if raw is None:
+                return count
+            self._append(OutboxItem.load(raw))
+            count += 1
+
+    async def _restore(self) -> None:
+        """Забирает уведомления воркеров, которые остановились или перестали продлевать аренду"""
+        try:
+            redis = get_shared_redis()
+            orphans = [OUTBOX_REDIS_KEY]
+            for worker_id in await redis.smembers(OUTBOX_WORKERS_KEY):
+                if worker_id != self.worker_id and not await redis.exists(self._lease_key(worker_id)):
+                    orphans.append(worker_id)
+            restored = 0
+            for worker_id in orphans:
+                queue_key = OUTBOX_REDIS_KEY if worker_id == OUTBOX_REDIS_KEY else self._queue_key(worker_id)
+                restored += await self._adopt(queue_key)
+                if worker_id != OUTBOX_REDIS_KEY:
+                    await redis.srem(OUTBOX_WORKERS_KEY, worker_id)
+        except Exception as e:
+            logger.warning(f"[TelegramOutbox] Не удалось восстановить очередь из Redis: {e}")
+            return
+
+        if restored:
+            self.adopted += restored
+            logger.info(f"[TelegramOutbox] Восстановлено {restored} уведомлений из Redis")
+            self._wakeup.set()
+
+    async def _keep_lease(self) -> None:
+        """Продлевает аренду своего списка и забирает списки остановившихся воркеров"""
+        while True:
+            try:
+                await self._renew_lease()
+            except Exception as e:
+                logger.warning(f"[TelegramOutbox] Не удалось продлить аренду очереди: {e}")
+            await self._restore()
+            await asyncio.sleep(settings.TELEGRAM_OUTBOX_LEASE_SECONDS / 3)
+
+    async def start(self) -> None:
+        if self.running:
+            return
+        if self.persistent:
+            self._lease_task = asyncio.create_task(self._keep_lease())
+        self._task = asyncio.create_task(self._run())
+        logger.info("[TelegramOutbox] Отправитель уведомлений запущен")
+
+    async def stop(self, flush_timeout: float = 5.0) -> None:
+        """Пытается дослать очередь и останавливает отправителя"""
+        if not self.running:
+            return
+        try:
+            await asyncio.wait_for(self._drain(), flush_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"[TelegramOutbox] Не отправлено {self.pending_count()} уведомлений при остановке")
+        self._task.cancel()
+        if self._lease_task is not None:
+            self._lease_task.cancel()
+            await self._release_lease()
+
+    async def _release_lease(self) -> None:
+        """Снимает аренду: остаток очереди сразу заберут другие воркеры"""
+        try:
+            redis = get_shared_redis()
+            await redis.delete(self._lease_key(self.worker_id))
+            if not await redis.llen(self._queue_key(self.worker_id)):
+                await redis.srem(OUTBOX_WORKERS_KEY, self.worker_id)
+        except Exception as e:
+            logger.warning(f"[TelegramOutbox] Не удалось снять аренду очереди: {e}")
+
+    async def _drain(self) -> None:
+        while self._pending or self._in_flight:
+            await asyncio.sleep(0.1)
+
+    async def _run(self) -> None:
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            group_delay = self._group_bucket.delay()
+            if group_delay > 0:
+                await asyncio.sleep(group_delay)
+                continue
+
+            key, thread_delay = None, None
+            for candidate in self._pending:
+                delay = self._thread_bucket(candidate).delay()
+                if delay <= 0:
+                    key = candidate
+                    break
+                thread_delay = delay if thread_delay is None else min(thread_delay, delay)
+            if key is None:
+                # Ждем освобождения лимита треда или нового уведомления в другой тред
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), thread_delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            batch = self._take_batch(key)
+            self._group_bucket.try_acquire()
+            self._thread_bucket(key).try_acquire()
+            self._in_flight += 1
+            try:
+                await self._send_batch(key, batch)
+            finally:
+                self._in_flight -= 1
+
+    async def _send_batch(self, key: str, batch: list[OutboxItem]) -> None:
+        text = "\n".join(item.text for item in batch)
+        thread_id = batch[0].thread_id
+        try:
+            await self._deliver(text, thread_id)
+        except TelegramRetryAfter as e:
+            self.retry_after_hits += 1
+            logger.warning(f"[TelegramOutbox] Лимит Telegram, повтор через {e.retry_after}с (тред {thread_id})")
+            self._group_bucket.pause(e.retry_after)
+            self._requeue(key, batch)
+            return
+        except asyncio.CancelledError:
+            self._requeue(key, batch)
+            raise
+        except Exception as e:
+            attempt = max(item.attempts for item in batch) + 1
+            if attempt < settings.TELEGRAM_OUTBOX_MAX_ATTEMPTS:
+                logger.warning(f"[TelegramOutbox] Ошибка отправки в тред {thread_id} (попытка {attempt}): {e}")
+                for item in batch:
+                    item.attempts = attempt
+                # Откладываем только этот тред, остальные продолжают отправляться
+                self._thread_bucket(key).pause(2 ** attempt)
+                self._requeue(key, batch)
+                return
+            logger.error(f"[TelegramOutbox] ❌ Уведомление в тред {thread_id} не отправлено: {e}")
+            self.failed += len(batch)
+        else:
+            self.sent += 1
+            self.coalesced += len(batch) - 1
+            logger.info(f"[TelegramOutbox] ✅ Отправлено в тред {thread_id} (уведомлений в сообщении: {len(batch)})")
+
+        if self.persistent:
+            self._spawn(self._forget(batch))
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "pending": self.pending_count(),
+            "sent_messages": self.sent,
+            "coalesced_alerts": self.coalesced,
+            "failed_alerts": self.failed,
+            "retry_after_hits": self.retry_after_hits,
+            "adopted_alerts": self.adopted
+        }
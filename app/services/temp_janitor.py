@@ -0,0 +1,146 @@
+import asyncio
+import os
+import time
+from pathlib import Path
+from typing import Optional
+
+from app.services.logs import logger
+
+
+class TempFileJanitor:
+    """
+    Очистка временной директории: удаляет файлы старше max_age и самые старые файлы сверх квоты.
+    Количество и объем файлов считаются инкрементально (track/untrack), периодический обход
+    через os.scandir сверяет счетчики с диском — на случай файлов, брошенных упавшим воркером.
+    """
+
+    def __init__(self, directory: Path, max_age_seconds: int, quota_bytes: int, interval: int, name: str = "TempJanitor"):
+        self.directory = Path(directory)
+        self.max_age_seconds = max_age_seconds
+        self.quota_bytes = quota_bytes
+        self.interval = interval
+        self.name = name
+        self.files = 0
+        self.bytes = 0
+        self.removed_files = 0
+        self.removed_bytes = 0
+        self._active: dict[str, int] = {}  # Файлы в работе: не удаляются по квоте
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def track(self, path, size: int) -> None:
+        """Учитывает файл, который еще пишется или обрабатывается; повторный вызов обновляет размер"""
+        previous = self._active.get(str(path))
+        self._active[str(path)] = size
+        if previous is None:
+            self.files += 1
+            self.bytes += size
+        else:
+            self.bytes += size - previous
+
+    def untrack(self, path) -> None:
+        """Файл удален владельцем"""
+        size = self._active.pop(str(path), None)
+        if size is not None:
+            self.files = max(self.files - 1, 0)
+            self.bytes = max(self.bytes - size, 0)
+
+    async def start(self) -> None:
+        if self.running:
+            return
+        await self.sweep()
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"[{self.name}] Очистка {self.directory} запущена: "
+                    f"файлов {self.files}, {self.bytes / (1024 * 1024):.1f} МБ")
+
+    async def stop(self) -> None:
+        if self.running:
+            self._task.cancel()
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.sweep()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"[{self.name}] Ошибка очистки: {e}")
+
+    async def sweep(self, max_age_seconds: Optional[int] = None) -> int:
+        """Один проход очистки; возвращает число удаленных файлов"""
+        max_age = self.max_age_seconds if max_age_seconds is None else max_age_seconds
+        kept, deleted, total, removed, removed_bytes = await asyncio.to_thread(
+            self._sweep_sync, max_age, set(self._active)
+        )
+        # Активными перестают быть только удаленные обходом файлы: файл, взятый в работу,
+        # пока обход шел в потоке, сохраняет защиту от квоты
+        self._active = {path: size for path, size in self._active.items() if path not in deleted}
+        unseen = {path: size for path, size in self._active.items() if path not in kept}
+        # Сверяем счетчики с диском
+        self.files = len(kept) + len(unseen)
+        self.bytes = total + sum(unseen.values())
+        self.removed_files += removed
+        self.removed_bytes += removed_bytes
+        if removed:
+            logger.info(f"[{self.name}] Удалено {removed} временных файлов ({removed_bytes} байт)")
+        return removed
+
+    def _sweep_sync(self, max_age: int, active: set) -> tuple[set, set, int, int, int]:
+        """(оставшиеся файлы, удаленные файлы, объем оставшихся, число и объем удаленных)"""
+        if not self.directory.exists():
+            return set(), set(), 0, 0, 0
+
+        now = time.time()
+        kept = []
+        deleted = set()
+        removed = removed_bytes = 0
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                try:
+                    if not entry.is_file(follow_symlinks=False):
+                        continue
+                    stat = entry.stat(follow_symlinks=False)
+                    if now - stat.st_mtime > max_age:
+                        os.unlink(entry.path)
+                        deleted.add(entry.path)
+                        removed += 1
+                        removed_bytes += stat.st_size
+                    else:
+                        kept.append((stat.st_mtime, stat.st_size, entry.path))
+                except FileNotFoundError:
+                    continue  # Файл уже удалил владелец
+
+        remaining = {path for _, _, path in kept}
+        total = sum(size for _, size, _ in kept)
+        if total > self.quota_bytes:
+            # Сверх квоты удаляем самые старые файлы, кроме тех, что сейчас в работе
+            for _, size, path in sorted(kept):
+                if total <= self.quota_bytes:
+                    break
+                if path in active:
+                    continue
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                removed += 1
+                removed_bytes += size
+                remaining.discard(path)
+                deleted.add(path)
+
+        return remaining, deleted, total, removed, removed_bytes
+
+    def stats(self) -> dict:
+        return {
+            "directory": str(self.directory),
+            "files": self.files,
+            "bytes": self.bytes,
+            "quota_bytes": self.quota_bytes,
+            "removed_files": self.removed_files,
+            "removed_bytes": self.removed_bytes
+        }
@@ -0,0 +1,295 @@
+import asyncio
+import time
+from typing import Optional
+
+from openai import OpenAI
+
+from app.config import settings, OPENAI_API_KEY
+from app.redis_db import RedisTier
+from app.services.cache import LRUCache
+from app.services.logs import logger
+from app.services.usage_tracker import usage_tracker, usage_tokens
+from db.chat_crud import get_chat_by_id, replace_chat_openai_thread
+
+# Сообщения с остатками товара каждый ход передаются заново — в сводку они не попадают
+CONTEXT_MARKER = "# STOCK AVAILABILITY AND INFORMATION"
+SUMMARY_MARKER = "# CONVERSATION SUMMARY (earlier messages):"
+# Пока чат сжимается, ходы других воркеров ждут новый тред
+COMPACTION_LOCK_TTL = 300
+COMPACTION_POLL_SECONDS = 0.5
+SUMMARY_PROMPT = (
+    "Ты сжимаешь переписку магазина одежды с покупателем на Авито. Выпиши кратко только факты, "
+    "важные для продолжения разговора: рост, вес и параметры клиента, подошедшие или выбранные размеры и цвета, "
+    "оформленные заказы и возвраты, договоренности о доставке и оплате, нерешенные вопросы. "
+    "Не включай наличие и цены товаров — они будут переданы заново. Ответ — список до 10 пунктов."
+)
+
+
+class ThreadCompactor:
+    """
+    Сжатие длинных тредов OpenAI. Для каждого треда хранится число сообщений, prompt_tokens
+    последнего запуска и время последнего хода (Redis, при его недоступности — память процесса).
+    Когда тред превышает THREAD_COMPACT_MAX_MESSAGES или THREAD_COMPACT_MAX_TOKENS либо простаивает
+    дольше THREAD_COMPACT_IDLE_SECONDS, ключевые факты переписки сводятся в короткую сводку,
+    создается новый тред с этой сводкой, а thread_id_openai чата заменяется через compare-and-swap.
+    Сжатие идет под блокировкой чата в Redis; сообщения, добавленные в старый тред после снимка
+    для сводки, переносятся в новый тред до замены.
+    """
+
+    def __init__(self, client: Optional[OpenAI] = None):
+        self.client = client or OpenAI(api_key=OPENAI_API_KEY)
+        self.local = LRUCache(maxsize=settings.CHAT_CACHE_SIZE)
+        self.redis = RedisTier("ThreadCompaction", "состояние тредов в памяти")
+        self._compacting: dict[str, asyncio.Task] = {}  # chat_id -> идущее сжатие
+        self.compactions = 0
+        self.conflicts = 0
+        self.failures = 0
+        self.waits = 0
+
+    @staticmethod
+    def state_key(thread_id: str) -> str:
+        return f"openai_thread:{thread_id}"
+
+    @staticmethod
+    def lock_key(chat_id: str) -> str:
+        return f"thread_compaction:{chat_id}"
+
+    async def get_state(self, thread_id: str) -> Optional[dict]:
+        """{"messages", "prompt_tokens", "last_used"} или None, если тред еще не учитывался"""
+        redis = self.redis.client()
+        if redis is not None:
+            try:
+                raw = await redis.hgetall(self.state_key(thread_id))
+                if raw:
+                    return {"messages": int(raw.get("messages", 0)), "prompt_tokens": int(raw.get("prompt_tokens", 0)),
+                            "last_used": float(raw.get("last_used", 0))}
+                return None
+            except Exception as e:
+                self.redis.mark_down(e)
+        state = self.local.get(thread_id)
+        return dict(state) if state else None
+
+    async def _save_state(self, thread_id: str, state: dict) -> None:
+        self.local.set(thread_id, state)
+        redis = self.redis.client()
+        if redis is None:
+            return
+        try:
+            async with redis.pipeline(transaction=False) as pipe:
+                pipe.hset(self.state_key(thread_id), mapping=state)
+                pipe.expire(self.state_key(thread_id), settings.THREAD_STATE_TTL)
+                await pipe.execute()
+        except Exception as e:
+            self.redis.mark_down(e)
+
+    async def record_turn(self, thread_id: str, messages_added: int, prompt_tokens: Optional[int] = None) -> dict:
+        """Учитывает ход в треде; prompt_tokens последнего запуска — примерный размер треда в токенах"""
+        state = await self.get_state(thread_id) or {"messages": 0, "prompt_tokens": 0, "last_used": 0.0}
+        state["messages"] += messages_added
+        if prompt_tokens:
+            state["prompt_tokens"] = prompt_tokens
+        state["last_used"] = time.time()
+        await self._save_state(thread_id, state)
+        return state
+
+    @staticmethod
+    def compaction_reason(state: dict, now: Optional[float] = None) -> Optional[str]:
+        now = now if now is not None else time.time()
+        if state["messages"] >= settings.THREAD_COMPACT_MAX_MESSAGES:
+            return f"{state['messages']} сообщений"
+        if state["prompt_tokens"] >= settings.THREAD_COMPACT_MAX_TOKENS:
+            return f"{state['prompt_tokens']} токенов"
+        if state["last_used"] and now - state["last_used"] >= settings.THREAD_COMPACT_IDLE_SECONDS:
+            return f"простой {(now - state['last_used']) / 86400:.0f} дн."
+        return None
+
+    async def _initial_state(self, thread_id: str) -> dict:
+        """Тред создан до учета: время последнего хода берем из его последнего сообщения"""
+        page = await asyncio.to_thread(self.client.beta.threads.messages.list, thread_id=thread_id, limit=1,
+                                       order="desc")
+        last_used = float(page.data[0].created_at) if page.data else time.time()
+        state = {"messages": 0, "prompt_tokens": 0, "last_used": last_used}
+        await self._save_state(thread_id, state)
+        return state
+
+    async def before_turn(self, chat_id, thread_id: str) -> str:
+        """Возвращает тред для хода: сжимает текущий, если он вырос или долго простаивал"""
+        key = str(chat_id)
+        if key in self._compacting:
+            # Сжатие уже идет (например, запущено после прошлого хода) — ждем новый тред
+            return await asyncio.shield(self._compacting[key])
+        if await self._locked_elsewhere(key):
+            return await self._wait_for_compaction(key, thread_id)
+        try:
+            state = await self.get_state(thread_id) or await self._initial_state(thread_id)
+        except Exception as e:
+            logger.error(f"[ThreadCompaction] Не удалось получить состояние треда {thread_id}: {e}")
+            return thread_id
+        reason = self.compaction_reason(state)
+        if reason is None:
+            return thread_id
+        return await self._compact_once(key, thread_id, reason)
+
+    async def after_turn(self, chat_id, thread_id: str, messages_added: int, prompt_tokens: Optional[int]) -> None:
+        """Учитывает ход и, если тред превысил лимиты, сжимает его в фоне до следующего сообщения"""
+        try:
+            state = await self.record_turn(thread_id, messages_added, prompt_tokens)
+        except Exception as e:
+            logger.error(f"[ThreadCompaction] Не удалось обновить состояние треда {thread_id}: {e}")
+            return
+        reason = self.compaction_reason(state)
+        if reason is not None and str(chat_id) not in self._compacting:
+            await self._compact_once(str(chat_id), thread_id, reason)
+
+    async def _compact_once(self, chat_id: str, thread_id: str, reason: str) -> str:
+        task = self._compacting.get(chat_id)
+        if task is None:
+            task = asyncio.create_task(self.compact(chat_id, thread_id, reason))
+            self._compacting[chat_id] = task
+            task.add_done_callback(lambda _: self._compacting.pop(chat_id, None))
+        return await asyncio.shield(task)
+
+    async def _lock(self, chat_id: str) -> Optional[bool]:
+        """True — блокировка взята, False — чат уже сжимает другой воркер, None — Redis недоступен"""
+        redis = self.redis.client()
+        if redis is None:
+            return None
+        try:
+            return bool(await redis.set(self.lock_key(chat_id), 1, nx=True, ex=COMPACTION_LOCK_TTL))
+        except Exception as e:
+            self.redis.mark_down(e)
+            return None
+
+    async def _unlock(self, chat_id: str) -> None:
+        redis = self.redis.client()
+        if redis is None:
+            return
+        try:
+            await redis.delete(self.lock_key(chat_id))
+        except Exception as e:
+            self.redis.mark_down(e)
+
+    async def _locked_elsewhere(self, chat_id: str) -> bool:
+        redis = self.redis.client()
+        if redis is None:
+            return False
+        try:
+            return bool(await redis.exists(self.lock_key(chat_id)))
+        except Exception as e:
+            self.redis.mark_down(e)
+            return False
+
+    async def _wait_for_compaction(self, chat_id: str, thread_id: str) -> str:
+        """Дожидается сжатия в другом воркере и возвращает тред чата из БД"""
+        self.waits += 1
+        deadline = time.monotonic() + COMPACTION_LOCK_TTL
+        while time.monotonic() < deadline and await self._locked_elsewhere(chat_id):
+            await asyncio.sleep(COMPACTION_POLL_SECONDS)
+        chat = await get_chat_by_id(chat_id)
+        return getattr(chat, "thread_id_openai", None) or thread_id
+
+    async def summarize(self, messages: list, chat_id: Optional[str] = None) -> str:
+        """Сводка ключевых фактов из сообщений треда (от новых к старым, как их отдает API)"""
+        lines = []
+        for message in reversed(messages):
+            if not message.content:
+                continue
+            text = message.content[0].text.value
+            if CONTEXT_MARKER in text:
+                continue
+            if text.startswith(SUMMARY_MARKER):
+                lines.append(f"Сводка ранее: {text[len(SUMMARY_MARKER):].strip()}")
+                continue
+            lines.append(f"{'Ассистент' if message.role == 'assistant' else 'Клиент'}: {text}")
+        if not lines:
+            return ""
+
+        response = await asyncio.to_thread(
+            self.client.chat.completions.create,
+            model=settings.THREAD_SUMMARY_MODEL,
+            messages=[{"role": "system", "content": SUMMARY_PROMPT}, {"role": "user", "content": "\n".join(lines)}],
+            temperature=0.0
+        )
+        prompt_tokens, completion_tokens = usage_tokens(getattr(response, "usage", None))
+        await usage_tracker.record_summary(chat_id, settings.THREAD_SUMMARY_MODEL, prompt_tokens, completion_tokens)
+        return (response.choices[0].message.content or "").strip()
+
+    async def _copy_newer(self, thread_id: str, new_thread_id: str, snapshot: Optional[str]) -> int:
+        """Переносит в новый тред сообщения, добавленные в старый после снимка для сводки"""
+        options = {"after": snapshot} if snapshot else {}
+        page = await asyncio.to_thread(self.client.beta.threads.messages.list, thread_id=thread_id, order="asc",
+                                       limit=100, **options)
+        copied = 0
+        for message in page.data:
+            if not message.content or CONTEXT_MARKER in message.content[0].text.value:
+                continue
+            await asyncio.to_thread(self.client.beta.threads.messages.create, thread_id=new_thread_id,
+                                    role=message.role, content=message.content[0].text.value)
+            copied += 1
+        return copied
+
+    async def _discard(self, thread_id: str) -> None:
+        try:
+            await asyncio.to_thread(self.client.beta.threads.delete, thread_id)
+        except Exception as e:
+            logger.warning(f"[ThreadCompaction] Не удалось удалить лишний тред {thread_id}: {e}")
+
+    async def compact(self, chat_id: str, thread_id: str, reason: str) -> str:
+        """Создает тред со сводкой и переключает на него чат; при ошибке остается прежний тред"""
+        locked = await self._lock(chat_id)
+        if locked is False:
+            # Этот чат уже сжимает другой воркер
+            return await self._wait_for_compaction(chat_id, thread_id)
+        try:
+            return await self._compact_locked(chat_id, thread_id, reason)
+        finally:
+            if locked:
+                await self._unlock(chat_id)
+
+    async def _compact_locked(self, chat_id: str, thread_id: str, reason: str) -> str:
+        started = time.monotonic()
+        thread = None
+        try:
+            page = await asyncio.to_thread(self.client.beta.threads.messages.list, thread_id=thread_id,
+                                           limit=settings.THREAD_SUMMARY_SOURCE_MESSAGES, order="desc")
+            snapshot = page.data[0].id if page.data else None
+            summary = await self.summarize(page.data, chat_id)
+            options = {"messages": [{"role": "user", "content": f"{SUMMARY_MARKER}\n{summary}"}]} if summary else {}
+            thread = await asyncio.to_thread(self.client.beta.threads.create, **options)
+            # Ход, завершившийся во время сводки, не должен пропасть из переписки
+            copied = await self._copy_newer(thread_id, thread.id, snapshot)
+        except Exception as e:
+            self.failures += 1
+            logger.error(f"[ThreadCompaction] Не удалось сжать тред {thread_id} чата {chat_id}: {e}")
+            if thread is not None:
+                await self._discard(thread.id)
+            return thread_id
+
+        # Тред меняется, только если его не заменил параллельный обработчик
+        if await replace_chat_openai_thread(chat_id, thread_id, thread.id) is None:
+            self.conflicts += 1
+            await self._discard(thread.id)
+            chat = await get_chat_by_id(chat_id)
+            current = getattr(chat, "thread_id_openai", None)
+            logger.info(f"[ThreadCompaction] Тред чата {chat_id} уже заменен другим обработчиком: {current}")
+            return current or thread_id
+
+        await self._save_state(thread.id, {"messages": (1 if summary else 0) + copied, "prompt_tokens": 0,
+                                           "last_used": time.time()})
+        self.compactions += 1
+        logger.info(f"[ThreadCompaction] Тред {thread_id} чата {chat_id} сжат ({reason}) в {thread.id} "
+                    f"за {time.monotonic() - started:.1f}с, сводка: {len(summary)} символов")
+        return thread.id
+
+    def stats(self) -> dict:
+        return {
+            "compactions": self.compactions,
+            "conflicts": self.conflicts,
+            "failures": self.failures,
+            "waits": self.waits,
+            "in_progress": len(self._compacting)
+        }
+
+
+# Создаем глобальный экземпляр
+thread_compactor = ThreadCompactor()
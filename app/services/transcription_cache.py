@@ -0,0 +1,86 @@
+import hashlib
+import json
+from typing import Optional
+
+from app.config import settings
+from app.redis_db import RedisTier
+from app.services.cache import LRUCache
+from app.services.logs import logger
+
+
+def audio_sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class TranscriptionCache:
+    """
+    Кэш распознанных голосовых сообщений: LRU в памяти процесса + Redis.
+    Ключ — voice_id от Авито, а если его нет или он новый — SHA-256 содержимого аудио
+    (повторная доставка вебхука или пересланное голосовое не распознаются заново).
+    Значение: {"text": ..., "duration": ..., "model": ...}
+    """
+
+    def __init__(self):
+        self.local = LRUCache(maxsize=settings.TRANSCRIPTION_CACHE_SIZE)
+        self.redis_ttl = settings.TRANSCRIPTION_CACHE_TTL
+        self.redis_hits = 0
+        self.redis = RedisTier("TranscriptionCache", "работаем без него")
+
+    @staticmethod
+    def voice_key(voice_id: str) -> str:
+        return f"transcription:voice:{voice_id}"
+
+    @staticmethod
+    def content_key(sha256: str) -> str:
+        return f"transcription:sha256:{sha256}"
+
+    async def get(self, key: str) -> Optional[dict]:
+        if not settings.TRANSCRIPTION_CACHE_ENABLED:
+            return None
+
+        value = self.local.get(key)
+        if value is not None:
+            return value
+
+        redis = self.redis.client()
+        if redis is None:
+            return None
+        try:
+            raw = await redis.get(key)
+        except Exception as e:
+            self.redis.mark_down(e)
+            return None
+        if raw is None:
+            return None
+
+        value = json.loads(raw)
+        self.local.set(key, value)
+        self.redis_hits += 1
+        return value
+
+    async def set(self, keys: list[str], text: str, duration: Optional[float], model: str) -> None:
+        """Сохраняет один результат под несколькими ключами (voice_id и хэш аудио)"""
+        if not settings.TRANSCRIPTION_CACHE_ENABLED:
+            return
+        value = {"text": text, "duration": duration, "model": model}
+        for key in keys:
+            self.local.set(key, value)
+
+        redis = self.redis.client()
+        if redis is None:
+            return
+        try:
+            raw = json.dumps(value, ensure_ascii=False)
+            async with redis.pipeline(transaction=False) as pipe:
+                for key in keys:
+                    pipe.set(key, raw, ex=self.redis_ttl)
+                await pipe.execute()
+        except Exception as e:
+            self.redis.mark_down(e)
+
+    def stats(self) -> dict:
+        return {**self.local.stats(), "redis_hits": self.redis_hits}
+
+
+# Создаем глобальный экземпляр
+transcription_cache = TranscriptionCache()
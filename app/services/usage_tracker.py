@@ -0,0 +1,238 @@
+import asyncio
+import datetime
+from collections import Counter, defaultdict
+from typing import Optional
+
+from app.config import settings
+from app.redis_db import RedisTier
+from app.services.logs import logger
+from db.usage_crud import upsert_usage
+
+FLOAT_FIELDS = {"whisper_seconds"}
+
+
+def usage_tokens(usage) -> tuple[int, int]:
+    """(prompt, completion) из usage ответа OpenAI: объект SDK, словарь или None"""
+    if not usage:
+        return 0, 0
+    if isinstance(usage, dict):
+        return int(usage.get("prompt_tokens") or 0), int(usage.get("completion_tokens") or 0)
+    return int(getattr(usage, "prompt_tokens", 0) or 0), int(getattr(usage, "completion_tokens", 0) or 0)
+
+
+class UsageTracker:
+    """
+    Учет расхода OpenAI: токены ходов ассистента и сводок тредов, секунды распознавания Whisper.
+    Дневные счетчики по общему итогу, чату, объявлению, модели и функции хранятся в хэшах Redis
+    (usage:<день>:<scope>:<key>), копия — в памяти процесса на случай недоступности Redis.
+    Раз в USAGE_ROLLUP_INTERVAL итоги за вчера и сегодня записываются в таблицу assistant.usage_daily.
+    """
+
+    def __init__(self):
+        # (день, scope, key) -> счетчики этого процесса
+        self.local: defaultdict[tuple, Counter] = defaultdict(Counter)
+        self._task: Optional[asyncio.Task] = None
+        self.redis = RedisTier("Usage", "счетчики только в памяти")
+        self.turns = 0
+        self.budget_exceeded = 0
+        self.rollups = 0
+        self.skipped_rollups = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    @staticmethod
+    def today() -> str:
+        return datetime.date.today().isoformat()
+
+    @staticmethod
+    def _counter_key(day: str, scope: str, key) -> str:
+        return f"usage:{day}:{scope}:{key}"
+
+    @staticmethod
+    def _index_key(day: str) -> str:
+        return f"usage:{day}:keys"
+
+    async def _add(self, increments: list[tuple[str, str, dict]]) -> None:
+        day = self.today()
+        for scope, key, fields in increments:
+            self.local[(day, scope, str(key))].update(fields)
+
+        redis = self.redis.client()
+        if redis is None:
+            return
+        ttl = settings.USAGE_REDIS_TTL_DAYS * 86400
+        try:
+            async with redis.pipeline(transaction=False) as pipe:
+                for scope, key, fields in increments:
+                    name = self._counter_key(day, scope, key)
+                    for field, value in fields.items():
+                        if field in FLOAT_FIELDS:
+                            pipe.hincrbyfloat(name, field, value)
+                        else:
+                            pipe.hincrby(name, field, value)
+                    pipe.expire(name, ttl)
+                pipe.sadd(self._index_key(day), *[f"{scope}:{key}" for scope, key, _ in increments])
+                pipe.expire(self._index_key(day), ttl)
+                await pipe.execute()
+        except Exception as e:
+            self.redis.mark_down(e)
+
+    async def record_turn(self, chat_id, ad_id, model: Optional[str], prompt_tokens: int, completion_tokens: int,
+                          tools: list[str], seconds: float) -> None:
+        """Учитывает один ход ассистента"""
+        if not settings.USAGE_TRACKING_ENABLED:
+            return
+        self.turns += 1
+        logger.info(f"[Usage] Ход в чате {chat_id}: {prompt_tokens} + {completion_tokens} токенов, "
+                    f"модель {model}, функции {tools or '-'}, {seconds:.2f}с")
+        tokens = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "turns": 1}
+        increments = [("total", "all", tokens), ("chat", chat_id, tokens), ("ad", ad_id, tokens)]
+        if model:
+            increments.append(("model", model, tokens))
+        increments.extend(("tool", tool, {"turns": 1}) for tool in tools)
+        await self._add(increments)
+
+    async def record_summary(self, chat_id, model: str, prompt_tokens: int, completion_tokens: int) -> None:
+        """Учитывает сводку при сжатии треда: токены идут в бюджет чата, но ходом не считаются"""
+        if not settings.USAGE_TRACKING_ENABLED:
+            return
+        tokens = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens}
+        await self._add([("total", "all", tokens), ("chat", chat_id, tokens), ("model", model, tokens)])
+
+    async def record_transcription(self, chat_id, model: str, seconds: Optional[float]) -> None:
+        """Учитывает распознавание через Whisper API (оплачивается по длительности аудио)"""
+        if not settings.USAGE_TRACKING_ENABLED:
+            return
+        fields = {"transcriptions": 1, "whisper_seconds": round(seconds or 0.0, 2)}
+        increments = [("total", "all", fields), ("model", model, fields)]
+        if chat_id:
+            increments.append(("chat", chat_id, fields))
+        await self._add(increments)
+
+    async def chat_tokens(self, chat_id) -> int:
+        """Токены, потраченные на чат за сегодня"""
+        day = self.today()
+        redis = self.redis.client()
+        if redis is not None:
+            try:
+                values = await redis.hmget(self._counter_key(day, "chat", chat_id), "prompt_tokens", "completion_tokens")
+                return sum(int(value or 0) for value in values)
+            except Exception as e:
+                self.redis.mark_down(e)
+        counters = self.local.get((day, "chat", str(chat_id)))
+        return int(counters["prompt_tokens"] + counters["completion_tokens"]) if counters else 0
+
+    async def over_budget(self, chat_id) -> bool:
+        """Чат израсходовал дневной бюджет токенов: дальше дешевая модель и короткая история"""
+        if not settings.CHAT_TOKEN_BUDGET:
+            return False
+        exceeded = await self.chat_tokens(chat_id) >= settings.CHAT_TOKEN_BUDGET
+        if exceeded:
+            self.budget_exceeded += 1
+            logger.warning(f"[Usage] Чат {chat_id} превысил дневной бюджет {settings.CHAT_TOKEN_BUDGET} токенов")
+        return exceeded
+
+    async def collect(self, day: str, local_fallback: bool = True) -> Optional[dict]:
+        """
+        Итоги за день: {(scope, key): {поле: значение}}. Если Redis настроен, но недоступен,
+        без local_fallback возвращает None: счетчики процесса — лишь часть общих итогов.
+        """
+        redis = self.redis.client()
+        if redis is not None:
+            try:
+                members = sorted(await redis.smembers(self._index_key(day)))
+                async with redis.pipeline(transaction=False) as pipe:
+                    for member in members:
+                        scope, key = member.split(":", 1)
+                        pipe.hgetall(self._counter_key(day, scope, key))
+                    values = await pipe.execute() if members else []
+                return {
+                    tuple(member.split(":", 1)): {
+                        field: float(value) if field in FLOAT_FIELDS else int(value) for field, value in counters.items()
+                    }
+                    for member, counters in zip(members, values)
+                }
+            except Exception as e:
+                self.redis.mark_down(e)
+        if self.redis.configured and not local_fallback:
+            return None
+        return {(scope, key): dict(counters) for (counter_day, scope, key), counters in self.local.items()
+                if counter_day == day}
+
+    async def snapshot(self, top: int = 10) -> dict:
+        """Сводка за сегодня для /metrics"""
+        day = self.today()
+        rows = await self.collect(day)
+
+        def tokens(counters: dict) -> int:
+            return counters.get("prompt_tokens", 0) + counters.get("completion_tokens", 0)
+
+        def leaders(scope: str) -> list[dict]:
+            items = [(key, counters) for (row_scope, key), counters in rows.items() if row_scope == scope]
+            items.sort(key=lambda item: tokens(item[1]), reverse=True)
+            return [{"key": key, "total_tokens": tokens(counters), **counters} for key, counters in items[:top]]
+
+        return {
+            "day": day,
+            "total": rows.get(("total", "all"), {}),
+            "models": {key: counters for (scope, key), counters in rows.items() if scope == "model"},
+            "tools": {key: counters.get("turns", 0) for (scope, key), counters in rows.items() if scope == "tool"},
+            "top_chats": leaders("chat"),
+            "top_ads": leaders("ad")
+        }
+
+    async def rollup(self) -> None:
+        """Сводит итоги за вчера и сегодня в Postgres (значения абсолютные, повтор безопасен)"""
+        today = datetime.date.today()
+        days = [today - datetime.timedelta(days=1), today]
+        # Старые дни в памяти больше не нужны
+        keep = {day.isoformat() for day in days}
+        for key in [key for key in self.local if key[0] not in keep]:
+            del self.local[key]
+        for day in days:
+            rows = await self.collect(day.isoformat(), local_fallback=False)
+            if rows is None:
+                # Счетчики одного процесса перезаписали бы в Postgres итоги всех воркеров
+                self.skipped_rollups += 1
+                logger.warning("[Usage] Redis недоступен, сводка в Postgres отложена")
+                return
+            await upsert_usage(day, rows)
+        self.rollups += 1
+
+    async def start(self) -> None:
+        if self.running or not settings.USAGE_TRACKING_ENABLED:
+            return
+        self._task = asyncio.create_task(self._run())
+        logger.info("[Usage] Сводка расхода в Postgres запущена")
+
+    async def stop(self) -> None:
+        if not self.running:
+            return
+        self._task.cancel()
+        try:
+            await self.rollup()
+        except Exception as e:
+            logger.error(f"[Usage] Не удалось сохранить итоги при остановке: {e}")
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(settings.USAGE_ROLLUP_INTERVAL)
+            try:
+                await self.rollup()
+            except Exception as e:
+                logger.error(f"[Usage] Ошибка сводки расхода в Postgres: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "turns": self.turns,
+            "budget_exceeded": self.budget_exceeded,
+            "rollups": self.rollups,
+            "skipped_rollups": self.skipped_rollups
+        }
+
+
+# Создаем глобальный экземпляр
+usage_tracker = UsageTracker()
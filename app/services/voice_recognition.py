@@ -1,13 +1,18 @@
+import asyncio
 import os
 import time
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import Optional, Tuple, Union
 from openai import OpenAI
 
 from app.config import settings, OPENAI_API_KEY
 from app.services.logs import logger
 from app.models.voice_schemas import VoiceError, VoiceErrorCodes, VoiceProcessingResult, VoiceProcessingStatus
-from app.services.audio_downloader import audio_downloader
+from app.services.audio_downloader import audio_downloader, AudioSource
+from app.services.transcription_cache import transcription_cache, audio_sha256
+from app.services.stt_backends import WhisperAPIBackend, local_whisper_backend
+from app.services.audio_preprocessor import audio_preprocessor
+from app.services.usage_tracker import usage_tracker
 
 # Проверяем наличие mutagen для анализа аудио метаданных
 try:
@@ -26,115 +31,144 @@ class VoiceRecognition:
         self.client = OpenAI(api_key=OPENAI_API_KEY)
         self.model = settings.WHISPER_MODEL
         self.max_duration = settings.MAX_AUDIO_DURATION
+        self._transcribe_slots = asyncio.Semaphore(settings.VOICE_MAX_CONCURRENCY)
+        self.api_backend = WhisperAPIBackend(self.client, self.model)
+        self.local_backend = local_whisper_backend
+        self.backend_usage = {self.api_backend.name: 0, self.local_backend.name: 0, "local_fallbacks": 0}
         logger.info(f"[VoiceRecognition] Инициализирован с моделью: {self.model}")
 
-    async def transcribe_audio(self, file_path: str, chat_id: str, message_id: str) -> Tuple[
+    async def transcribe_audio(self, file_path: Union[str, AudioSource], chat_id: str, message_id: str) -> Tuple[
         Optional[str], Optional[VoiceError]]:
         """
         Распознает речь из аудио файла
 
         Args:
-            file_path: Путь к аудио файлу
+            file_path: Путь к аудио файлу или аудио, скачанное в память
             chat_id: ID чата для логирования
             message_id: ID сообщения для логирования
 
         Returns:
             Tuple[transcribed_text, error]: Распознанный текст или ошибка
         """
+        transcribed_text, error, _ = await self._transcribe(file_path, chat_id, message_id)
+        return transcribed_text, error
+
+    async def _transcribe(self, file_path: Union[str, AudioSource], chat_id: str, message_id: str) -> Tuple[
+        Optional[str], Optional[VoiceError], Optional[str]]:
+        """Распознает речь и возвращает вместе с текстом модель, которая его получила"""
         start_time = time.time()
         logger.info(f"[VoiceRecognition] Начинаем распознавание для чата {chat_id}, сообщение {message_id}")
 
+        audio = file_path if isinstance(file_path, AudioSource) else AudioSource.from_path(file_path)
+
         try:
             # Проверяем существование файла
-            if not os.path.exists(file_path):
+            if not audio.exists():
                 error = VoiceError(
                     code=VoiceErrorCodes.DOWNLOAD_FAILED,
                     message=f"Аудио файл не найден: {file_path}"
                 )
-                return None, error
+                return None, error, None
 
-            # Проверяем размер файла
-            file_size = os.path.getsize(file_path)
-            max_size_bytes = settings.MAX_AUDIO_SIZE_MB * 1024 * 1024
-            if file_size > max_size_bytes:
-                size_mb = file_size / (1024 * 1024)
-                error = VoiceError(
-                    code=VoiceErrorCodes.FILE_TOO_LARGE,
-                    message=f"Файл слишком большой: {size_mb:.1f} МБ"
-                )
-                return None, error
+            # Проверяем размер файла (при предобработке — после сжатия)
+            preprocess = audio_preprocessor.enabled
+            size_error = self._check_size(audio)
+            if size_error and not preprocess:
+                return None, size_error, None
 
             # Анализируем метаданные аудио (если доступно)
-            audio_info = await self._analyze_audio_metadata(file_path)
-            if audio_info and audio_info.get("duration"):
-                duration = audio_info["duration"]
-                if duration > self.max_duration:
+            audio_info = await self._analyze_audio_metadata(audio)
+            duration = audio_info.get("duration") if audio_info else None
+            if duration:
+                # Длинные сообщения при предобработке распознаются по частям
+                max_duration = settings.MAX_CHUNKED_AUDIO_DURATION if preprocess else self.max_duration
+                if duration > max_duration:
                     minutes = duration / 60
-                    max_minutes = self.max_duration / 60
+                    max_minutes = max_duration / 60
                     error = VoiceError(
                         code=VoiceErrorCodes.DURATION_TOO_LONG,
                         message=f"Длительность аудио {minutes:.1f} мин превышает лимит {max_minutes:.1f} мин"
                     )
-                    return None, error
+                    return None, error, None
                 logger.info(f"[VoiceRecognition] Длительность аудио: {duration:.1f}с")
 
-            # Отправляем в Whisper API
-            logger.info(f"[VoiceRecognition] Отправляем файл в Whisper API: {file_path}")
-
-            with open(file_path, "rb") as audio_file:
-                try:
-                    response = self.client.audio.transcriptions.create(
-                        model=self.model,
-                        file=audio_file,
-                        language="ru",  # Указываем русский язык для лучшего качества
-                        response_format="text",
-                        temperature=0.0  # Минимальная температура для более точного распознавания
-                    )
-
-                    # Whisper возвращает строку при response_format="text"
-                    transcribed_text = response.strip() if isinstance(response, str) else str(response).strip()
-
-                    if not transcribed_text:
-                        logger.warning(f"[VoiceRecognition] Whisper вернул пустой результат для {message_id}")
+            pieces = [audio]
+            if preprocess:
+                pieces = await audio_preprocessor.prepare(audio, duration)
+                # ffmpeg не справился: исходный файл проходит прежние проверки
+                if pieces[0] is audio:
+                    if size_error:
+                        return None, size_error, None
+                    if duration and duration > self.max_duration:
                         error = VoiceError(
-                            code=VoiceErrorCodes.TRANSCRIPTION_FAILED,
-                            message="Не удалось распознать речь в аудио сообщении"
+                            code=VoiceErrorCodes.DURATION_TOO_LONG,
+                            message=f"Длительность аудио {duration / 60:.1f} мин превышает лимит "
+                                    f"{self.max_duration / 60:.1f} мин"
                         )
-                        return None, error
+                        return None, error, None
+                else:
+                    for piece in pieces:
+                        size_error = self._check_size(piece)
+                        if size_error:
+                            return None, size_error, None
+
+            # Отправляем на распознавание (локальная модель или Whisper API)
+            logger.info(f"[VoiceRecognition] Отправляем файл на распознавание: {audio.filename}, частей: {len(pieces)}")
 
-                    processing_time = time.time() - start_time
-                    logger.info(
-                        f"[VoiceRecognition] Успешно распознано за {processing_time:.2f}с: '{transcribed_text[:50]}...'")
+            try:
+                if len(pieces) == 1:
+                    transcribed_text, model = await self._run_backends(pieces[0], duration, chat_id)
+                else:
+                    # Части распознаются параллельно и склеиваются в исходном порядке
+                    chunk_duration = min(duration, settings.AUDIO_CHUNK_SECONDS)
+                    results = await asyncio.gather(
+                        *(self._run_backends(piece, chunk_duration, chat_id) for piece in pieces)
+                    )
+                    transcribed_text = " ".join(text for text, _ in results if text).strip()
+                    # Части могли распознать разные бэкенды (локальная модель с откатом на API)
+                    model = "+".join(sorted({piece_model for _, piece_model in results}))
 
-                    return transcribed_text, None
+                if not transcribed_text:
+                    logger.warning(f"[VoiceRecognition] Распознавание вернуло пустой результат для {message_id}")
+                    error = VoiceError(
+                        code=VoiceErrorCodes.TRANSCRIPTION_FAILED,
+                        message="Не удалось распознать речь в аудио сообщении"
+                    )
+                    return None, error, None
 
-                except Exception as whisper_error:
-                    logger.error(f"[VoiceRecognition] Ошибка Whisper API: {whisper_error}")
+                processing_time = time.time() - start_time
+                logger.info(
+                    f"[VoiceRecognition] Успешно распознано за {processing_time:.2f}с: '{transcribed_text[:50]}...'")
 
-                    # Анализируем тип ошибки от OpenAI
-                    error_message = str(whisper_error)
-                    if "file size" in error_message.lower():
-                        error = VoiceError(
-                            code=VoiceErrorCodes.FILE_TOO_LARGE,
-                            message="Файл слишком большой для Whisper API"
-                        )
-                    elif "duration" in error_message.lower():
-                        error = VoiceError(
-                            code=VoiceErrorCodes.DURATION_TOO_LONG,
-                            message="Аудио слишком длинное для обработки"
-                        )
-                    elif "format" in error_message.lower():
-                        error = VoiceError(
-                            code=VoiceErrorCodes.UNSUPPORTED_FORMAT,
-                            message="Неподдерживаемый формат аудио файла"
-                        )
-                    else:
-                        error = VoiceError(
-                            code=VoiceErrorCodes.TRANSCRIPTION_FAILED,
-                            message=f"Ошибка распознавания речи: {error_message}"
-                        )
+                return transcribed_text, None, model
 
-                    return None, error
+            except Exception as whisper_error:
+                logger.error(f"[VoiceRecognition] Ошибка Whisper API: {whisper_error}")
+
+                # Анализируем тип ошибки от OpenAI
+                error_message = str(whisper_error)
+                if "file size" in error_message.lower():
+                    error = VoiceError(
+                        code=VoiceErrorCodes.FILE_TOO_LARGE,
+                        message="Файл слишком большой для Whisper API"
+                    )
+                elif "duration" in error_message.lower():
+                    error = VoiceError(
+                        code=VoiceErrorCodes.DURATION_TOO_LONG,
+                        message="Аудио слишком длинное для обработки"
+                    )
+                elif "format" in error_message.lower():
+                    error = VoiceError(
+                        code=VoiceErrorCodes.UNSUPPORTED_FORMAT,
+                        message="Неподдерживаемый формат аудио файла"
+                    )
+                else:
+                    error = VoiceError(
+                        code=VoiceErrorCodes.TRANSCRIPTION_FAILED,
+                        message=f"Ошибка распознавания речи: {error_message}"
+                    )
+
+                return None, error, None
 
         except FileNotFoundError:
             logger.error(f"[VoiceRecognition] Файл не найден: {file_path}")
@@ -142,7 +176,7 @@ class VoiceRecognition:
                 code=VoiceErrorCodes.DOWNLOAD_FAILED,
                 message="Аудио файл не найден"
             )
-            return None, error
+            return None, error, None
 
         except PermissionError:
             logger.error(f"[VoiceRecognition] Нет доступа к файлу: {file_path}")
@@ -150,7 +184,7 @@ class VoiceRecognition:
                 code=VoiceErrorCodes.DOWNLOAD_FAILED,
                 message="Нет доступа к аудио файлу"
             )
-            return None, error
+            return None, error, None
 
         except Exception as e:
             logger.error(f"[VoiceRecognition] Неожиданная ошибка при распознавании: {e}")
@@ -158,17 +192,57 @@ class VoiceRecognition:
                 code=VoiceErrorCodes.TRANSCRIPTION_FAILED,
                 message=f"Неожиданная ошибка: {str(e)}"
             )
-            return None, error
+            return None, error, None
+
+    @staticmethod
+    def _check_size(audio: AudioSource) -> Optional[VoiceError]:
+        max_size_bytes = settings.MAX_AUDIO_SIZE_MB * 1024 * 1024
+        if audio.size > max_size_bytes:
+            return VoiceError(
+                code=VoiceErrorCodes.FILE_TOO_LARGE,
+                message=f"Файл слишком большой: {audio.size / (1024 * 1024):.1f} МБ"
+            )
+        return None
 
-    async def _analyze_audio_metadata(self, file_path: str) -> Optional[dict]:
+    async def _run_backends(self, audio: AudioSource, duration: Optional[float],
+                            chat_id: Optional[str] = None) -> Tuple[str, str]:
+        """
+        Короткие сообщения распознаются локально (если включено), остальные и неудачные — через Whisper API.
+        Возвращает текст и модель бэкенда, который его распознал.
+        """
+        use_local = (
+            settings.STT_BACKEND == "local"
+            and self.local_backend.running
+            and (duration is None or duration <= settings.STT_LOCAL_MAX_DURATION)
+        )
+        if use_local:
+            try:
+                text = await self.local_backend.transcribe(audio)
+                if text:
+                    self.backend_usage[self.local_backend.name] += 1
+                    return text, self.local_backend.model
+                logger.warning("[VoiceRecognition] Локальная модель вернула пустой результат, пробуем Whisper API")
+            except Exception as e:
+                logger.warning(f"[VoiceRecognition] Ошибка локального распознавания, пробуем Whisper API: {e}")
+            self.backend_usage["local_fallbacks"] += 1
+
+        self.backend_usage[self.api_backend.name] += 1
+        text = await self.api_backend.transcribe(audio)
+        await usage_tracker.record_transcription(chat_id, self.api_backend.model, duration)
+        return text, self.api_backend.model
+
+    async def _analyze_audio_metadata(self, file_path: Union[str, AudioSource]) -> Optional[dict]:
         """Анализирует метаданные аудио файла"""
         if not MUTAGEN_AVAILABLE:
             return None
 
+        audio = file_path if isinstance(file_path, AudioSource) else AudioSource.from_path(file_path)
         try:
-            audio_file = MutagenFile(file_path)
+            # Mutagen читает и файл на диске, и буфер в памяти
+            with audio.open() as fileobj:
+                audio_file = MutagenFile(fileobj)
             if audio_file is None:
-                logger.warning(f"[VoiceRecognition] Не удалось проанализировать метаданные: {file_path}")
+                logger.warning(f"[VoiceRecognition] Не удалось проанализировать метаданные: {audio.filename}")
                 return None
 
             info = {
@@ -214,22 +288,36 @@ class VoiceRecognition:
 
             # voice_url здесь на самом деле voice_id
             voice_id = voice_url
-            file_path, download_error = await audio_downloader.download_voice_file(
+
+            # Повторная доставка вебхука: текст уже есть, не скачиваем и не распознаем
+            cached = await transcription_cache.get(transcription_cache.voice_key(voice_id))
+            if cached:
+                logger.info(f"[VoiceRecognition] ✅ Распознанный текст для {voice_id} взят из кэша")
+                return self._cached_result(result, cached, start_time)
+
+            audio, download_error = await audio_downloader.download_voice_file(
                 voice_id, chat_id, message_id, user_id
             )
 
-            if download_error or not file_path:
+            if download_error or not audio:
                 result.status = VoiceProcessingStatus.FAILED
                 result.error_message = download_error.message if download_error else "Неизвестная ошибка скачивания"
                 return result
 
             try:
                 # Сохраняем информацию о файле
-                file_size = os.path.getsize(file_path)
-                result.file_size = file_size
+                result.file_size = audio.size
+
+                # То же аудио могло прийти под другим voice_id (например, пересланное)
+                content_key = transcription_cache.content_key(await asyncio.to_thread(self._audio_sha256, audio))
+                cached = await transcription_cache.get(content_key)
+                if cached:
+                    logger.info(f"[VoiceRecognition] ✅ Аудио {voice_id} уже распознавалось, текст взят из кэша")
+                    await transcription_cache.set([transcription_cache.voice_key(voice_id)], **cached)
+                    return self._cached_result(result, cached, start_time)
 
                 # Анализируем метаданные
-                audio_info = await self._analyze_audio_metadata(file_path)
+                audio_info = await self._analyze_audio_metadata(audio)
                 if audio_info:
                     result.audio_duration = audio_info.get("duration")
 
@@ -237,9 +325,10 @@ class VoiceRecognition:
                 result.status = VoiceProcessingStatus.TRANSCRIBING
                 logger.info(f"[VoiceRecognition] Этап 2: Распознавание речи")
 
-                transcribed_text, transcription_error = await self.transcribe_audio(
-                    file_path, chat_id, message_id
-                )
+                async with self._transcribe_slots:
+                    transcribed_text, transcription_error, model = await self._transcribe(
+                        audio, chat_id, message_id
+                    )
 
                 if transcription_error or not transcribed_text:
                     result.status = VoiceProcessingStatus.FAILED
@@ -251,15 +340,19 @@ class VoiceRecognition:
                 result.transcribed_text = transcribed_text
                 result.processing_time = time.time() - start_time
 
+                await transcription_cache.set(
+                    [transcription_cache.voice_key(voice_id), content_key],
+                    text=transcribed_text, duration=result.audio_duration, model=model
+                )
+
                 logger.info(f"[VoiceRecognition] ✅ Обработка завершена успешно за {result.processing_time:.2f}с")
                 logger.info(f"[VoiceRecognition] Распознанный текст: '{transcribed_text[:100]}...'")
 
                 return result
 
             finally:
-                # Всегда удаляем временный файл
-                if file_path:
-                    await audio_downloader.cleanup_file(file_path)
+                # Всегда удаляем временный файл (если аудио не поместилось в память)
+                await audio_downloader.cleanup_file(audio)
 
         except Exception as e:
             logger.error(f"[VoiceRecognition] Критическая ошибка при обработке: {e}")
@@ -268,23 +361,40 @@ class VoiceRecognition:
             result.processing_time = time.time() - start_time
             return result
 
+    @staticmethod
+    def _audio_sha256(audio: AudioSource) -> str:
+        return audio_sha256(audio.read_bytes())
+
+    @staticmethod
+    def _cached_result(result: VoiceProcessingResult, cached: dict, start_time: float) -> VoiceProcessingResult:
+        result.status = VoiceProcessingStatus.COMPLETED
+        result.transcribed_text = cached["text"]
+        result.audio_duration = cached.get("duration")
+        result.processing_time = time.time() - start_time
+        return result
+
     def is_voice_recognition_enabled(self) -> bool:
         """Проверяет включен ли модуль распознавания голоса"""
         return settings.VOICE_RECOGNITION_ENABLED
 
     async def get_processing_stats(self) -> dict:
         """Возвращает статистику обработки (для мониторинга)"""
-        temp_dir = Path(settings.AUDIO_TEMP_DIR)
-        temp_files_count = len(list(temp_dir.glob("*"))) if temp_dir.exists() else 0
+        temp_files = audio_downloader.janitor.stats()
 
         return {
             "voice_recognition_enabled": self.is_voice_recognition_enabled(),
             "whisper_model": self.model,
             "max_file_size_mb": settings.MAX_AUDIO_SIZE_MB,
             "max_duration_seconds": self.max_duration,
-            "temp_files_count": temp_files_count,
-            "temp_directory": str(temp_dir),
-            "mutagen_available": MUTAGEN_AVAILABLE
+            "temp_files_count": temp_files["files"],
+            "temp_files_bytes": temp_files["bytes"],
+            "temp_directory": temp_files["directory"],
+            "mutagen_available": MUTAGEN_AVAILABLE,
+            "transcription_cache": transcription_cache.stats(),
+            "stt_backend": settings.STT_BACKEND,
+            "local_stt_running": self.local_backend.running,
+            "stt_backend_usage": self.backend_usage,
+            "audio_preprocessing": audio_preprocessor.stats()
         }
 
 
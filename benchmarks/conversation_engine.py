@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Сравнение задержки ответа: треды Assistants API и Chat Completions с локальной историей.
+Запросы идут в реальный API OpenAI (нужны OPENAI_API_KEY и OPENAI_ASSISTANT_ID).
+Использование: python -m benchmarks.conversation_engine [ходов]
+"""
+
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from app.services.chat_engine import ChatCompletionsEngine
+from app.services.openai_assistant import assistant_manager
+
+CONTEXT = """
+# STOCK AVAILABILITY AND INFORMATION: {"id":"7000000000","category":"Куртки","name":"Куртка зимняя","price":"5900",
+"stock":[{"color":"черный","sizes":{"46":"в наличии","48":"в наличии","50":"нет в наличии"},"has_available_sizes":true}]}
+"""
+QUESTIONS = [
+    "Здравствуйте, какие размеры есть в наличии?",
+    "А 50 размер будет?",
+    "Есть ли доставка в Казань?",
+    "Какая длина у куртки?",
+]
+
+
+async def skip_tools(calls):
+    return [{"status": "success", "message": "Benchmark: tool call skipped"} for _ in calls]
+
+
+async def run_assistants(turns: int) -> list[float]:
+    thread = assistant_manager.client.beta.threads.create()
+    timings = []
+    for turn in range(turns):
+        started = time.perf_counter()
+        await assistant_manager._run_thread(thread.id, QUESTIONS[turn % len(QUESTIONS)], CONTEXT, skip_tools)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+async def run_chat_completions(turns: int) -> list[float]:
+    engine = ChatCompletionsEngine()
+    timings = []
+    for turn in range(turns):
+        started = time.perf_counter()
+        await engine.respond("benchmark", f"benchmark-{os.getpid()}", QUESTIONS[turn % len(QUESTIONS)], CONTEXT,
+                             skip_tools)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def report(name: str, timings: list[float]) -> None:
+    p50 = statistics.median(timings)
+    p95 = statistics.quantiles(timings, n=20)[18] if len(timings) > 1 else timings[0]
+    print(f"{name:<18} ходов: {len(timings)}, p50 {p50:.2f} с, p95 {p95:.2f} с, максимум {max(timings):.2f} с")
+
+
+async def main():
+    turns = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    report("assistants", await run_assistants(turns))
+    report("chat_completions", await run_chat_completions(turns))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк парсера листов на большой синтетической таблице.
+Использование: python -m benchmarks.sheet_parser [товаров] [повторов]
+"""
+
+import sys
+import os
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from app.services.google_sheets_api import parse_sheet
+
+HEADERS = ["ID", "Название", "Цена", "Цвет", "42", "44", "46", "48", "50", "52", "54", "Описание", "Фото"]
+COLORS = ["черный", "белый", "синий", "серый"]
+
+
+def build_sheet(products: int, products_per_block: int = 100) -> list:
+    """Лист из блоков по products_per_block товаров, у каждого товара 4 цвета и 2 ID в ячейке"""
+    rows = []
+    for index in range(products):
+        if index % products_per_block == 0:
+            if rows:
+                rows.append([])
+            rows.append(HEADERS)
+        ad_id = 7000000000 + index * 2
+        for color_index, color in enumerate(COLORS):
+            first_cell = f"{ad_id}, {ad_id + 1}" if color_index == 0 else ""
+            sizes = [str((index + color_index + size) % 3) for size in range(7)]
+            rows.append([first_cell, f"Товар {index}", str(1000 + index), color, *sizes,
+                         "Описание товара" if color_index == 0 else "", f"photo_{index}_{color_index}"])
+    return rows
+
+
+def main():
+    products = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    rows = build_sheet(products)
+
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        parsed = parse_sheet(rows, "benchmark")
+        timings.append(time.perf_counter() - started)
+
+    best = min(timings)
+    print(f"Строк: {len(rows)}, товаров: {products}, ID в индексе: {len(parsed)}")
+    print(f"Разбор листа: лучший {best * 1000:.1f} мс, средний {sum(timings) / len(timings) * 1000:.1f} мс")
+    print(f"Строк в секунду: {len(rows) / best:,.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -18,11 +18,14 @@ def event_loop():
 @pytest_asyncio.fixture(scope="function")
 async def clean_db():
     """Очищает БД перед и после каждого теста"""
+    from app.services.chat_cache import chat_cache
+
     # Очищаем БД перед тестом
     async with engine.begin() as conn:
         await conn.execute(
             text("TRUNCATE TABLE assistant.messages, assistant.chat RESTART IDENTITY CASCADE;")
         )
+    await chat_cache.clear()  # TRUNCATE идет мимо CRUD, поэтому кэш чатов сбрасываем вручную
 
     yield
 
@@ -34,6 +37,7 @@ async def clean_db():
             )
     except Exception:
         pass
+    await chat_cache.clear()
 
     # Важно: закрываем все соединения после теста
     await engine.dispose()
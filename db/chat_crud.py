@@ -1,15 +1,22 @@
 import asyncio
 import datetime
+from typing import Optional, List
+from sqlalchemy import update, delete
 from sqlalchemy.exc import SQLAlchemyError
 from db.models import Chat
-from db.db_config import SessionLocal
+from db.db_config import get_session, commit, after_commit, in_unit_of_work
 from sqlalchemy.future import select
+from app.services.chat_cache import chat_cache
 from app.services.logs import logger
 
 
+def _chat_to_row(chat: Chat) -> dict:
+    return {column.name: getattr(chat, column.name) for column in Chat.__table__.columns}
+
+
 async def create_chat(chat_id, thread_id, client_id, user_id, chat_url, under_assistant=True, thread_id_openai=None):
     logger.info(f"[DB] Создание чата {chat_id}")
-    async with SessionLocal() as session:
+    async with get_session() as session:
         try:
             new_chat = Chat(
                 chat_id=str(chat_id),
@@ -23,86 +30,171 @@ async def create_chat(chat_id, thread_id, client_id, user_id, chat_url, under_as
                 updated_at=datetime.datetime.now()
             )
             session.add(new_chat)
-            await session.commit()
+            await commit(session)
+            await after_commit(chat_cache.invalidate, chat_id)
             logger.info(f"[DB] Чат {chat_id} создан")
             return new_chat
         except SQLAlchemyError as e:
             logger.error(f"Ошибка при добавлении чата в БД: {e}")
+            if in_unit_of_work():
+                raise
             await session.rollback()
 
 
 # Read
 async def get_chat_by_id(chat_id):
+    # Внутри unit_of_work читаем из БД: там могут быть ещё не закоммиченные изменения
+    use_cache = not in_unit_of_work()
+    if use_cache:
+        cached = await chat_cache.get(chat_id)
+        if cached is not None:
+            return Chat(**cached)
+        # Версию берем до чтения: если чат изменят, пока идет запрос, устаревшая строка не закэшируется
+        version = await chat_cache.version(chat_id)
+
     logger.info(f"[DB] Получение информации по чату {chat_id}")
-    async with SessionLocal() as session:
+    async with get_session() as session:
         try:
             result = await session.execute(select(Chat).filter_by(chat_id=chat_id))
             chat = result.scalar_one_or_none()
             logger.info(f"[DB] Информация по чату {chat_id} получена")
+            if chat and use_cache:
+                await chat_cache.set(chat_id, _chat_to_row(chat), version)
             return chat
         except SQLAlchemyError as e:
             logger.error(f"Ошибка при получении чата: {e}")
+            if in_unit_of_work():
+                raise
             return None
 
 
 async def update_chat(chat_id, thread_id=None, thread_id_openai=None, client_id=None, user_id=None, under_assistant=None, chat_url=None):
     logger.info(f"Изменение чата {chat_id}")
-    async with SessionLocal() as session:
+    values = {
+        "thread_id": thread_id,  # Telegram thread ID
+        "thread_id_openai": thread_id_openai,  # OpenAI thread ID
+        "client_id": client_id,
+        "user_id": user_id,
+        "chat_url": chat_url,
+        "under_assistant": under_assistant,
+    }
+    values = {column: value for column, value in values.items() if value is not None}
+    values["updated_at"] = datetime.datetime.now()
+
+    async with get_session() as session:
         try:
-            chat = await session.get(Chat, chat_id)  # Получаем объект внутри сессии
-            if chat:
-                if thread_id is not None:
-                    chat.thread_id = thread_id  # Telegram thread ID
-                if thread_id_openai is not None:
-                    chat.thread_id_openai = thread_id_openai  # OpenAI thread ID
-                if client_id is not None:
-                    chat.client_id = client_id
-                if user_id is not None:
-                    chat.user_id = user_id
-                if chat_url is not None:
-                    chat.chat_url = chat_url
-                if under_assistant is not None:
-                    chat.under_assistant = under_assistant
-                chat.updated_at = datetime.datetime.now()
-
-                await session.merge(chat)  # Обновляем объект в сессии
-                await session.commit()
+            # Один UPDATE ... RETURNING вместо SELECT + merge
+            result = await session.execute(
+                update(Chat).where(Chat.chat_id == str(chat_id)).values(**values).returning(Chat)
+            )
+            chat = result.scalar_one_or_none()
+            await commit(session)
+            await after_commit(chat_cache.invalidate, chat_id)
             return chat
         except SQLAlchemyError as e:
             logger.error(f"Ошибка при обновлении чата: {e} - {getattr(e, 'orig', 'Нет доп. информации')}")
+            if in_unit_of_work():
+                raise
             await session.rollback()
 
 
 # Delete
 async def delete_chat(chat_id):
-    async with SessionLocal() as session:
+    async with get_session() as session:
         try:
-            chat = await get_chat_by_id(chat_id)
-            if chat:
-                await session.delete(chat)
-                await session.commit()
+            result = await session.execute(delete(Chat).where(Chat.chat_id == str(chat_id)).returning(Chat))
+            chat = result.scalar_one_or_none()
+            await commit(session)
+            await after_commit(chat_cache.invalidate, chat_id)
             return chat
         except SQLAlchemyError as e:
             logger.error(f"Ошибка при удалении чата: {e}")
+            if in_unit_of_work():
+                raise
             await session.rollback()
 
 
-async def update_chat_by_thread(thread_id: int, under_assistant: bool) -> None:
+async def update_chat_by_thread(thread_id: int, under_assistant: bool) -> Optional[Chat]:
     """Обновляет информацию о чате в БД по thread_id (Telegram thread ID)."""
-    async with SessionLocal() as session:
+    async with get_session() as session:
         try:
-            result = await session.execute(select(Chat).where(Chat.thread_id == thread_id).limit(1))
-            chat = result.scalars().first()
+            # Как и раньше, меняем только один чат с этим thread_id, но одним запросом
+            target_chat_id = select(Chat.chat_id).where(Chat.thread_id == thread_id).limit(1).scalar_subquery()
+            result = await session.execute(
+                update(Chat)
+                .where(Chat.chat_id == target_chat_id)
+                .values(under_assistant=under_assistant, updated_at=datetime.datetime.now())
+                .returning(Chat)
+            )
+            chat = result.scalar_one_or_none()
+            await commit(session)
 
             if chat:
-                chat.under_assistant = under_assistant
-                chat.updated_at = datetime.datetime.now()
-
-                await session.commit()
+                await after_commit(chat_cache.invalidate, chat.chat_id)
                 logger.info(f"Чат {thread_id} обновлен: under_assistant={under_assistant}")
             else:
                 logger.warning(f"Чат с thread_id={thread_id} не найден в базе данных")
+            return chat
 
         except SQLAlchemyError as e:
             logger.error(f"Ошибка обновления чата {thread_id}: {e}")
-            await session.rollback()
\ No newline at end of file
+            if in_unit_of_work():
+                raise
+            await session.rollback()
+
+
+async def fill_chat_thread(chat_id, thread_id: int) -> Optional[Chat]:
+    """Проставляет Telegram thread_id чату, у которого топик еще не создан"""
+    async with get_session() as session:
+        try:
+            result = await session.execute(
+                update(Chat)
+                .where(Chat.chat_id == str(chat_id), Chat.thread_id.is_(None))
+                .values(thread_id=thread_id, updated_at=datetime.datetime.now())
+                .returning(Chat)
+            )
+            chat = result.scalar_one_or_none()
+            await commit(session)
+            await after_commit(chat_cache.invalidate, chat_id)
+            return chat
+        except SQLAlchemyError as e:
+            logger.error(f"Ошибка при сохранении thread_id чата {chat_id}: {e}")
+            if in_unit_of_work():
+                raise
+            await session.rollback()
+
+
+async def replace_chat_openai_thread(chat_id, expected_thread_id: str, new_thread_id: str) -> Optional[Chat]:
+    """
+    Заменяет OpenAI thread чата, только если в БД все еще expected_thread_id (compare-and-swap).
+    None — тред уже заменил другой процесс
+    """
+    async with get_session() as session:
+        try:
+            result = await session.execute(
+                update(Chat)
+                .where(Chat.chat_id == str(chat_id), Chat.thread_id_openai == expected_thread_id)
+                .values(thread_id_openai=new_thread_id, updated_at=datetime.datetime.now())
+                .returning(Chat)
+            )
+            chat = result.scalar_one_or_none()
+            await commit(session)
+            await after_commit(chat_cache.invalidate, chat_id)
+            return chat
+        except SQLAlchemyError as e:
+            logger.error(f"Ошибка при замене OpenAI thread чата {chat_id}: {e}")
+            if in_unit_of_work():
+                raise
+            await session.rollback()
+
+async def get_chats_without_thread() -> List[Chat]:
+    """Чаты, для которых топик в Telegram еще не создан"""
+    async with get_session() as session:
+        try:
+            result = await session.execute(select(Chat).where(Chat.thread_id.is_(None)))
+            return list(result.scalars().all())
+        except SQLAlchemyError as e:
+            logger.error(f"Ошибка при получении чатов без топика: {e}")
+            if in_unit_of_work():
+                raise
+            return []
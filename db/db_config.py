@@ -1,16 +1,176 @@
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Awaitable, Callable, Optional
+
 from sqlalchemy.ext.declarative import declarative_base
-from app.config import DATABASE_URL
+from app.config import DATABASE_URL, settings
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 Base = declarative_base()
 
+
+class PoolMetrics:
+    """Метрики ожидания соединения из пула"""
+
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record(self, wait: float, timed_out: bool = False) -> None:
+        self.checkouts += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        if timed_out:
+            self.timeouts += 1
+
+    def snapshot(self) -> dict:
+        return {
+            "checkouts": self.checkouts,
+            "timeouts": self.timeouts,
+            "avg_wait_ms": round(self.total_wait / self.checkouts * 1000, 3) if self.checkouts else 0.0,
+            "max_wait_ms": round(self.max_wait * 1000, 3),
+        }
+
+
+pool_metrics = PoolMetrics()
+
+
+class MeteredQueuePool(AsyncAdaptedQueuePool):
+    """Пул соединений, замеряющий время ожидания соединения"""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            pool_metrics.record(time.perf_counter() - start, timed_out=True)
+            raise
+        pool_metrics.record(time.perf_counter() - start)
+        return connection
+
+
+engine_options = {
+    "future": True,
+    "echo": False,
+    "poolclass": MeteredQueuePool,
+    "pool_size": settings.DB_POOL_SIZE,
+    "max_overflow": settings.DB_MAX_OVERFLOW,
+    "pool_timeout": settings.DB_POOL_TIMEOUT,
+    "pool_recycle": settings.DB_POOL_RECYCLE,
+    "pool_pre_ping": settings.DB_POOL_PRE_PING,
+}
+
+# Кэш подготовленных выражений поддерживается только драйвером asyncpg
+if DATABASE_URL and "+asyncpg" in DATABASE_URL:
+    engine_options["connect_args"] = {
+        "prepared_statement_cache_size": settings.DB_PREPARED_STATEMENT_CACHE_SIZE
+    }
+
 # Создаем асинхронный движок
-engine = create_async_engine(DATABASE_URL, future=True, echo=False)
+engine = create_async_engine(DATABASE_URL, **engine_options)
 
 # Создаем фабрику сессий
 SessionLocal = sessionmaker(
     bind=engine,
     class_=AsyncSession,
     expire_on_commit=False
-)
\ No newline at end of file
+)
+
+
+class _UnitOfWork:
+    """Сессия, общая для всех CRUD-вызовов внутри unit_of_work()"""
+
+    def __init__(self, session: AsyncSession):
+        self.session: Optional[AsyncSession] = session
+        self.after_commit: list[tuple[Callable[..., Awaitable], tuple]] = []
+
+
+# Задачи, созданные внутри unit_of_work, наследуют контекст, поэтому
+# по завершении блока сессия обнуляется у самого объекта, а не только в ContextVar
+_current_uow: ContextVar[Optional[_UnitOfWork]] = ContextVar("current_uow", default=None)
+
+
+def _active_session() -> Optional[AsyncSession]:
+    uow = _current_uow.get()
+    return uow.session if uow else None
+
+
+@asynccontextmanager
+async def unit_of_work():
+    """
+    Единая сессия и транзакция для последовательности CRUD-вызовов (например, одного вебхука).
+    Внутри блока CRUD-функции не коммитят, а делают flush; коммит выполняется при выходе.
+    Ошибки SQLAlchemy CRUD-функции внутри блока не глотают, а пробрасывают — транзакция откатывается целиком.
+    """
+    session = _active_session()
+    if session is not None:
+        # Вложенный вызов — переиспользуем внешнюю транзакцию
+        yield session
+        return
+
+    async with SessionLocal() as session:
+        uow = _UnitOfWork(session)
+        token = _current_uow.set(uow)
+        try:
+            yield session
+            await session.commit()
+        except Exception:
+            await session.rollback()
+            raise
+        finally:
+            uow.session = None
+            _current_uow.reset(token)
+
+        for callback, args in uow.after_commit:
+            await callback(*args)
+
+
+@asynccontextmanager
+async def get_session():
+    """Возвращает сессию текущего unit_of_work или открывает новую"""
+    session = _active_session()
+    if session is not None:
+        yield session
+        return
+
+    async with SessionLocal() as session:
+        yield session
+
+
+async def commit(session: AsyncSession) -> None:
+    """Коммит вне unit_of_work, flush — внутри него"""
+    if session is _active_session():
+        await session.flush()
+    else:
+        await session.commit()
+
+
+def in_unit_of_work() -> bool:
+    return _active_session() is not None
+
+
+async def after_commit(callback: Callable[..., Awaitable], *args) -> None:
+    """Выполняет callback после коммита unit_of_work или сразу, если транзакции нет"""
+    uow = _current_uow.get()
+    if uow is not None and uow.session is not None:
+        uow.after_commit.append((callback, args))
+    else:
+        await callback(*args)
+
+
+def get_pool_stats() -> dict:
+    """Возвращает состояние пула соединений (для мониторинга)"""
+    pool = engine.sync_engine.pool
+    return {
+        "pool_size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+        "checked_in": pool.checkedin(),
+        **pool_metrics.snapshot()
+    }
@@ -1,13 +1,13 @@
 import datetime
 from sqlalchemy.future import select
 from sqlalchemy.exc import SQLAlchemyError
-from db.db_config import SessionLocal
+from db.db_config import get_session, commit, in_unit_of_work
 from db.models import Escalations
 from app.services.logs import logger
 
 # Create
 async def create_escalation(chat_id, client_id, client_name, chat_url, reason):
-    async with SessionLocal() as session:
+    async with get_session() as session:
         try:
             new_escalation = Escalations(
                 chat_id=str(chat_id),
@@ -19,26 +19,30 @@ async def create_escalation(chat_id, client_id, client_name, chat_url, reason):
                 updated_at=datetime.datetime.now()
             )
             session.add(new_escalation)
-            await session.commit()
+            await commit(session)
             return new_escalation
         except SQLAlchemyError as e:
             logger.error(f"Ошибка при добавлении эскалации: {e}")
+            if in_unit_of_work():
+                raise
             await session.rollback()
 
 # Read
 async def get_escalation_by_id(escalation_id):
-    async with SessionLocal() as session:
+    async with get_session() as session:
         try:
             result = await session.execute(select(Escalations).filter_by(id=escalation_id))
             escalation = result.scalar_one_or_none()
             return escalation
         except SQLAlchemyError as e:
             logger.error(f"Ошибка при получении эскалации: {e}")
+            if in_unit_of_work():
+                raise
             return None
 
 # Update escalation
 async def update_escalation(escalation_id, chat_id=None, client_id=None, client_name=None, chat_url=None, reason=None):
-    async with SessionLocal() as session:
+    async with get_session() as session:
         try:
             escalation = await session.get(Escalations, escalation_id)  # Загружаем объект внутри сессии
             if escalation:
@@ -55,21 +59,25 @@ async def update_escalation(escalation_id, chat_id=None, client_id=None, client_
                 escalation.updated_at = datetime.datetime.now()
 
                 await session.merge(escalation)  # Обновляем объект в сессии
-                await session.commit()
+                await commit(session)
             return escalation
         except SQLAlchemyError as e:
             logger.error(f"Ошибка при обновлении эскалации: {e} - {getattr(e, 'orig', 'Нет доп. информации')}")
+            if in_unit_of_work():
+                raise
             await session.rollback()
 
 # Delete
 async def delete_escalation(escalation_id):
-    async with SessionLocal() as session:
+    async with get_session() as session:
         try:
             escalation = await get_escalation_by_id(escalation_id)
             if escalation:
                 await session.delete(escalation)
-                await session.commit()
+                await commit(session)
             return escalation
         except SQLAlchemyError as e:
             logger.error(f"Ошибка при удалении эскалации: {e}")
+            if in_unit_of_work():
+                raise
             await session.rollback()
\ No newline at end of file
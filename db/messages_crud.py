@@ -1,14 +1,15 @@
-from db.db_config import SessionLocal
+from db.db_config import get_session, commit, in_unit_of_work
 from db.models import Messages
 from app.services.logs import logger
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy import func
 from sqlalchemy.future import select
 import datetime
 
 # Create
 async def create_message(chat_id, author_id, from_assistant=False, message=None):
     logger.info(f"[DB] Создание сообщения в чате {chat_id}, от {author_id}")
-    async with SessionLocal() as session:
+    async with get_session() as session:
         try:
             new_message = Messages(
                 chat_id=str(chat_id),
@@ -19,17 +20,19 @@ async def create_message(chat_id, author_id, from_assistant=False, message=None)
                 updated_at=datetime.datetime.now()
             )
             session.add(new_message)
-            await session.commit()
+            await commit(session)
             logger.info(f"[DB] Сообщение создано в чате {chat_id}, от {author_id}")
             return new_message
         except SQLAlchemyError as e:
             logger.error(f"Ошибка при добавлении сообщения: {e}")
+            if in_unit_of_work():
+                raise
             await session.rollback()
 
 # Read
 async def get_latest_message_by_chat_id_and_author_id(chat_id, author_id):
     logger.info(f"[DB] Получение последнего сообщения из БД для чата {chat_id} и пользователя {author_id}")
-    async with SessionLocal() as session:
+    async with get_session() as session:
         try:
             result = await session.execute(
                 select(Messages.message)
@@ -44,11 +47,32 @@ async def get_latest_message_by_chat_id_and_author_id(chat_id, author_id):
             return latest_message
         except SQLAlchemyError as e:
             logger.error(f"[DB] Ошибка при получении сообщения: {e} - {getattr(e, 'orig', 'Нет доп. информации')}")
+            if in_unit_of_work():
+                raise
+            return None
+
+async def count_messages_by_chat_id_and_author_id(chat_id, author_id):
+    """Число сообщений автора в чате; None при ошибке БД"""
+    async with get_session() as session:
+        try:
+            result = await session.execute(
+                select(func.count())
+                .select_from(Messages)
+                .filter(
+                    Messages.chat_id == str(chat_id),
+                    Messages.author_id == str(author_id)
+                )
+            )
+            return result.scalar_one()
+        except SQLAlchemyError as e:
+            logger.error(f"[DB] Ошибка при подсчете сообщений: {e} - {getattr(e, 'orig', 'Нет доп. информации')}")
+            if in_unit_of_work():
+                raise
             return None
 
 # Update
 async def update_message(message_id, chat_id=None, author_id=None, from_assistant=None, message=None):
-    async with SessionLocal() as session:
+    async with get_session() as session:
         try:
             message_record = await session.get(Messages, message_id)  # Загружаем объект в сессию
             if message_record:
@@ -63,10 +87,12 @@ async def update_message(message_id, chat_id=None, author_id=None, from_assistan
                 message_record.updated_at = datetime.datetime.now()
 
                 await session.merge(message_record)  # Обновляем объект в сессии
-                await session.commit()
+                await commit(session)
             return message_record
         except SQLAlchemyError as e:
             logger.error(f"Ошибка при обновлении сообщения: {e} - {getattr(e, 'orig', 'Нет доп. информации')}")
+            if in_unit_of_work():
+                raise
             await session.rollback()
 # Messages
 async def get_messages_by_chat_id(chat_id):
@@ -74,7 +100,7 @@ async def get_messages_by_chat_id(chat_id):
     from sqlalchemy.future import select
     from db.models import Messages
 
-    async with SessionLocal() as session:
+    async with get_session() as session:
         try:
             result = await session.execute(
                 select(Messages)
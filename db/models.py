@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Boolean, Integer, DateTime
+from sqlalchemy import Column, String, Boolean, Integer, BigInteger, Float, Date, DateTime, UniqueConstraint
 from db.db_config import Base
 
 class Chat(Base):
@@ -6,7 +6,7 @@ class Chat(Base):
     __table_args__ = {'schema': 'assistant'}
 
     chat_id = Column(String, primary_key=True)
-    thread_id = Column(Integer, default=0)  # Telegram thread ID
+    thread_id = Column(Integer, default=0, index=True)  # Telegram thread ID (индекс для /turn_on, /turn_off)
     thread_id_openai = Column(String)  # OpenAI thread ID (new column)
     client_id = Column(String)  # Идентификатор клиента
     user_id = Column(String)  # Идентификатор владельца аккаунта
@@ -70,4 +70,24 @@ class Escalations(Base):
     chat_url = Column(String)
     reason = Column(String)
     updated_at = Column(DateTime)
-    created_at = Column(DateTime)
\ No newline at end of file
+    created_at = Column(DateTime)
+
+
+class UsageDaily(Base):
+    """Дневные итоги расхода OpenAI (сводятся из счетчиков Redis)"""
+    __tablename__ = 'usage_daily'
+    __table_args__ = (
+        UniqueConstraint('day', 'scope', 'key', name='uq_usage_daily_day_scope_key'),
+        {'schema': 'assistant'}
+    )
+
+    id = Column(Integer, primary_key=True)
+    day = Column(Date, nullable=False)
+    scope = Column(String, nullable=False)  # total, chat, ad, model или tool
+    key = Column(String, nullable=False)  # chat_id, ad_id, имя модели или функции
+    prompt_tokens = Column(BigInteger, default=0)
+    completion_tokens = Column(BigInteger, default=0)
+    turns = Column(Integer, default=0)  # Для scope=tool — число вызовов функции
+    transcriptions = Column(Integer, default=0)
+    whisper_seconds = Column(Float, default=0)
+    updated_at = Column(DateTime)
@@ -1,13 +1,13 @@
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.future import select
 import datetime
-from db.db_config import SessionLocal
+from db.db_config import get_session, commit, in_unit_of_work
 from db.models import Orders
 from app.services.logs import logger
 
 # Create
 async def create_order(chat_id, client_id, client_name, color, size, good_url, good_name):
-    async with SessionLocal() as session:
+    async with get_session() as session:
         try:
             new_order = Orders(
                 chat_id=str(chat_id),
@@ -21,27 +21,31 @@ async def create_order(chat_id, client_id, client_name, color, size, good_url, g
                 updated_at=datetime.datetime.now()
             )
             session.add(new_order)
-            await session.commit()
+            await commit(session)
             return new_order
         except SQLAlchemyError as e:
             logger.error(f"Ошибка при добавлении заказа: {e}")
+            if in_unit_of_work():
+                raise
             await session.rollback()
 
 # Read
 async def get_order_by_id(order_id):
-    async with SessionLocal() as session:
+    async with get_session() as session:
         try:
             result = await session.execute(select(Orders).filter_by(id=order_id))
             order = result.scalar_one_or_none()
             return order
         except SQLAlchemyError as e:
             logger.error(f"Ошибка при получении заказа: {e}")
+            if in_unit_of_work():
+                raise
             return None
 
 # Update
 # Update order
 async def update_order(order_id, chat_id=None, client_id=None, client_name=None, color=None, size=None, good_url=None):
-    async with SessionLocal() as session:
+    async with get_session() as session:
         try:
             order = await session.get(Orders, order_id)  # Загружаем объект в сессию
             if order:
@@ -60,21 +64,25 @@ async def update_order(order_id, chat_id=None, client_id=None, client_name=None,
                 order.updated_at = datetime.datetime.now()
 
                 await session.merge(order)  # Обновляем объект в сессии
-                await session.commit()
+                await commit(session)
             return order
         except SQLAlchemyError as e:
             logger.error(f"Ошибка при обновлении заказа: {e} - {getattr(e, 'orig', 'Нет доп. информации')}")
+            if in_unit_of_work():
+                raise
             await session.rollback()
 
 # Delete
 async def delete_order(order_id):
-    async with SessionLocal() as session:
+    async with get_session() as session:
         try:
             order = await get_order_by_id(order_id)
             if order:
                 await session.delete(order)
-                await session.commit()
+                await commit(session)
             return order
         except SQLAlchemyError as e:
             logger.error(f"Ошибка при удалении заказа: {e}")
+            if in_unit_of_work():
+                raise
             await session.rollback()
\ No newline at end of file
@@ -1,13 +1,13 @@
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.future import select
 import datetime
-from db.db_config import SessionLocal
+from db.db_config import get_session, commit, in_unit_of_work
 from db.models import Returns
 from app.services.logs import logger
 
 # Create
 async def create_return(chat_id, client_id, client_name, reason, good_url):
-    async with SessionLocal() as session:
+    async with get_session() as session:
         try:
             new_return = Returns(
                 chat_id=str(chat_id),
@@ -19,26 +19,30 @@ async def create_return(chat_id, client_id, client_name, reason, good_url):
                 updated_at=datetime.datetime.now()
             )
             session.add(new_return)
-            await session.commit()
+            await commit(session)
             return new_return
         except SQLAlchemyError as e:
             logger.error(f"Ошибка при добавлении возврата: {e}")
+            if in_unit_of_work():
+                raise
             await session.rollback()
 
 # Read
 async def get_return_by_id(return_id):
-    async with SessionLocal() as session:
+    async with get_session() as session:
         try:
             result = await session.execute(select(Returns).filter_by(id=return_id))
             return_record = result.scalar_one_or_none()
             return return_record
         except SQLAlchemyError as e:
             logger.error(f"Ошибка при получении возврата: {e}")
+            if in_unit_of_work():
+                raise
             return None
 
 # Update
 async def update_return(return_id, chat_id=None, client_id=None, client_name=None, reason=None, good_url=None):
-    async with SessionLocal() as session:
+    async with get_session() as session:
         try:
             return_record = await session.get(Returns, return_id)  # Загружаем объект в сессию
             if return_record:
@@ -55,21 +59,25 @@ async def update_return(return_id, chat_id=None, client_id=None, client_name=Non
                 return_record.updated_at = datetime.datetime.now()
 
                 await session.merge(return_record)  # Обновляем объект в сессии
-                await session.commit()
+                await commit(session)
             return return_record
         except SQLAlchemyError as e:
             logger.error(f"Ошибка при обновлении возврата: {e} - {getattr(e, 'orig', 'Нет доп. информации')}")
+            if in_unit_of_work():
+                raise
             await session.rollback()
 
 # Delete
 async def delete_return(return_id):
-    async with SessionLocal() as session:
+    async with get_session() as session:
         try:
             return_record = await get_return_by_id(return_id)
             if return_record:
                 await session.delete(return_record)
-                await session.commit()
+                await commit(session)
             return return_record
         except SQLAlchemyError as e:
             logger.error(f"Ошибка при удалении возврата: {e}")
+            if in_unit_of_work():
+                raise
             await session.rollback()
\ No newline at end of file
@@ -0,0 +1,39 @@
+import datetime
+
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import SQLAlchemyError
+
+from db.db_config import get_session, commit, in_unit_of_work
+from db.models import UsageDaily
+from app.services.logs import logger
+
+USAGE_FIELDS = ("prompt_tokens", "completion_tokens", "turns", "transcriptions", "whisper_seconds")
+
+
+# Create / Update
+async def upsert_usage(day: datetime.date, rows: dict) -> None:
+    """Записывает дневные итоги; rows — {(scope, key): {поле: значение}}. Значения абсолютные, повтор безопасен"""
+    if not rows:
+        return
+    now = datetime.datetime.now()
+    values = [
+        {"day": day, "scope": scope, "key": key, "updated_at": now,
+         **{field: counters.get(field, 0) for field in USAGE_FIELDS}}
+        for (scope, key), counters in rows.items()
+    ]
+    async with get_session() as session:
+        try:
+            # Пачками: у Postgres ограничение на число параметров запроса
+            for start in range(0, len(values), 1000):
+                statement = insert(UsageDaily).values(values[start:start + 1000])
+                statement = statement.on_conflict_do_update(
+                    index_elements=["day", "scope", "key"],
+                    set_={field: statement.excluded[field] for field in (*USAGE_FIELDS, "updated_at")}
+                )
+                await session.execute(statement)
+            await commit(session)
+        except SQLAlchemyError as e:
+            logger.error(f"[DB] Ошибка при сохранении итогов расхода за {day}: {e}")
+            if in_unit_of_work():
+                raise
+            await session.rollback()
@@ -29,7 +29,7 @@ async def quick_test(url=None):
             if result:
                 print("✅ Найдено!")
                 await asyncio.sleep(10)
-                print(result)
+                print(result.prompt)
             else:
                 print("❌ Не найдено")
             print("-" * 50)
@@ -39,12 +39,12 @@ async def quick_test(url=None):
 
         if result:
             print("\n✅ Результат:")
-            print(result)
+            print(result.prompt)
 
             # Сохраняем в файл
             filename = "test_result.json"
             with open(filename, 'w', encoding='utf-8') as f:
-                f.write(result)
+                f.write(result.prompt)
             print(f"\n💾 Сохранено в {filename}")
         else:
             print("\n❌ Данные не найдены")
@@ -1,6 +1,8 @@
 import asyncio
 import tempfile
+from contextlib import contextmanager
 from pathlib import Path
+from types import SimpleNamespace
 
 import pytest
 from httpx import AsyncClient
@@ -19,8 +21,23 @@ from freezegun import freeze_time
 from httpx import AsyncClient
 
 
+def without_redis():
+    """Сервисы работают только на памяти процесса"""
+    return patch('app.redis_db.is_redis_configured', return_value=False)
 
 
+@contextmanager
+def redis_tier(tier, redis):
+    """Redis сервиса настроен, а client() отдает заданный клиент (None — Redis недоступен)"""
+    with patch('app.redis_db.is_redis_configured', return_value=True), \
+            patch.object(tier, 'client', return_value=redis):
+        yield redis
+
+
+def thread_message(id, role, text):
+    """Сообщение треда Assistants API"""
+    return SimpleNamespace(id=id, role=role, content=[SimpleNamespace(text=SimpleNamespace(value=text))])
+
 
 # ==================== НОЧНОЕ ВРЕМЯ (22:00 - 10:00) ====================
 #
@@ -1468,6 +1485,57 @@ async def test_chat_crud_operations(clean_db):
     assert chat is None
 
 
+@pytest.mark.asyncio
+async def test_update_chat_by_thread(clean_db):
+    """Тест переключения бота по Telegram треду одним UPDATE"""
+    from db.chat_crud import create_chat, update_chat_by_thread
+
+    chat_id = "test_thread_update"
+    chat_url = f'https://www.avito.ru/profile/messenger/channel/{chat_id}'
+    await create_chat(chat_id, 777, "author1", "user1", chat_url, under_assistant=True)
+
+    updated = await update_chat_by_thread(777, False)
+    assert updated is not None
+    assert updated.chat_id == chat_id
+    assert (await get_chat_by_id(chat_id)).under_assistant is False
+
+    assert await update_chat_by_thread(778, True) is None
+
+
+@pytest.mark.asyncio
+async def test_unit_of_work(clean_db):
+    """Тест unit_of_work: CRUD-вызовы внутри блока идут в одной транзакции"""
+    from db.chat_crud import create_chat, update_chat
+    from db.db_config import unit_of_work, get_pool_stats
+
+    chat_id = "test_uow"
+    chat_url = f'https://www.avito.ru/profile/messenger/channel/{chat_id}'
+    async with unit_of_work():
+        await create_chat(chat_id, 123, "author1", "user1", chat_url, under_assistant=True)
+        await update_chat(chat_id, under_assistant=False)
+
+    chat = await get_chat_by_id(chat_id)
+    assert chat is not None
+    assert chat.under_assistant is False
+
+    # Ошибка внутри блока откатывает все изменения
+    with pytest.raises(RuntimeError):
+        async with unit_of_work():
+            await create_chat("test_uow_rollback", 124, "author1", "user1", chat_url)
+            raise RuntimeError("rollback")
+
+    assert await get_chat_by_id("test_uow_rollback") is None
+
+    # Ошибка БД внутри блока не превращается в None, а откатывает транзакцию
+    from sqlalchemy.exc import IntegrityError
+    with pytest.raises(IntegrityError):
+        async with unit_of_work():
+            await create_chat(chat_id, 125, "author1", "user1", chat_url)
+    assert (await get_chat_by_id(chat_id)).thread_id == 123
+    assert get_pool_stats()["checkouts"] > 0
+
+
+
 # ==================== ТЕСТЫ ГОЛОСОВЫХ СООБЩЕНИЙ ====================
 
 class TestVoiceMessages:
@@ -1560,6 +1628,220 @@ class TestVoiceMessages:
         except Exception as e:
             pytest.skip(f"VoiceRecognition.get_processing_stats недоступен: {e}")
 
+    @pytest.mark.asyncio
+    async def test_voice_transcription_cache(self):
+        """Тест кэша распознавания: повтор по voice_id и по содержимому аудио не вызывает Whisper"""
+        from app.services.audio_downloader import AudioSource
+        from app.services.voice_recognition import VoiceRecognition
+        from app.services.transcription_cache import TranscriptionCache
+
+        async def fake_download(voice_id, chat_id, message_id, user_id):
+            return AudioSource(filename=f"{voice_id}.mp4", data=self.test_audio_file.read_bytes()), None
+
+        voice_rec = VoiceRecognition()
+        cache = TranscriptionCache()
+        with patch('app.services.voice_recognition.transcription_cache', cache), \
+                without_redis(), \
+                patch('app.services.voice_recognition.audio_downloader.download_voice_file',
+                      side_effect=fake_download) as mock_download, \
+                patch.object(voice_rec.client.audio.transcriptions, 'create',
+                             return_value="Привет из кэша") as mock_transcribe:
+            first = await voice_rec.process_voice_message("voice_1", "test_chat", "msg_1", 1)
+            repeated = await voice_rec.process_voice_message("voice_1", "test_chat", "msg_1", 1)
+            forwarded = await voice_rec.process_voice_message("voice_2", "test_chat", "msg_2", 1)
+
+            # В кэш записывается модель бэкенда, который на самом деле распознал текст
+            local_backend = MagicMock(running=True, model="faster-whisper-small",
+                                      transcribe=AsyncMock(return_value="Привет локально"))
+            local_backend.name = "faster-whisper"
+            voice_rec.local_backend = local_backend
+            cache.local.clear()
+            with patch('app.services.voice_recognition.settings.STT_BACKEND', "local"):
+                local = await voice_rec.process_voice_message("voice_3", "test_chat", "msg_3", 1)
+
+        assert first.transcribed_text == repeated.transcribed_text == forwarded.transcribed_text == "Привет из кэша"
+        assert repeated.status == forwarded.status == VoiceProcessingStatus.COMPLETED
+        assert mock_download.call_count == 3  # voice_1 повторно не скачивается
+        mock_transcribe.assert_called_once()
+        assert local.transcribed_text == "Привет локально"
+        assert (await cache.get(cache.voice_key("voice_3")))["model"] == "faster-whisper-small"
+
+    @pytest.mark.asyncio
+    async def test_audio_downloader_in_memory(self):
+        """Тест скачивания в память: маленький файл не пишется на диск, большой — пишется"""
+        import httpx
+        from app.services.audio_downloader import AudioDownloader
+
+        payload = self.test_audio_file.read_bytes()
+        transport = httpx.MockTransport(lambda request: httpx.Response(200, content=payload))
+        real_client = httpx.AsyncClient
+
+        with patch('app.services.audio_downloader.httpx.AsyncClient',
+                   side_effect=lambda **kwargs: real_client(transport=transport, **kwargs)):
+            downloader = AudioDownloader()
+            downloader.temp_dir = self.test_dir
+
+            audio, error = await downloader._download_file_from_url("https://avito.ru/voice", "chat", "msg", "voice_1")
+            assert error is None
+            assert audio.in_memory and audio.read_bytes() == payload
+            assert not (self.test_dir / audio.filename).exists()
+
+            downloader.spill_threshold_bytes = 100
+            audio, error = await downloader._download_file_from_url("https://avito.ru/voice", "chat", "msg", "voice_2")
+            assert error is None
+            assert not audio.in_memory and audio.read_bytes() == payload
+
+            await downloader.cleanup_file(audio)
+            assert not Path(audio.file_path).exists()
+
+    @pytest.mark.asyncio
+    async def test_voice_url_resolver_batching(self):
+        """Тест пакетного getVoiceFiles: голосовые, пришедшие одновременно, запрашиваются одним вызовом"""
+        import httpx
+        from app.services.audio_downloader import VoiceUrlResolver
+
+        requests = []
+
+        def handler(request):
+            voice_ids = request.url.params.get_list("voice_ids")
+            requests.append(voice_ids)
+            return httpx.Response(200, json={"voices_urls": {v: f"https://avito.ru/{v}.mp4" for v in voice_ids if v != "missing"}})
+
+        real_client = httpx.AsyncClient
+        with patch('app.services.audio_downloader.get_avito_token', AsyncMock(return_value="token")), \
+                patch('app.services.audio_downloader.httpx.AsyncClient',
+                      side_effect=lambda **kwargs: real_client(transport=httpx.MockTransport(handler), **kwargs)):
+            resolver = VoiceUrlResolver(timeout=5)
+            urls = await asyncio.gather(
+                resolver.resolve(1, "v1"), resolver.resolve(1, "v2"), resolver.resolve(1, "missing")
+            )
+
+        assert urls == ["https://avito.ru/v1.mp4", "https://avito.ru/v2.mp4", None]
+        assert requests == [["v1", "v2", "missing"]]
+
+    @pytest.mark.asyncio
+    async def test_local_stt_fallback_to_api(self):
+        """Тест локального бэкенда: короткое сообщение распознается локально, при ошибке — через API"""
+        from app.services.audio_downloader import AudioSource
+        from app.services.voice_recognition import VoiceRecognition
+
+        voice_rec = VoiceRecognition()
+        local_backend = MagicMock(running=True, model="faster-whisper-small",
+                                  transcribe=AsyncMock(return_value="локально"))
+        local_backend.name = "faster-whisper"
+        voice_rec.local_backend = local_backend
+        audio = AudioSource(filename="voice.mp4", data=self.test_audio_file.read_bytes())
+
+        with patch('app.services.voice_recognition.settings.STT_BACKEND', "local"), \
+                patch.object(voice_rec.client.audio.transcriptions, 'create', return_value="через API") as mock_api:
+            assert await voice_rec._run_backends(audio, duration=5) == ("локально", "faster-whisper-small")
+            assert await voice_rec._run_backends(audio, duration=600) == ("через API", "whisper-1")
+
+            local_backend.transcribe.side_effect = RuntimeError("модель упала")
+            assert await voice_rec._run_backends(audio, duration=5) == ("через API", "whisper-1")
+
+        assert mock_api.call_count == 2
+        assert voice_rec.backend_usage["local_fallbacks"] == 1
+
+    @pytest.mark.asyncio
+    async def test_local_stt_timeout_recycles_pool(self):
+        """Тест локального бэкенда: зависшее распознавание завершает процессы пула, пул пересоздается"""
+        import time
+        from concurrent.futures import ThreadPoolExecutor
+        from app.services.audio_downloader import AudioSource
+        from app.services.stt_backends import LocalWhisperBackend
+
+        backend = LocalWhisperBackend()
+        hung_process = MagicMock()
+        pool = ThreadPoolExecutor(max_workers=1)
+        pool._processes = {1: hung_process}
+        backend._pool = pool
+        audio = AudioSource(filename="voice.mp4", data=b"audio")
+
+        with patch('app.services.stt_backends.settings.STT_LOCAL_TIMEOUT', 0.05), \
+                patch('app.services.stt_backends.stt_worker.transcribe', lambda data, language: time.sleep(0.3)), \
+                patch.object(LocalWhisperBackend, 'start', new_callable=AsyncMock) as mock_start:
+            with pytest.raises(asyncio.TimeoutError):
+                await backend.transcribe(audio)
+            await backend._restart
+
+        hung_process.terminate.assert_called_once()
+        mock_start.assert_awaited_once()
+        assert backend._pool is None and backend.recycles == 1
+
+    @pytest.mark.asyncio
+    async def test_long_voice_transcribed_in_chunks(self):
+        """Тест предобработки: сообщение длиннее лимита режется на части и склеивается по порядку"""
+        from app.services.audio_downloader import AudioSource
+        from app.services.audio_preprocessor import audio_preprocessor
+        from app.services.voice_recognition import VoiceRecognition
+
+        voice_rec = VoiceRecognition()
+        audio = AudioSource(filename="voice.mp4", data=self.test_audio_file.read_bytes())
+        pieces = [AudioSource(filename=f"voice_{i}.ogg", data=b"opus") for i in range(3)]
+
+        async def fake_backend(piece, duration, chat_id=None):
+            await asyncio.sleep(0.01 * (3 - int(piece.filename[6])))  # Последняя часть готова первой
+            return f"часть {piece.filename[6]}", "whisper-1"
+
+        with patch('app.services.audio_preprocessor.FFMPEG_AVAILABLE', True), \
+                patch('app.services.audio_preprocessor.settings.AUDIO_PREPROCESSING_ENABLED', True), \
+                patch.object(voice_rec, '_analyze_audio_metadata', AsyncMock(return_value={"duration": 350})), \
+                patch.object(audio_preprocessor, 'prepare', AsyncMock(return_value=pieces)), \
+                patch.object(voice_rec, '_run_backends', side_effect=fake_backend):
+            text, error = await voice_rec.transcribe_audio(audio, "chat", "msg")
+
+        assert error is None
+        assert text == "часть 0 часть 1 часть 2"
+
+        # Без предобработки длинное сообщение по-прежнему отклоняется
+        with patch.object(voice_rec, '_analyze_audio_metadata', AsyncMock(return_value={"duration": 350})):
+            text, error = await voice_rec.transcribe_audio(audio, "chat", "msg")
+        assert error.code == VoiceErrorCodes.DURATION_TOO_LONG
+
+    @pytest.mark.asyncio
+    async def test_temp_file_janitor(self):
+        """Тест очистки временных файлов: возраст, квота и инкрементальные счетчики"""
+        import os
+        import time
+        from app.services.temp_janitor import TempFileJanitor
+
+        janitor_dir = self.test_dir / "janitor"
+        janitor_dir.mkdir()
+        janitor = TempFileJanitor(janitor_dir, max_age_seconds=3600, quota_bytes=2500, interval=300)
+
+        now = time.time()
+        for name, age in (("stale.mp4", 7200), ("old.mp4", 300), ("active.mp4", 200), ("new.mp4", 100)):
+            path = janitor_dir / name
+            path.write_bytes(b"x" * 1000)
+            os.utime(path, (now - age, now - age))
+        janitor.track(janitor_dir / "active.mp4", 1000)
+
+        removed = await janitor.sweep()
+
+        # stale — по возрасту, old — по квоте; active в работе и не трогается, хотя он старше new
+        assert removed == 2
+        assert sorted(p.name for p in janitor_dir.iterdir()) == ["active.mp4", "new.mp4"]
+        assert (janitor.files, janitor.bytes) == (2, 2000)
+
+        # Скачивание началось, пока обход шел в потоке: файл остается под защитой, размер уточняется
+        sweep_sync = janitor._sweep_sync
+
+        def sweep_during_download(*args):
+            result = sweep_sync(*args)
+            janitor.track(janitor_dir / "spill.mp4", 0)
+            return result
+
+        with patch.object(janitor, '_sweep_sync', side_effect=sweep_during_download):
+            await janitor.sweep()
+        assert str(janitor_dir / "spill.mp4") in janitor._active
+        janitor.track(janitor_dir / "spill.mp4", 500)
+        assert (janitor.files, janitor.bytes) == (3, 2500)
+
+        (janitor_dir / "active.mp4").unlink()
+        janitor.untrack(janitor_dir / "active.mp4")
+        assert (janitor.files, janitor.bytes) == (2, 1500)
+
     @pytest.mark.asyncio
     async def test_audio_downloader_invalid_url(self):
         """Тест ошибки - невалидный URL"""
@@ -2432,3 +2714,833 @@ async def test_case_2(all_mocks, monkeypatch):
 
         chat_after = await get_chat_by_id(chat_id)
         assert chat_after.under_assistant is False
+
+
+# ==================== ОЧЕРЕДЬ СООБЩЕНИЙ И ОТПРАВКА ====================
+
+@pytest.mark.asyncio
+async def test_flush_queue_awaits_voice_transcriptions():
+    """Тест сброса очереди: фоновые распознавания собираются в момент сброса, порядок сообщений сохраняется"""
+    from app.models.schemas import WebhookRequest
+    from app.routes.chat import flush_queue
+
+    def webhook(message_id, message_type, content):
+        return WebhookRequest.model_validate({
+            "id": message_id, "version": "v3.0.0", "timestamp": 1749755907,
+            "payload": {"type": "message", "value": {
+                "id": message_id, "chat_id": "voice_chat", "user_id": 1, "author_id": 2, "created": 1749755907,
+                "type": message_type, "chat_type": "u2i", "content": content, "item_id": 5,
+                "published_at": "2025-06-12T19:18:27Z"}}
+        })
+
+    async def slow_transcription(text, delay):
+        await asyncio.sleep(delay)
+        return text
+
+    queue = asyncio.Queue()
+    for msg in (webhook("v1", "voice", {"url": "https://avito.ru/v1"}),
+                webhook("t1", "text", {"text": "и текст"}),
+                webhook("v2", "voice", {"url": "https://avito.ru/v2"})):
+        queue.put_nowait(msg)
+
+    voice_tasks = {
+        "v1": asyncio.create_task(slow_transcription("первое голосовое", 0.05)),
+        "v2": asyncio.create_task(slow_transcription("второе голосовое", 0.01)),
+    }
+    with patch('app.routes.chat.message_queues', {"voice_chat": queue}), \
+            patch('app.routes.chat.voice_tasks', voice_tasks), \
+            patch('app.routes.chat.process_and_send_response', new_callable=AsyncMock) as mock_process:
+        await flush_queue("voice_chat", 2, 1, None, "ad", "Test User", 123)
+
+    assert mock_process.await_args.args[0] == "первое голосовое и текст второе голосовое"
+    assert voice_tasks == {}
+
+
+def test_debounce_policy():
+    """Тест адаптивного окна: обучение на паузах, ранний ответ на вопрос и верхний предел"""
+    from app.services.debounce import DebouncePolicy
+
+    clock = {"now": 1000.0}
+    with patch('app.services.debounce.time.monotonic', side_effect=lambda: clock["now"]):
+        policy = DebouncePolicy()
+        assert policy.delay("chat_1", "привет") == policy.fixed_window  # Статистики еще нет
+
+        # Клиент пишет фрагментами с паузой ~2 секунды
+        for _ in range(5):
+            policy.record_message("chat_1")
+            clock["now"] += 2
+        learned = policy.delay("chat_1", "и еще")
+        assert policy.min_window <= learned < policy.fixed_window
+
+        assert policy.delay("chat_1", "Сколько стоит доставка?") <= policy.terminal_window
+
+        # Другой чат без своей статистики использует общую
+        assert policy.delay("chat_2", "и еще") == learned
+
+        policy.record_flush("chat_1", learned)
+        policy.record_message("chat_1")  # Клиент дописал сразу после ответа
+        stats = policy.stats()
+        assert stats["early_flushes"] == 1
+        assert stats["split_replies"] == 1
+
+        # Каждое окно не длиннее предела, а вся серия частых сообщений — не дольше предела от ее начала
+        for _ in range(3):
+            policy.record_message("chat_3")
+            clock["now"] += 1
+        assert policy.delay("chat_3", "и еще") <= policy.max_window - 3
+        for _ in range(40):
+            policy.record_message("chat_3")
+            clock["now"] += 1
+        assert policy.delay("chat_3", "и еще") == 0.0
+
+        policy.record_flush("chat_3", 0.0)
+        clock["now"] += 60
+        policy.record_message("chat_3")  # Новая серия после ответа
+        assert policy.delay("chat_3", "и еще") > 0
+
+
+@pytest.mark.asyncio
+async def test_reply_stream_sends_chunks_in_order():
+    """Тест потоковой отправки: части по границам предложений, порядок внутри чата, короткий ответ целиком"""
+    from app.services.reply_stream import ReplyStreamer
+
+    streamer = ReplyStreamer()
+    sent = []
+
+    async def send(user_id, chat_id, text):
+        await asyncio.sleep(0.01)
+        sent.append((chat_id, text))
+
+    reply = ("Куртка есть в черном цвете, размеры 46 и 48 в наличии. Доставка СДЭК или Почтой России.\n"
+             "- 46: в наличии\n- 48: в наличии\n- 50: нет в наличии\nОформить заказ?")
+    first = streamer.open(1, "c1", send)
+    second = streamer.open(1, "c1", send)
+    for index in range(0, len(reply), 7):
+        first.feed(reply[index:index + 7])
+    second.feed("Следующий ответ этого же чата отправляется после предыдущего. И он тоже длинный.")
+
+    assert await first.finish() is True
+    assert await second.finish() is True
+    assert sent[0] == ("c1", "Куртка есть в черном цвете, размеры 46 и 48 в наличии. Доставка СДЭК или Почтой России.")
+    assert [text for _, text in sent] == first.sent + second.sent
+    assert " ".join(first.sent).replace("\n", " ") == " ".join(reply.split())
+    assert streamer.stats()["active_chats"] == 0
+
+    short = streamer.open(1, "c2", send)
+    short.feed("Да, есть.")
+    assert await short.finish() is False
+
+    # Вторая часть не отправилась — все неотправленное уходит одним сообщением
+    failing = []
+
+    async def flaky_send(user_id, chat_id, text):
+        failing.append(text)
+        if len(failing) == 2:
+            raise RuntimeError("Avito 502")
+
+    broken = streamer.open(1, "c3", flaky_send)
+    for index in range(0, len(reply), 7):
+        broken.feed(reply[index:index + 7])
+    assert await broken.finish() is True
+    assert failing[0] == sent[0][1] and len(failing) == 3
+    assert " ".join(failing[::2]).replace("\n", " ") == " ".join(reply.split())
+    assert streamer.stats()["send_errors"] == 1
+
+
+@pytest.mark.asyncio
+async def test_telegram_outbox_coalescing():
+    """Тест очереди уведомлений: склейка уведомлений одного треда и повтор после retry_after"""
+    from aiogram.exceptions import TelegramRetryAfter
+    from app.services.telegram_outbox import TelegramOutbox
+
+    delivered = []
+    calls = {"count": 0}
+
+    async def deliver(text, thread_id):
+        calls["count"] += 1
+        if calls["count"] == 1:
+            raise TelegramRetryAfter(method=MagicMock(), message="Too Many Requests", retry_after=0)
+        delivered.append((thread_id, text))
+
+    with patch('app.services.telegram_outbox.is_redis_configured', return_value=False), \
+            patch('app.services.telegram_outbox.settings.TELEGRAM_GROUP_RATE_PER_MIN', 600):
+        outbox = TelegramOutbox(deliver)
+        outbox.enqueue("первое", 1)
+        outbox.enqueue("второе", 1)
+        outbox.enqueue("другой тред", 2)
+        await outbox.start()
+        await outbox.stop(flush_timeout=2)
+
+    assert delivered == [(1, "первое\nвторое"), (2, "другой тред")]
+    assert outbox.stats()["coalesced_alerts"] == 1
+    assert outbox.stats()["retry_after_hits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_telegram_outbox_forgets_after_persist():
+    """Тест очереди уведомлений: LREM отправленного уведомления идет только после его RPUSH"""
+    from app.services.telegram_outbox import TelegramOutbox
+
+    operations = []
+
+    async def rpush(key, raw):
+        await asyncio.sleep(0.05)  # Redis отвечает дольше, чем Telegram принимает сообщение
+        operations.append("rpush")
+
+    async def lrem(key, count, raw):
+        operations.append("lrem")
+
+    redis = MagicMock()
+    redis.rpush = AsyncMock(side_effect=rpush)
+    redis.lrem = AsyncMock(side_effect=lrem)
+
+    with patch('app.services.telegram_outbox.is_redis_configured', return_value=True), \
+            patch('app.services.telegram_outbox.get_shared_redis', return_value=redis), \
+            patch.object(TelegramOutbox, '_keep_lease', new_callable=AsyncMock), \
+            patch.object(TelegramOutbox, '_release_lease', new_callable=AsyncMock):
+        outbox = TelegramOutbox(AsyncMock())
+        outbox.enqueue("уведомление", 1)
+        await outbox.start()
+        await outbox.stop(flush_timeout=2)
+        await asyncio.gather(*outbox._background)
+
+    assert operations == ["rpush", "lrem"]
+    assert not outbox._persisting
+    assert len(outbox._thread_buckets) == 1
+
+
+@pytest.mark.asyncio
+async def test_telegram_outbox_adopts_only_expired_queues():
+    """Тест восстановления очереди: забираются только списки воркеров с истекшей арендой, по одному элементу"""
+    from app.services.telegram_outbox import TelegramOutbox, OutboxItem, OUTBOX_REDIS_KEY
+
+    lists = {"telegram_outbox:dead": [OutboxItem("из упавшего воркера", 7).dump()],
+             "telegram_outbox:live": [OutboxItem("из живого воркера", 8).dump()]}
+
+    async def lmove(source, destination, *_):
+        return lists.get(source, []).pop(0) if lists.get(source) else None
+
+    redis = MagicMock()
+    redis.smembers = AsyncMock(return_value={"dead", "live"})
+    redis.exists = AsyncMock(side_effect=lambda key: key == "telegram_outbox:lease:live")
+    redis.lmove = AsyncMock(side_effect=lmove)
+    redis.srem = AsyncMock()
+
+    with patch('app.services.telegram_outbox.get_shared_redis', return_value=redis):
+        outbox = TelegramOutbox(AsyncMock())
+        await outbox._restore()
+
+    assert outbox.pending_count() == 1
+    assert lists["telegram_outbox:live"] and not lists["telegram_outbox:dead"]
+    sources = [call.args[0] for call in redis.lmove.await_args_list]
+    assert OUTBOX_REDIS_KEY in sources and "telegram_outbox:live" not in sources
+    redis.srem.assert_awaited_once_with("telegram_outbox:workers", "dead")
+
+
+@pytest.mark.asyncio
+async def test_forum_topic_worker():
+    """Тест фонового создания топика: повтор после ошибки, запись thread_id и досылка уведомлений"""
+    from app.services.forum_topics import ForumTopicWorker
+
+    create_topic = AsyncMock(side_effect=[RuntimeError("Telegram недоступен"), 321])
+    real_sleep = asyncio.sleep  # asyncio.sleep ниже подменяется, чтобы не ждать паузу между попытками
+    with patch('app.services.forum_topics.create_telegram_forum_topic', create_topic), \
+            patch('app.services.forum_topics.fill_chat_thread', new_callable=AsyncMock) as mock_fill, \
+            patch('app.services.forum_topics.send_alert', new_callable=AsyncMock) as mock_alert, \
+            patch('app.services.forum_topics.get_chats_without_thread', AsyncMock(return_value=[])), \
+            patch('app.services.forum_topics.get_chat_by_id',
+                  AsyncMock(return_value=SimpleNamespace(thread_id=None))), \
+            patch('app.services.forum_topics.is_redis_configured', return_value=False), \
+            patch('app.services.forum_topics.asyncio.sleep', new_callable=AsyncMock):
+        worker = ForumTopicWorker()
+        await worker.start()
+        await worker.request("chat_1", "Test User, 1", alert="Создан новый чат")
+        assert await worker.defer_alert("chat_1", "Ответ бота") is True
+
+        for _ in range(10):
+            await real_sleep(0)
+        await worker.stop()
+
+    assert create_topic.await_count == 2
+    mock_fill.assert_awaited_once_with("chat_1", 321)
+    assert [c.args for c in mock_alert.await_args_list] == [("Создан новый чат", 321), ("Ответ бота", 321)]
+    assert await worker.defer_alert("chat_1", "после создания") is False
+
+
+@pytest.mark.asyncio
+async def test_forum_topic_alerts_shared_between_workers():
+    """Тест отложенных уведомлений в Redis: уведомление другого воркера и название топика после перезапуска"""
+    from app.services.forum_topics import ForumTopicWorker
+
+    values = {"forum_topic:pending:chat_2": "Иван, 42", "forum_topic:failures:chat_3": "3"}
+    redis = MagicMock()
+    redis.eval = AsyncMock(return_value=1)
+    redis.get = AsyncMock(side_effect=values.get)
+    with patch('app.services.forum_topics.is_redis_configured', return_value=True), \
+            patch('app.services.forum_topics.get_shared_redis', return_value=redis), \
+            patch('app.services.forum_topics.get_chats_without_thread',
+                  AsyncMock(return_value=[MagicMock(chat_id="chat_2"), MagicMock(chat_id="chat_3")])), \
+            patch.object(ForumTopicWorker, '_run', AsyncMock()):
+        # Топик создает другой воркер: уведомление уходит в его список в Redis
+        assert await ForumTopicWorker().defer_alert("chat_2", "К чату подключился оператор") is True
+        assert redis.eval.await_args.args[2:5] == ("forum_topic:pending:chat_2", "forum_topic:alerts:chat_2",
+                                                   "К чату подключился оператор")
+
+        worker = ForumTopicWorker()
+        await worker.start()
+    # Топик chat_3 уже не создался FORUM_TOPIC_MAX_FAILURES раз — при перезапуске он не повторяется
+    assert worker._queue.get_nowait() == ("chat_2", "Иван, 42")
+    assert worker._queue.empty()
+
+
+@pytest.mark.asyncio
+async def test_forum_topic_claim_released_and_retried():
+    """Тест блокировки создания топика: занятый чат повторяется позже, блокировка снимается и после неудачи"""
+    from app.services.forum_topics import ForumTopicWorker, RELEASE_CLAIM_SCRIPT
+
+    pipe = MagicMock(execute=AsyncMock(return_value=[1, ["Ответ бота"], 1]))
+    redis = MagicMock(set=AsyncMock(side_effect=[False, True, True]), eval=AsyncMock(return_value=1))
+    redis.pipeline.return_value.__aenter__ = AsyncMock(return_value=pipe)
+    redis.pipeline.return_value.__aexit__ = AsyncMock(return_value=False)
+    worker = ForumTopicWorker()
+    with patch('app.services.forum_topics.is_redis_configured', return_value=True), \
+            patch('app.services.forum_topics.get_shared_redis', return_value=redis), \
+            patch('app.services.forum_topics.TOPIC_RETRY_DELAY', 0), \
+            patch('app.services.forum_topics.get_chat_by_id',
+                  AsyncMock(return_value=SimpleNamespace(thread_id=None))), \
+            patch('app.services.forum_topics.fill_chat_thread', new_callable=AsyncMock) as mock_fill, \
+            patch('app.services.forum_topics.send_alert', new_callable=AsyncMock) as mock_alert, \
+            patch.object(worker, '_create', AsyncMock(side_effect=[555, None])):
+        # Блокировку держит упавший воркер: чат не теряется, а возвращается в очередь
+        await worker._process("chat_4", "Иван, 42")
+        assert await asyncio.wait_for(worker._queue.get(), 1) == ("chat_4", "Иван, 42")
+
+        await worker._process("chat_4", "Иван, 42")
+        mock_fill.assert_awaited_once_with("chat_4", 555)
+        mock_alert.assert_awaited_once_with("Ответ бота", 555)
+        assert redis.eval.await_args.args == (RELEASE_CLAIM_SCRIPT, 1, "forum_topic:chat_4", worker.worker_id)
+
+        # Неудача учитывается в Redis, блокировка все равно снимается
+        await worker._process("chat_5", "Петр, 43")
+        pipe.incr.assert_called_once_with("forum_topic:failures:chat_5")
+        assert redis.eval.await_args.args[2] == "forum_topic:chat_5"
+    assert worker.stats()["failed"] == 1
+
+
+# ==================== КЭШ ЧАТОВ, КАТАЛОГ И БАЗА ЗНАНИЙ ====================
+
+
+@pytest.mark.asyncio
+async def test_chat_cache_local_tier():
+    """Тест локального уровня кэша чатов: чтение, инвалидация и вытеснение LRU"""
+    from app.services.chat_cache import ChatCache
+
+    with without_redis():
+        cache = ChatCache()
+        cache.local.maxsize = 2
+
+        await cache.set("chat_1", {"chat_id": "chat_1", "under_assistant": True})
+        assert (await cache.get("chat_1"))["under_assistant"] is True
+
+        await cache.invalidate("chat_1")
+        assert await cache.get("chat_1") is None
+
+        for chat_id in ("chat_2", "chat_3", "chat_4"):
+            await cache.set(chat_id, {"chat_id": chat_id})
+        assert await cache.get("chat_2") is None
+        assert await cache.get("chat_4") is not None
+
+        # Строка, прочитанная из БД до изменения чата, в кэш не попадает
+        version = await cache.version("chat_4")
+        await cache.invalidate("chat_4")
+        await cache.set("chat_4", {"chat_id": "chat_4", "under_assistant": True}, version)
+        assert await cache.get("chat_4") is None
+        assert cache.stats()["stale_fills"] == 1
+
+    # Инвалидация, не дошедшая до Redis, повторяется, а до этого Redis для чата не используется
+    redis = MagicMock()
+    redis.pipeline.side_effect = ConnectionError("down")
+    cache = ChatCache()
+    with redis_tier(cache.redis, redis):
+        await cache.invalidate("chat_5")
+        assert cache.pending == {"chat_5"}
+        assert await cache.get("chat_5") is None
+        redis.get.assert_not_called()
+
+
+def test_parse_sheet_blocks():
+    """Тест разбора листа за один проход: блоки под разными шапками, несколько ID в ячейке"""
+    import json
+    from app.models.product import StockItem
+    from app.services.google_sheets_api import parse_sheet
+
+    rows = [
+        ["Каталог"],
+        ["ID", "Название", "Цена", "Цвет", "44", "48", "Фото"],
+        ["111, 112", "Куртка", "5000", "черный", "1", "0", "p1"],
+        ["", "", "", "синий", "0", "0", "p2"],
+        ["222", "Свитшот", "3000", "белый", "0", "2", "p3"],
+        [],
+        ["Артикул", "Название", "Цена", "Описание", "Цвет", "s", "м"],
+        ["333", "Футболка", "1500", "Хлопок", "серый", "3", ""],
+    ]
+
+    products = parse_sheet(rows, "Одежда")
+
+    assert set(products) == {"111", "112", "222", "333"}
+    assert products["112"].id == "112"
+    assert products["111"].stock is products["112"].stock
+    assert products["111"].stock == [
+        StockItem(color="черный", sizes={"S": "Есть в наличии", "M": "Нет в наличии"}, has_available_sizes=True),
+        StockItem(color="синий", sizes={"S": "Нет в наличии", "M": "Нет в наличии"}, has_available_sizes=False),
+    ]
+    assert products["111"].photo_ids == "p1, p2"
+    assert products["222"].available_colors == ["белый"]
+    assert products["333"].description == "Хлопок"
+    assert products["333"].stock[0].sizes == {"S": "Есть в наличии", "M": "Нет в наличии"}
+
+    # Готовый компактный prompt: без пробелов и пустых полей
+    prompt = json.loads(products["112"].prompt)
+    assert prompt["id"] == "112" and prompt["name"] == "Куртка"
+    assert "payment_method" not in prompt
+    assert ": " not in products["112"].prompt
+
+
+def test_size_normalizer_lookup_table():
+    """Тест нормализатора размеров: варианты написания, дополнительная таблица и кэш"""
+    from app.services.google_sheets_api import SizeNormalizer
+
+    normalizer = SizeNormalizer({"EU 38": "38", "рост 110": "110", "one size": "ONE SIZE"}, cache_size=16)
+
+    assert normalizer.normalize("хл") == "XL"
+    assert normalizer.normalize(" 2XL ") == "XXL"
+    assert normalizer.normalize("48 (M)") == "M"
+    assert normalizer.normalize("eu 38") == "38"
+    assert normalizer.normalize("Рост 110") == "110"
+    assert normalizer.is_size(normalizer.normalize("One Size"))
+    assert normalizer.normalize("Фото") == "ФОТО"
+
+    normalizer.normalize("хл")
+    assert normalizer.normalize.cache_info().hits == 1
+
+
+@pytest.mark.asyncio
+async def test_product_catalog_incremental_refresh(tmp_path):
+    """Тест каталога: разбираются только измененные листы, неизмененная таблица не скачивается"""
+    from app.services.catalog_snapshot import CatalogSnapshot
+    from app.services.google_sheets_api import ProductCatalog
+
+    header = ["ID", "Название", "Цена", "Цвет", "48"]
+    sheets = {
+        "Куртки": [header, ["111", "Куртка", "5000", "черный", "1"]],
+        "Свитшоты": [header, ["222", "Свитшот", "3000", "белый", "0"], ["333", "Худи", "4000", "серый", "2"]],
+    }
+    revision = {"value": None}
+    catalog = ProductCatalog()
+    catalog.snapshot = CatalogSnapshot(str(tmp_path / "catalog.sqlite3"))
+
+    with patch('app.services.google_sheets_api.get_all_sheet_names', AsyncMock(side_effect=lambda: list(sheets))), \
+            patch.object(catalog, '_fetch_values', AsyncMock(side_effect=lambda names: [sheets[n] for n in names])), \
+            patch.object(catalog, '_fetch_revision', AsyncMock(side_effect=lambda: revision["value"])):
+        assert await catalog.refresh() == 2
+        assert (await catalog.get("333")).name == "Худи"
+
+        assert await catalog.refresh() == 0  # Хэши листов не изменились
+
+        sheets["Свитшоты"] = [header, ["222", "Свитшот", "2500", "белый", "1"]]
+        assert await catalog.refresh() == 1
+        assert (await catalog.get("222")).price == "2500"
+        assert catalog._index.get("333") is None
+        assert (await catalog.get("111")).name == "Куртка"
+
+        revision["value"] = "2026-01-01T00:00:00Z"
+        await catalog.refresh()
+        sheets["Куртки"] = [header, ["111", "Куртка", "6000", "черный", "1"]]
+        assert await catalog.refresh() == 0  # modifiedTime не изменился — листы не скачиваются
+        assert catalog._fetch_values.await_count == 4
+
+
+@pytest.mark.asyncio
+async def test_product_catalog_serves_snapshot_during_outage(tmp_path):
+    """Тест stale-while-revalidate: после перезапуска при недоступном Google ответ идет из снимка"""
+    import time
+    from app.services.catalog_snapshot import CatalogSnapshot
+    from app.services.google_sheets_api import ProductCatalog
+
+    snapshot = CatalogSnapshot(str(tmp_path / "catalog.sqlite3"))
+    rows = [["ID", "Название", "Цена", "Цвет", "48"], ["111", "Куртка", "5000", "черный", "1"]]
+    catalog = ProductCatalog()
+    catalog.snapshot = snapshot
+    with patch('app.services.google_sheets_api.get_all_sheet_names', AsyncMock(return_value=["Куртки"])), \
+            patch.object(catalog, '_fetch_values', AsyncMock(return_value=[rows])), \
+            patch.object(catalog, '_fetch_revision', AsyncMock(return_value=None)):
+        await catalog.refresh()
+
+    # Перезапуск: Google недоступен, снимок сделан час назад
+    snapshot.save(None, time.time() - 3600, ["Куртки"], {}, set())
+    restarted = ProductCatalog()
+    restarted.snapshot = snapshot
+    outage = AsyncMock(return_value=[])
+    with patch('app.services.google_sheets_api.get_all_sheet_names', outage), \
+            patch.object(restarted, '_fetch_revision', AsyncMock(return_value=None)):
+        assert await restarted.load_snapshot()
+        result = await restarted.lookup("111")
+        await asyncio.sleep(0)  # Фоновое обновление стартовало, но ответ его не ждал
+
+    assert result.product.name == "Куртка"
+    assert result.product.prompt.startswith('{"id":"111",')
+    assert result.age_seconds >= 3600
+    assert restarted.stale_lookups == 1
+    assert outage.await_count == 1
+
+
+@pytest.mark.asyncio
+async def test_knowledge_index_rebuilt_with_catalog(tmp_path):
+    """Тест базы знаний: индекс строится при обновлении каталога и возвращает только подходящие пары"""
+    from app.services.catalog_snapshot import CatalogSnapshot
+    from app.services.google_sheets_api import ProductCatalog
+    from app.services.knowledge_index import KnowledgeIndex
+
+    index = KnowledgeIndex()
+    sheets = {
+        "Куртки": [["ID", "Название", "Цена", "Цвет", "48"], ["111", "Куртка", "5000", "черный", "1"]],
+        "knowledge_base": [
+            ["Есть ли доставка?", "Да, доставка СДЭК и Почтой России"],
+            ["Как оплатить заказ?", "Оплата при получении или переводом"],
+            ["Можно ли примерить?", "Да, примерка в шоуруме"],
+        ],
+    }
+    catalog = ProductCatalog()
+    catalog.snapshot = CatalogSnapshot(str(tmp_path / "catalog.sqlite3"))
+
+    with patch('app.services.google_sheets_api.knowledge_index', index), \
+            patch('app.services.google_sheets_api.get_all_sheet_names', AsyncMock(return_value=list(sheets))), \
+            patch.object(catalog, '_fetch_values', AsyncMock(side_effect=lambda names: [sheets[n] for n in names])), \
+            patch.object(catalog, '_fetch_revision', AsyncMock(return_value=None)):
+        await catalog.refresh()
+
+    assert index.size == 3
+    assert catalog._index.keys() == {"111"}
+    assert [e["question"] for e in index.search("Здравствуйте, а доставкой отправите?", 3, 1.0)] == ["Есть ли доставка?"]
+    assert [e["question"] for e in index.search("как можно оплатить", 3, 1.0)] == ["Как оплатить заказ?"]
+    assert index.search("привет", 3, 1.0) == []
+    assert index.render(index.search("примерка", 1)) == "Q: Можно ли примерить?\nA: Да, примерка в шоуруме"
+
+
+@pytest.mark.asyncio
+async def test_knowledge_index_built_after_restart_and_without_catalog(tmp_path):
+    """Тест базы знаний: индекс строится после подъема каталога из снимка и при выключенном каталоге"""
+    from app.config import settings
+    from app.services.catalog_snapshot import CatalogSnapshot
+    from app.services.google_sheets_api import ProductCatalog
+    from app.services.knowledge_index import KnowledgeIndex
+
+    sheet_names = ["Куртки", "Knowledge_base"]
+    knowledge = [["Есть ли доставка?", "Да, доставка СДЭК"]]
+    snapshot = CatalogSnapshot(str(tmp_path / "catalog.sqlite3"))
+    snapshot.save("rev-1", 0.0, ["Куртки"], {"Куртки": ("hash", {})}, set())
+
+    # Перезапуск: каталог из снимка, таблица не менялась
+    index = KnowledgeIndex()
+    catalog = ProductCatalog()
+    catalog.snapshot = snapshot
+    with patch('app.services.google_sheets_api.knowledge_index', index), \
+            patch('app.services.google_sheets_api.get_all_sheet_names', AsyncMock(return_value=sheet_names)), \
+            patch.object(catalog, '_fetch_values', AsyncMock(return_value=[knowledge])) as fetch, \
+            patch.object(catalog, '_fetch_revision', AsyncMock(return_value="rev-1")):
+        assert await catalog.load_snapshot()
+        assert await catalog.refresh() == 0
+    fetch.assert_awaited_once_with(["Knowledge_base"])
+    assert index.size == 1
+
+    # Каталог выключен: индекс строится при первом ответе и не перечитывается на каждом
+    index = KnowledgeIndex()
+    catalog = ProductCatalog()
+    with patch('app.services.google_sheets_api.knowledge_index', index), \
+            patch('app.services.google_sheets_api.get_all_sheet_names', AsyncMock(return_value=sheet_names)), \
+            patch.object(settings, 'CATALOG_ENABLED', False), \
+            patch.object(catalog, '_fetch_values', AsyncMock(return_value=[knowledge])) as fetch:
+        await catalog.ensure_knowledge()
+        await catalog.ensure_knowledge()
+    assert fetch.await_count == 1
+    assert index.size == 1
+
+
+# ==================== АССИСТЕНТ ====================
+
+
+@pytest.mark.asyncio
+async def test_answer_cache_exact_and_similar():
+    """Тест кэша ответов: точное и похожее совпадение, смена версии товара, защита первого ответа в чате"""
+    import json
+    from app.models.product import Product
+    from app.services.answer_cache import AnswerCache, context_version
+    from app.services.openai_assistant import assistant_manager
+
+    cache = AnswerCache()
+    version = context_version('{"id":"111","name":"Куртка"}', None)
+    with without_redis():
+        key = cache.key("111", version, "Здравствуйте! Какие размеры есть?")
+        assert cache.key("111", version, "а в черном?") is None
+        assert await cache.get(key) is None
+
+        await cache.set(key, "Есть 46 и 48")
+        cache.record_run(8.0)
+        assert await cache.get(cache.key("111", version, "какие размеры есть")) == "Есть 46 и 48"
+        assert await cache.get(cache.key("111", version, "какие размеры есть?)")) == "Есть 46 и 48"
+        assert await cache.get(cache.key("111", version, "какие размеры естьь")) == "Есть 46 и 48"
+        assert await cache.get(cache.key("111", context_version("изменился", None), "какие размеры есть")) is None
+        assert await cache.get(cache.key("111", version, "есть ли доставка")) is None
+        await cache.set(cache.key("111", version, "есть ли 46 размер"), "Да, 46 есть")
+        assert await cache.get(cache.key("111", version, "есть ли 48 размер")) is None
+
+    stats = cache.stats()
+    assert stats["exact_hits"] == 2 and stats["similar_hits"] == 1 and stats["misses"] == 4
+    assert stats["saved_seconds"] == 24.0
+
+    product = Product("111", "Куртки", "Куртка", "5000", "", "", "", "", "", [], False, [])
+    with patch('app.services.openai_assistant.answer_cache', cache), \
+            patch('app.services.openai_assistant.get_latest_message_by_chat_id_and_author_id',
+                  AsyncMock(side_effect=[None, "Здравствуйте! Чем помочь?", "Есть 46 и 48"])):
+        # Первый ответ в чате должен поздороваться — кэш не используется
+        assert await assistant_manager._answer_cache_key("c1", 1, product, None, "какие размеры есть") is None
+        assert await assistant_manager._answer_cache_key("c1", 1, product, None, "какие размеры есть") is not None
+        await cache.set(cache.key("111", context_version(product.prompt, None), "какие размеры есть"), "Есть 46 и 48")
+        # Клиент переспрашивает после такого же ответа — отвечает ассистент
+        assert await assistant_manager._answer_cache_key("c1", 1, product, None, "какие размеры есть") is None
+
+    # Ответ другого процесса лежит только в Redis — повтор все равно распознается
+    shared = AnswerCache()
+    redis = MagicMock(get=AsyncMock(return_value=json.dumps({"answer": "Есть 46 и 48"})))
+    with patch('app.services.openai_assistant.answer_cache', shared), \
+            redis_tier(shared.redis, redis), \
+            patch('app.services.openai_assistant.get_latest_message_by_chat_id_and_author_id',
+                  AsyncMock(return_value="Есть 46 и 48")):
+        assert await assistant_manager._answer_cache_key("c2", 1, product, None, "какие размеры есть") is None
+
+    # Ответ после рассказа клиента о себе зависит от истории чата и не сохраняется
+    with patch('app.services.openai_assistant.answer_cache', cache), \
+            patch('app.services.openai_assistant.count_messages_by_chat_id_and_author_id',
+                  AsyncMock(side_effect=[2, 5, None])):
+        assert await assistant_manager._answer_cacheable("c1", 2) is True
+        assert await assistant_manager._answer_cacheable("c1", 2) is False
+        assert await assistant_manager._answer_cacheable("c1", 2) is False
+
+
+@pytest.mark.asyncio
+async def test_chat_completions_engine_tools_and_history():
+    """Тест движка Chat Completions: вызов функции из фрагментов потока, ответ и локальная история"""
+    from app.services.chat_engine import ChatCompletionsEngine
+
+    def chunk(content=None, tool_calls=None):
+        return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=content, tool_calls=tool_calls))])
+
+    def tool_delta(index, id=None, name=None, arguments=None):
+        return SimpleNamespace(index=index, id=id, function=SimpleNamespace(name=name, arguments=arguments))
+
+    async def stream(chunks):
+        for item in chunks:
+            yield item
+
+    responses = [
+        [chunk(tool_calls=[tool_delta(0, "call_1", "create_order", '{"size": "4')]),
+         chunk(tool_calls=[tool_delta(0, arguments='8", "color": "черный"}')])],
+        [chunk("Заказ оформлен. "), chunk("Спасибо!")],
+        [chunk("Да, доставка есть.")],
+        [chunk("Сейчас оформлю возврат."), chunk(tool_calls=[tool_delta(0, "call_2", "create_return", "{}")])],
+        [chunk("Готово!")],
+    ]
+    requests = []
+
+    async def create(**kwargs):
+        requests.append(kwargs)
+        return stream(responses.pop(0))
+
+    client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    engine = ChatCompletionsEngine(client=client)
+    handle_tools = AsyncMock(return_value=[{"status": "success", "message": "Order created"}])
+
+    with without_redis():
+        result = await engine.respond(1, "c1", "Хочу 48 черный", "# STOCK: {}", handle_tools)
+        assert result.text == "Заказ оформлен. Спасибо!" and result.function_name == "create_order"
+        handle_tools.assert_awaited_once_with([("create_order", {"size": "48", "color": "черный"})])
+        assert requests[1]["messages"][-1] == {"role": "tool", "tool_call_id": "call_1",
+                                               "content": '{"status": "success", "message": "Order created"}'}
+
+        result = await engine.respond(1, "c1", "Есть доставка?", "# STOCK: {}", handle_tools)
+        assert result.text == "Да, доставка есть."
+        # В историю попадают только реплики клиента и ассистента, без контекста и вызовов функций
+        assert requests[2]["messages"][1:3] == [
+            {"role": "user", "content": "Хочу 48 черный"},
+            {"role": "assistant", "content": "Заказ оформлен. Спасибо!"}
+        ]
+        assert len(await engine.load_history(1, "c1")) == 4
+
+        # Текст раунда перед вызовом функции уже ушел клиенту — он входит в ответ и в историю
+        sent = []
+        result = await engine.respond(1, "c1", "Хочу вернуть", "# STOCK: {}", handle_tools, on_text=sent.append)
+        assert result.text == "Сейчас оформлю возврат.\nГотово!"
+        assert "".join(sent) == result.text
+        assert (await engine.load_history(1, "c1"))[-1] == {"role": "assistant", "content": result.text}
+
+
+@pytest.mark.asyncio
+async def test_tool_calls_run_concurrently_with_background_alerts():
+    """Тест функций ассистента: вызовы одного хода идут параллельно, уведомления в Telegram не ждем"""
+    import time
+    from app.services.assistant_tools import ToolContext, ToolResult
+    from app.services.openai_assistant import assistant_manager
+
+    async def slow_write(arguments, context):
+        await asyncio.sleep(0.1)
+        return ToolResult({"status": "success", "message": arguments["name"]}, (f"alert {arguments['name']}", 1))
+
+    async def broken_write(arguments, context):
+        raise RuntimeError("database is down")
+
+    async def slow_alert(message, thread_id):
+        await asyncio.sleep(0.3)
+        alerts.append(message)
+
+    alerts = []
+    context = ToolContext("c1", "client", "Иван", "https://avito.ru/chat", "https://avito.ru/ad", "Куртка")
+    handlers = {"escalation": slow_write, "create_order": slow_write, "create_return": broken_write}
+    with patch.dict('app.services.assistant_tools.TOOL_HANDLERS', handlers), \
+            patch('app.services.telegram_notifier.send_alert', slow_alert):
+        started = time.monotonic()
+        outputs = await assistant_manager.handle_tool_calls(
+            [("escalation", {"name": "first"}), ("create_return", {}), ("create_order", {"name": "second"}),
+             ("unknown", {})], context
+        )
+        assert time.monotonic() - started < 0.18
+        assert [output["message"] for output in outputs] == [
+            "first", "Function create_return failed", "second", "Unknown function unknown"
+        ]
+        assert outputs[1]["status"] == "error"
+        assert alerts == []
+
+        await asyncio.gather(*assistant_manager._background)
+    assert sorted(alerts) == ["alert first", "alert second"]
+
+
+@pytest.mark.asyncio
+async def test_usage_tracker_counters_budget_and_metrics():
+    """Тест учета расхода: счетчики по чату, объявлению и функциям, бюджет чата, сводка в Postgres и /metrics"""
+    import datetime
+    from app.config import settings
+    from app.services.usage_tracker import UsageTracker
+
+    tracker = UsageTracker()
+    with without_redis(), \
+            patch.object(settings, 'CHAT_TOKEN_BUDGET', 1000), \
+            patch('app.services.usage_tracker.upsert_usage', new_callable=AsyncMock) as upsert:
+        await tracker.record_turn("c1", "111", "gpt-4o-mini", 600, 100, [], 2.5)
+        assert await tracker.over_budget("c1") is False
+        await tracker.record_turn("c1", "111", "gpt-4o-mini", 300, 50, ["create_order"], 3.0)
+        await tracker.record_turn("c2", "222", "gpt-4o-mini", 200, 20, [], 1.0)
+        await tracker.record_summary("c2", "gpt-4o-mini", 500, 60)
+        await tracker.record_transcription("c1", "whisper-1", 12.5)
+
+        assert await tracker.chat_tokens("c1") == 1050
+        assert await tracker.chat_tokens("c2") == 780  # Сводка треда входит в бюджет чата
+        assert await tracker.over_budget("c1") is True
+        assert await tracker.over_budget("c2") is False
+
+        snapshot = await tracker.snapshot()
+        assert snapshot["total"] == {"prompt_tokens": 1600, "completion_tokens": 230, "turns": 3,
+                                     "transcriptions": 1, "whisper_seconds": 12.5}
+        assert snapshot["tools"] == {"create_order": 1}
+        assert [row["key"] for row in snapshot["top_chats"]] == ["c1", "c2"]
+        assert snapshot["top_ads"][0]["total_tokens"] == 1050
+
+        await tracker.rollup()
+        day, rows = upsert.await_args_list[-1].args
+        assert day == datetime.date.today()
+        assert rows[("ad", "111")]["prompt_tokens"] == 900
+
+    # Redis настроен, но недоступен: счетчики одного процесса не перезаписывают общие итоги
+    with redis_tier(tracker.redis, None), \
+            patch('app.services.usage_tracker.upsert_usage', new_callable=AsyncMock) as upsert:
+        await tracker.rollup()
+        upsert.assert_not_awaited()
+        assert (await tracker.snapshot())["total"]["turns"] == 3
+    assert tracker.stats()["skipped_rollups"] == 1
+
+    async with AsyncClient(app=app, base_url="http://test") as client:
+        with patch('app.routes.metrics.usage_tracker', tracker), \
+                patch('app.routes.metrics.METRICS_TOKEN', "secret"), \
+                without_redis():
+            assert (await client.get("/metrics")).status_code == 403
+            assert (await client.get("/metrics", params={"token": "wrong"})).status_code == 403
+            assert (await client.get("/metrics", params={"token": "secret"})).status_code == 200
+            response = await client.get("/metrics", headers={"X-Metrics-Token": "secret"})
+    assert response.status_code == 200
+    body = response.json()
+    assert body["usage"]["total"]["turns"] == 3
+    assert {"answer_cache", "catalog", "knowledge_index", "telegram_outbox", "voice"} <= body.keys()
+
+
+@pytest.mark.asyncio
+async def test_thread_compaction_summary_and_compare_and_swap():
+    """Тест сжатия треда: лимит сообщений, сводка без контекста остатков, замена треда только при совпадении в БД"""
+    from app.config import settings
+    from app.services.thread_compaction import ThreadCompactor, SUMMARY_MARKER
+
+    def list_messages(thread_id, order, limit, after=None):
+        if order == "asc":
+            # Ход другого воркера, завершившийся, пока готовилась сводка
+            newer = [thread_message("m4", "user", "# STOCK AVAILABILITY AND INFORMATION: {...}"),
+                     thread_message("m5", "user", "А доставка когда?")]
+            return SimpleNamespace(data=newer if thread_id == "thread_old" and after == "m3" else [])
+        return SimpleNamespace(data=[
+            thread_message("m3", "assistant", "Вам подойдет 48 размер"),
+            thread_message("m2", "user", "# STOCK AVAILABILITY AND INFORMATION: {...}"),
+            thread_message("m1", "user", "Рост 180, вес 80"),
+        ])
+
+    client = MagicMock()
+    client.beta.threads.messages.list.side_effect = list_messages
+    client.chat.completions.create.return_value = SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(content="- Рост 180, вес 80\n- Размер 48"))],
+        usage=SimpleNamespace(prompt_tokens=300, completion_tokens=40)
+    )
+    client.beta.threads.create.side_effect = [SimpleNamespace(id="thread_new"), SimpleNamespace(id="thread_lost")]
+    compactor = ThreadCompactor(client)
+
+    with without_redis(), \
+            patch.object(settings, 'THREAD_COMPACT_MAX_MESSAGES', 6), \
+            patch('app.services.thread_compaction.replace_chat_openai_thread', new_callable=AsyncMock,
+                  side_effect=[SimpleNamespace(thread_id_openai="thread_new"), None]) as replace, \
+            patch('app.services.thread_compaction.get_chat_by_id', new_callable=AsyncMock,
+                  return_value=SimpleNamespace(thread_id_openai="thread_other")), \
+            patch('app.services.thread_compaction.usage_tracker.record_summary', new_callable=AsyncMock) as record:
+        await compactor.after_turn("c1", "thread_old", 3, 1200)
+        assert await compactor.before_turn("c1", "thread_old") == "thread_old"
+        await compactor.after_turn("c1", "thread_old", 3, 1500)
+
+        replace.assert_awaited_with("c1", "thread_old", "thread_new")
+        transcript = client.chat.completions.create.call_args.kwargs["messages"][1]["content"]
+        assert transcript == "Клиент: Рост 180, вес 80\nАссистент: Вам подойдет 48 размер"
+        seed = client.beta.threads.create.call_args.kwargs["messages"][0]["content"]
+        assert seed.startswith(SUMMARY_MARKER) and "Размер 48" in seed
+        client.beta.threads.messages.create.assert_called_once_with(thread_id="thread_new", role="user",
+                                                                    content="А доставка когда?")
+        assert (await compactor.get_state("thread_new"))["messages"] == 2
+        record.assert_awaited_once_with("c1", settings.THREAD_SUMMARY_MODEL, 300, 40)
+
+        # Другой процесс уже заменил тред: новый удаляется, используется тред из БД
+        assert await compactor.compact("c1", "thread_new", "test") == "thread_other"
+        client.beta.threads.delete.assert_called_once_with("thread_lost")
+    assert compactor.stats()["compactions"] == 1
+    assert compactor.stats()["conflicts"] == 1
+
+    # Чат сжимает другой воркер: ход ждет снятия блокировки и берет новый тред из БД
+    redis = MagicMock(set=AsyncMock(return_value=False), exists=AsyncMock(side_effect=[1, 1, 0, 1, 0]))
+    with redis_tier(compactor.redis, redis), \
+            patch('app.services.thread_compaction.COMPACTION_POLL_SECONDS', 0), \
+            patch('app.services.thread_compaction.get_chat_by_id', new_callable=AsyncMock,
+                  return_value=SimpleNamespace(thread_id_openai="thread_compacted")):
+        assert await compactor.before_turn("c2", "thread_old") == "thread_compacted"
+        assert await compactor.compact("c2", "thread_old", "test") == "thread_compacted"
+    assert client.beta.threads.create.call_count == 2
+    assert compactor.stats()["waits"] == 2
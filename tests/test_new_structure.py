@@ -4,7 +4,6 @@
 """
 
 import asyncio
-import json
 
 import pytest
 import sys
@@ -74,7 +73,7 @@ async def test_category_search():
         try:
             result = await fetch_google_sheet_stock(test_url)
             if result:
-                data = json.loads(result)
+                data = result.to_dict()
                 category = data.get('category', 'Не определена')
                 name = data.get('name', 'Не указано')
                 colors = len(data.get('stock', []))
@@ -103,7 +102,7 @@ async def test_category_search():
 
                 # Сохраняем результат для изучения
                 with open(f"result_{product_id}.json", 'w', encoding='utf-8') as f:
-                    f.write(result)
+                    f.write(result.prompt)
                 print(f"   💾 Сохранено в result_{product_id}.json")
 
             else: